@@ -0,0 +1,284 @@
+"""Local stand-ins for the services the bot talks to.
+
+- media server: synthetic files of any size with per-connection bandwidth
+  and optional Range support
+- fake Cobalt API: answers tunnel/redirect/picker/error depending on the URL
+- fake Bot API: accepts every method the bot uses, reads uploads to the end
+  and remembers what each chat received
+
+URLs understood by the fake Cobalt API: https://bench.test/<kind>/<id>
+where kind is tunnel, redirect, picker or error.
+"""
+
+import asyncio
+import json
+import time
+from collections import defaultdict
+from typing import Any
+
+from aiohttp import web
+
+BLOCK = b"\0" * (64 * 1024)
+
+
+class Config:
+    """Settings shared by the fake services"""
+
+    def __init__(
+        self,
+        host: str = "127.0.0.1",
+        media_port: int = 18701,
+        cobalt_port: int = 18702,
+        bot_port: int = 18703,
+        file_size: int = 8 * 1024 * 1024,
+        bandwidth: int = 8 * 1024 * 1024,
+        ranges: bool = True,
+        cobalt_latency: float = 0.05,
+        bot_latency: float = 0.01,
+        upload_bandwidth: int = 0,
+        picker_items: int = 4,
+    ):
+        self.host = host
+        self.media_port = media_port
+        self.cobalt_port = cobalt_port
+        self.bot_port = bot_port
+        self.file_size = file_size
+        self.bandwidth = bandwidth
+        self.ranges = ranges
+        self.cobalt_latency = cobalt_latency
+        self.bot_latency = bot_latency
+        self.upload_bandwidth = upload_bandwidth
+        self.picker_items = picker_items
+
+    @property
+    def media_url(self) -> str:
+        return f"http://{self.host}:{self.media_port}"
+
+    @property
+    def cobalt_url(self) -> str:
+        return f"http://{self.host}:{self.cobalt_port}"
+
+    @property
+    def bot_url(self) -> str:
+        return f"http://{self.host}:{self.bot_port}"
+
+    def media_file_url(self, name: str, size: int | None = None) -> str:
+        return f"{self.media_url}/media/{name}?size={size or self.file_size}"
+
+
+async def throttled_write(response: web.StreamResponse, length: int, bandwidth: int) -> None:
+    """Write length zero bytes, pacing to bandwidth bytes/s (0 = unlimited)"""
+    started = time.monotonic()
+    sent = 0
+    while sent < length:
+        chunk = BLOCK[:min(len(BLOCK), length - sent)]
+        await response.write(chunk)
+        sent += len(chunk)
+        if bandwidth:
+            ahead = sent / bandwidth - (time.monotonic() - started)
+            if ahead > 0:
+                await asyncio.sleep(ahead)
+
+
+def media_app(config: Config) -> web.Application:
+    stats = {"requests": 0, "bytes": 0}
+
+    async def media(request: web.Request) -> web.StreamResponse:
+        size = int(request.query.get("size", config.file_size))
+        start, end = 0, size - 1
+        status = 200
+        range_header = request.headers.get("Range")
+        if config.ranges and range_header and range_header.startswith("bytes="):
+            first, _, last = range_header[6:].partition("-")
+            start = int(first or 0)
+            end = min(int(last), size - 1) if last else size - 1
+            status = 206
+
+        response = web.StreamResponse(status=status)
+        response.content_length = end - start + 1
+        response.content_type = "video/mp4"
+        if config.ranges:
+            response.headers["Accept-Ranges"] = "bytes"
+        if status == 206:
+            response.headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+        await response.prepare(request)
+        stats["requests"] += 1
+        await throttled_write(response, end - start + 1, config.bandwidth)
+        stats["bytes"] += end - start + 1
+        return response
+
+    async def media_stats(request: web.Request) -> web.Response:
+        return web.json_response(stats)
+
+    app = web.Application()
+    app.router.add_get("/media/{name}", media)
+    app.router.add_get("/_bench/stats", media_stats)
+    return app
+
+
+def cobalt_app(config: Config) -> web.Application:
+    async def info(request: web.Request) -> web.Response:
+        return web.json_response({"cobalt": {"version": "bench"}})
+
+    async def process(request: web.Request) -> web.Response:
+        body = await request.json()
+        await asyncio.sleep(config.cobalt_latency)
+
+        parts = body.get("url", "").rstrip("/").split("/")
+        kind, item_id = (parts[-2], parts[-1]) if len(parts) >= 2 else ("error", "none")
+        audio = body.get("downloadMode") == "audio"
+
+        if kind in ("tunnel", "redirect"):
+            name = f"{item_id}.m4a" if audio else f"{item_id}.mp4"
+            size = config.file_size // 8 if audio else config.file_size
+            return web.json_response({"status": kind, "url": config.media_file_url(name, size), "filename": name})
+        if kind == "picker":
+            return web.json_response({
+                "status": "picker",
+                "picker": [
+                    {"type": "photo", "url": config.media_file_url(f"{item_id}-{i}.jpg", 200 * 1024)}
+                    for i in range(config.picker_items)
+                ],
+            })
+        return web.json_response({"status": "error", "error": {"code": "error.api.content.video.unavailable"}})
+
+    app = web.Application()
+    app.router.add_get("/", info)
+    app.router.add_post("/", process)
+    return app
+
+
+# Methods whose result carries the sent media, and the field it goes in
+MEDIA_METHODS = {"sendVideo": "video", "sendAudio": "audio", "sendPhoto": "photo", "sendDocument": "document"}
+
+
+def bot_app(config: Config) -> web.Application:
+    chats: dict[int, dict[str, Any]] = defaultdict(lambda: {"buttons": [], "media": 0, "errors": 0})
+    stats = {"requests": 0, "upload_bytes": 0, "methods": defaultdict(int)}
+    message_ids = iter(range(1, 1 << 62))
+
+    async def read_body(request: web.Request) -> dict[str, Any]:
+        """Parse form or JSON fields, reading file parts to the end at the configured speed"""
+        if request.content_type == "application/json":
+            return await request.json()
+        fields: dict[str, Any] = {}
+        if not request.content_type.startswith("multipart/"):
+            fields.update(await request.post())
+            return fields
+        reader = await request.multipart()
+        started = time.monotonic()
+        received = 0
+        async for part in reader:
+            if part.filename:  # type: ignore[union-attr]
+                while chunk := await part.read_chunk(256 * 1024):  # type: ignore[union-attr]
+                    received += len(chunk)
+                    if config.upload_bandwidth:
+                        ahead = received / config.upload_bandwidth - (time.monotonic() - started)
+                        if ahead > 0:
+                            await asyncio.sleep(ahead)
+            else:
+                fields[part.name] = await part.text()  # type: ignore[union-attr]
+        stats["upload_bytes"] += received
+        return fields
+
+    def message(chat_id: int, **extra: Any) -> dict[str, Any]:
+        return {
+            "message_id": next(message_ids),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            **extra,
+        }
+
+    def media_object(kind: str) -> Any:
+        file_id = f"bench-{kind}-{next(message_ids)}"
+        item = {"file_id": file_id, "file_unique_id": file_id}
+        if kind == "photo":
+            return [{**item, "width": 640, "height": 360}]
+        if kind == "video":
+            return {**item, "width": 1280, "height": 720, "duration": 60}
+        if kind == "audio":
+            return {**item, "duration": 60}
+        return item
+
+    async def method(request: web.Request) -> web.Response:
+        name = request.match_info["method"]
+        fields = await read_body(request)
+        await asyncio.sleep(config.bot_latency)
+        stats["requests"] += 1
+        stats["methods"][name] += 1
+
+        chat_id = int(fields.get("chat_id") or 0)
+        chat = chats[chat_id]
+        markup = fields.get("reply_markup")
+        if markup:
+            markup = json.loads(markup) if isinstance(markup, str) else markup
+            chat["buttons"] = [
+                button["callback_data"]
+                for row in markup.get("inline_keyboard", [])
+                for button in row
+                if button.get("callback_data") and not button["callback_data"].startswith("cancel")
+            ]
+        text = str(fields.get("text") or "")
+        if text.startswith(("❌", "⚠️")):
+            chat["errors"] += 1
+
+        if name in MEDIA_METHODS:
+            # Previews are photos with buttons, everything else is a delivered file
+            if not markup:
+                chat["media"] += 1
+            kind = MEDIA_METHODS[name]
+            result: Any = message(chat_id, **{kind: media_object(kind)})
+        elif name == "sendMediaGroup":
+            media = fields.get("media")
+            items = json.loads(media) if isinstance(media, str) else media or []
+            chat["media"] += len(items)
+            result = [
+                message(chat_id, **{("photo" if item.get("type") == "photo" else "video"): media_object(item.get("type", "video"))})
+                for item in items
+            ]
+        elif name in ("sendMessage", "editMessageText"):
+            result = message(chat_id, text=text)
+        elif name == "getMe":
+            result = {"id": 123456, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+        else:
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+    async def chat_state(request: web.Request) -> web.Response:
+        return web.json_response(chats[int(request.match_info["chat_id"])])
+
+    async def bot_stats(request: web.Request) -> web.Response:
+        return web.json_response(stats)
+
+    app = web.Application(client_max_size=4 * 1024 ** 3)
+    app.router.add_post("/bot{token}/{method}", method)
+    app.router.add_get("/_bench/chat/{chat_id}", chat_state)
+    app.router.add_get("/_bench/stats", bot_stats)
+    return app
+
+
+async def serve(config: Config) -> None:
+    """Run all fake services until cancelled"""
+    runners = []
+    for app, port in (
+        (media_app(config), config.media_port),
+        (cobalt_app(config), config.cobalt_port),
+        (bot_app(config), config.bot_port),
+    ):
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, config.host, port).start()
+        runners.append(runner)
+    try:
+        await asyncio.Event().wait()
+    finally:
+        for runner in runners:
+            await runner.cleanup()
+
+
+def serve_forever(config: Config) -> None:
+    """Process entry point"""
+    try:
+        asyncio.run(serve(config))
+    except KeyboardInterrupt:
+        pass
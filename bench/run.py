@@ -0,0 +1,382 @@
+"""Offline benchmark: drives the real bot handlers against local fake services.
+
+    python bench/run.py --users 20 --jobs 5 --scenario mix --output run.json
+    python bench/run.py --baseline run.json
+
+Each simulated user sends a link through dp.feed_update (video_handler),
+waits for the preview and presses its first download button
+(quality_callback_handler / cobalt_callback_handler). A job's latency is
+measured from sending the link until the callback handler returns.
+
+The fake Bot API, Cobalt API and media server run in a separate process so
+the reported peak RSS belongs to the bot. Bot settings (MAX_ACTIVE_DOWNLOADS,
+YTDLP_EXECUTION_MODE, ...) are taken from the environment as usual.
+"""
+
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import resource
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Any
+
+import aiohttp
+
+BENCH_DIR = Path(__file__).resolve().parent
+REPO_DIR = BENCH_DIR.parent
+# bench/ on sys.path makes yt-dlp pick up the stub extractor in yt_dlp_plugins/
+sys.path[:0] = [str(BENCH_DIR), str(REPO_DIR)]
+
+from fakes import Config, serve_forever  # noqa: E402
+
+SCENARIOS = ("youtube", "tunnel", "redirect", "picker", "error")
+
+# Bot settings the results depend on, recorded with every run
+RECORDED_SETTINGS = (
+    "MAX_ACTIVE_DOWNLOADS", "YTDLP_EXECUTION_MODE", "YTDLP_PROCESS_WORKERS", "DOWNLOAD_SEGMENTS",
+    "DOWNLOAD_CACHE_MAX_BYTES", "HTTP_POOL_LIMIT_PER_HOST", "PREFETCH",
+)
+
+
+def percentile(values: list[float], share: float) -> float | None:
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(share * (len(ordered) - 1))))]
+
+
+def configure_bot_env(config: Config, workdir: Path, disk_cache: bool) -> None:
+    """Point the bot at the fakes; explicit environment settings win"""
+    defaults = {
+        "BOT_TOKEN": "123456:bench",
+        "BOT_API_SERVER": config.bot_url,
+        "COBALT_API_URL": config.cobalt_url,
+        "COBALT_API_KEY": "bench",
+        "COBALT_SESSION_PATH": str(workdir / "cobalt_sessions.json"),
+        "FILE_ID_CACHE_PATH": "",
+        "CALLBACK_STORE": "memory",
+        "JOB_JOURNAL_PATH": str(workdir / "jobs.db"),
+        "DOWNLOAD_CACHE_DIR": str(workdir / "downloads"),
+        "DOWNLOAD_CACHE_MAX_BYTES": str(10 * 1024 ** 3) if disk_cache else "0",
+        "DOWNLOAD_CACHE_MIN_FREE": "0",
+        "METRICS_PORT": "0",
+        "WEBHOOK_URL": "",
+    }
+    for key, value in defaults.items():
+        os.environ.setdefault(key, value)
+    os.environ["BENCH_MEDIA_URL"] = config.media_url
+    os.environ["BENCH_FILE_SIZE"] = str(config.file_size)
+
+
+async def wait_for_fakes(config: Config, timeout: float = 30) -> None:
+    deadline = time.monotonic() + timeout
+    async with aiohttp.ClientSession() as session:
+        while True:
+            try:
+                for url in (config.media_url, config.bot_url):
+                    async with session.get(f"{url}/_bench/stats") as response:
+                        response.raise_for_status()
+                return
+            except aiohttp.ClientError:
+                if time.monotonic() > deadline:
+                    raise RuntimeError("Fake services did not start")
+                await asyncio.sleep(0.1)
+
+
+class LoopLagMonitor:
+    """Measures how late the event loop wakes up from a short sleep"""
+
+    def __init__(self, interval: float = 0.01):
+        self.interval = interval
+        self.samples: list[float] = []
+        self._task: asyncio.Task[None] | None = None
+
+    async def _run(self) -> None:
+        while True:
+            started = time.monotonic()
+            await asyncio.sleep(self.interval)
+            self.samples.append(max(0.0, time.monotonic() - started - self.interval))
+
+    def start(self) -> None:
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+
+class Bench:
+    """Simulated users feeding updates into the bot's dispatcher"""
+
+    def __init__(self, bot_module: Any, config: Config, http: aiohttp.ClientSession, think_time: float = 0):
+        self.main = bot_module
+        self.config = config
+        self.http = http
+        self.think_time = think_time
+        self.update_ids = iter(range(1, 1 << 62))
+        self.results: list[dict[str, Any]] = []
+
+    async def chat_state(self, chat_id: int) -> dict[str, Any]:
+        async with self.http.get(f"{self.config.bot_url}/_bench/chat/{chat_id}") as response:
+            return await response.json()
+
+    def user(self, user_id: int) -> dict[str, Any]:
+        return {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"}
+
+    async def feed(self, update: dict[str, Any]) -> None:
+        from aiogram.types import Update
+        update["update_id"] = next(self.update_ids)
+        await self.main.dp.feed_update(self.main.bot, Update.model_validate(update, context={"bot": self.main.bot}))
+
+    async def send_link(self, user_id: int, url: str) -> None:
+        await self.feed({"message": {
+            "message_id": next(self.update_ids),
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": self.user(user_id),
+            "text": url,
+        }})
+
+    async def press(self, user_id: int, data: str) -> None:
+        await self.feed({"callback_query": {
+            "id": str(next(self.update_ids)),
+            "from": self.user(user_id),
+            "chat_instance": str(user_id),
+            "data": data,
+            "message": {
+                "message_id": next(self.update_ids),
+                "date": int(time.time()),
+                "chat": {"id": user_id, "type": "private"},
+                "text": "preview",
+            },
+        }})
+
+    def link(self, scenario: str, job_id: str) -> str:
+        if scenario == "youtube":
+            return f"https://www.youtube.com/watch?v={job_id}"
+        return f"https://bench.test/{scenario}/{job_id}"
+
+    async def job(self, user_id: int, scenario: str, job_id: str) -> None:
+        before = await self.chat_state(user_id)
+        started = time.monotonic()
+        error = None
+        try:
+            await self.send_link(user_id, self.link(scenario, job_id))
+            if scenario in ("youtube", "tunnel", "redirect"):
+                state = await self.chat_state(user_id)
+                if state["buttons"]:
+                    await asyncio.sleep(self.think_time)
+                    await self.press(user_id, state["buttons"][0])
+                else:
+                    error = "no preview buttons"
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+        latency = time.monotonic() - started
+        after = await self.chat_state(user_id)
+        delivered = after["media"] > before["media"]
+        expected_error = scenario == "error" and after["errors"] > before["errors"]
+        self.results.append({
+            "scenario": scenario,
+            "latency": latency,
+            "ok": error is None and (delivered or expected_error),
+            "error": error,
+        })
+
+    async def user_session(self, user_id: int, scenarios: list[str], jobs: int, same_url: bool) -> None:
+        for n in range(jobs):
+            scenario = scenarios[(user_id + n) % len(scenarios)]
+            job_id = f"shared{n}" if same_url else f"u{user_id}j{n}"
+            await self.job(user_id, scenario, job_id)
+
+
+def summarize(results: list[dict[str, Any]], wall: float) -> dict[str, Any]:
+    def latency_stats(items: list[dict[str, Any]]) -> dict[str, Any]:
+        latencies = [item["latency"] for item in items]
+        return {
+            "jobs": len(items),
+            "ok": sum(item["ok"] for item in items),
+            "p50": percentile(latencies, 0.50),
+            "p95": percentile(latencies, 0.95),
+            "p99": percentile(latencies, 0.99),
+            "mean": statistics.fmean(latencies) if latencies else None,
+        }
+
+    summary = latency_stats(results)
+    summary["jobs_per_s"] = len(results) / wall if wall else None
+    summary["by_scenario"] = {
+        scenario: latency_stats([item for item in results if item["scenario"] == scenario])
+        for scenario in sorted({item["scenario"] for item in results})
+    }
+    summary["errors"] = sorted({item["error"] for item in results if item["error"]})[:20]
+    return summary
+
+
+async def run(args: argparse.Namespace, config: Config) -> dict[str, Any]:
+    await wait_for_fakes(config)
+    import main  # Imported late so the environment is in place
+
+    scenarios = list(SCENARIOS) if args.scenario == "mix" else [args.scenario]
+    main.get_http_session()
+    await asyncio.get_running_loop().run_in_executor(main.file_io_executor, main.download_cache.sweep)
+    lag = LoopLagMonitor()
+    try:
+        async with aiohttp.ClientSession() as http:
+            bench = Bench(main, config, http, args.think_time)
+            if args.warmup:
+                await bench.user_session(0, scenarios, 1, False)
+                bench.results.clear()
+
+            lag.start()
+            started = time.monotonic()
+            await asyncio.gather(*(
+                bench.user_session(user_id, scenarios, args.jobs, args.same_url)
+                for user_id in range(1, args.users + 1)
+            ))
+            wall = time.monotonic() - started
+            await lag.stop()
+
+            async with http.get(f"{config.bot_url}/_bench/stats") as response:
+                bot_stats = await response.json()
+            async with http.get(f"{config.media_url}/_bench/stats") as response:
+                media_stats = await response.json()
+    finally:
+        await main.close_http_session()
+        main.ytdlp_runner.shutdown()
+        main.ytdlp_pool.close()
+        await main.bot.session.close()
+
+    summary = summarize(bench.results, wall)
+    return {
+        "config": {
+            "users": args.users,
+            "jobs_per_user": args.jobs,
+            "scenario": args.scenario,
+            "same_url": args.same_url,
+            "file_size": config.file_size,
+            "bandwidth": config.bandwidth,
+            "ranges": config.ranges,
+            "upload_bandwidth": config.upload_bandwidth,
+            "cobalt_latency": config.cobalt_latency,
+            "think_time": args.think_time,
+            "settings": {key: os.environ[key] for key in RECORDED_SETTINGS if key in os.environ},
+        },
+        "wall_s": wall,
+        "throughput": {
+            **{key: summary.pop(key) for key in ("jobs_per_s",)},
+            "media_bytes_per_s": media_stats["bytes"] / wall if wall else None,
+            "upload_bytes_per_s": bot_stats["upload_bytes"] / wall if wall else None,
+        },
+        "latency_s": summary,
+        "loop_lag_ms": {
+            "p50": (percentile(lag.samples, 0.50) or 0) * 1000,
+            "p99": (percentile(lag.samples, 0.99) or 0) * 1000,
+            "max": max(lag.samples, default=0) * 1000,
+        },
+        # ru_maxrss is in kilobytes on Linux
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "bot_api_calls": bot_stats["methods"],
+    }
+
+
+def compare(result: dict[str, Any], baseline: dict[str, Any], tolerance: float) -> list[str]:
+    """Regressions of result against baseline beyond tolerance (a share, 0.2 = 20 %)"""
+    checks = [
+        ("jobs/s", result["throughput"]["jobs_per_s"], baseline["throughput"]["jobs_per_s"], True),
+        ("p50 latency", result["latency_s"]["p50"], baseline["latency_s"]["p50"], False),
+        ("p95 latency", result["latency_s"]["p95"], baseline["latency_s"]["p95"], False),
+        ("p99 latency", result["latency_s"]["p99"], baseline["latency_s"]["p99"], False),
+        ("loop lag p99", result["loop_lag_ms"]["p99"], baseline["loop_lag_ms"]["p99"], False),
+        ("peak RSS", result["peak_rss_mb"], baseline["peak_rss_mb"], False),
+    ]
+    regressions = []
+    for name, value, old, higher_is_better in checks:
+        if not value or not old:
+            continue
+        change = (value - old) / old
+        print(f"{name:>14}: {old:10.3f} -> {value:10.3f} ({change:+.1%})", file=sys.stderr)
+        if (-change if higher_is_better else change) > tolerance:
+            regressions.append(name)
+    return regressions
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=10, help="simulated users running concurrently")
+    parser.add_argument("--jobs", type=int, default=3, help="links each user sends, one after another")
+    parser.add_argument("--scenario", choices=(*SCENARIOS, "mix"), default="mix")
+    parser.add_argument("--same-url", action="store_true", help="all users request the same links")
+    parser.add_argument("--file-size", type=int, default=8 * 1024 * 1024, help="media file size, bytes")
+    parser.add_argument("--bandwidth", type=int, default=8 * 1024 * 1024, help="per-connection media speed, bytes/s")
+    parser.add_argument("--no-ranges", action="store_true", help="media server ignores Range requests")
+    parser.add_argument("--upload-bandwidth", type=int, default=0, help="fake Bot API upload speed, bytes/s")
+    parser.add_argument("--cobalt-latency", type=float, default=0.05, help="fake Cobalt API response time, s")
+    parser.add_argument("--think-time", type=float, default=0, help="seconds a user looks at the preview before pressing")
+    parser.add_argument("--disk-cache", action="store_true", help="keep the bot's download cache enabled")
+    parser.add_argument("--no-warmup", dest="warmup", action="store_false", help="skip the untimed first job")
+    parser.add_argument("--port-base", type=int, default=18701)
+    parser.add_argument("--output", help="write the JSON result to this file instead of stdout")
+    parser.add_argument("--baseline", help="JSON result of an earlier run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed regression vs baseline")
+    args = parser.parse_args()
+    # The bot runs in a scratch directory, keep the user's paths working
+    for name in ("output", "baseline"):
+        if getattr(args, name):
+            setattr(args, name, os.path.abspath(getattr(args, name)))
+
+    config = Config(
+        media_port=args.port_base,
+        cobalt_port=args.port_base + 1,
+        bot_port=args.port_base + 2,
+        file_size=args.file_size,
+        bandwidth=args.bandwidth,
+        ranges=not args.no_ranges,
+        cobalt_latency=args.cobalt_latency,
+        upload_bandwidth=args.upload_bandwidth,
+    )
+    fakes = multiprocessing.get_context("spawn").Process(target=serve_forever, args=(config,), daemon=True)
+    fakes.start()
+    workdir = tempfile.TemporaryDirectory(prefix="zavantazhuvator-bench-")
+    try:
+        os.chdir(workdir.name)
+        configure_bot_env(config, Path(workdir.name), args.disk_cache)
+        result = asyncio.run(run(args, config))
+    finally:
+        fakes.terminate()
+        fakes.join()
+        os.chdir(REPO_DIR)
+        workdir.cleanup()
+
+    output = json.dumps(result, indent=2)
+    if args.output:
+        Path(args.output).write_text(output)
+    else:
+        print(output)
+
+    latency = result["latency_s"]
+    print(
+        f"{latency['ok']}/{latency['jobs']} jobs ok, {result['throughput']['jobs_per_s']:.2f} jobs/s, "
+        f"p50 {latency['p50']:.2f}s p95 {latency['p95']:.2f}s p99 {latency['p99']:.2f}s, "
+        f"loop lag p99 {result['loop_lag_ms']['p99']:.1f}ms, peak RSS {result['peak_rss_mb']:.0f} MB",
+        file=sys.stderr,
+    )
+
+    if args.baseline:
+        regressions = compare(result, json.loads(Path(args.baseline).read_text()), args.tolerance)
+        if regressions:
+            print(f"Regressions beyond {args.tolerance:.0%}: {', '.join(regressions)}", file=sys.stderr)
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
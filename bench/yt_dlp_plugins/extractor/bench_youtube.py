@@ -0,0 +1,54 @@
+"""yt-dlp plugin that answers YouTube watch URLs with files from the bench media server.
+
+Loaded only when bench/ is on sys.path (bench/run.py puts it there), and
+takes precedence over the real YouTube extractor.
+"""
+
+import os
+
+from yt_dlp.extractor.common import InfoExtractor
+
+
+class BenchYoutubeIE(InfoExtractor):
+    IE_NAME = "bench:youtube"
+    _VALID_URL = r"https?://(?:www\.|m\.)?youtube\.com/watch\?v=(?P<id>[\w-]+)"
+
+    # height -> share of BENCH_FILE_SIZE
+    _FORMATS = {360: 0.4, 480: 0.7, 720: 1.0}
+
+    def _real_extract(self, url):
+        video_id = self._match_id(url)
+        media_url = os.environ["BENCH_MEDIA_URL"]
+        size = int(os.environ.get("BENCH_FILE_SIZE", str(8 * 1024 * 1024)))
+
+        formats = [
+            {
+                "format_id": f"{height}p",
+                "url": f"{media_url}/media/{video_id}-{height}.mp4?size={int(size * share)}",
+                "ext": "mp4",
+                "height": height,
+                "width": height * 16 // 9,
+                "vcodec": "avc1",
+                "acodec": "mp4a",
+                "filesize": int(size * share),
+            }
+            for height, share in self._FORMATS.items()
+        ]
+        formats.append({
+            "format_id": "audio",
+            "url": f"{media_url}/media/{video_id}.m4a?size={size // 8}",
+            "ext": "m4a",
+            "vcodec": "none",
+            "acodec": "mp4a",
+            "filesize": size // 8,
+        })
+
+        return {
+            "id": video_id,
+            "title": f"Bench video {video_id}",
+            "uploader": "bench",
+            "duration": 60,
+            "view_count": 1000,
+            "thumbnail": f"{media_url}/media/{video_id}.jpg?size=20000",
+            "formats": formats,
+        }
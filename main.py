@@ -1,18 +1,47 @@
+import time
+
+# Cold start is measured from here, imports of aiogram and friends dominate it
+IMPORT_STARTED = time.perf_counter()
+
 import asyncio
+import contextlib
+import contextvars
+import functools
+import hashlib
+import json
 import logging
+import multiprocessing
 import os
+import random
+import secrets
+import shutil
+import sqlite3
+import sys
+import threading
 import aiohttp
-import yt_dlp
+from aiohttp import web
+from collections import OrderedDict, deque
+from itertools import count
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from pathlib import Path
-from typing import Any
+from typing import Any, AsyncIterator, Awaitable, Callable, Collection, Coroutine, Iterator
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
 
 from aiogram import Bot, Dispatcher, types
 from aiogram.filters.command import Command
 from aiogram import F
-from aiogram.types import FSInputFile, URLInputFile, InlineKeyboardMarkup, InlineKeyboardButton
+from aiogram.types import (
+    BufferedInputFile, FSInputFile, URLInputFile, InlineKeyboardMarkup, InlineKeyboardButton,
+    InputMediaPhoto, InputMediaVideo
+)
+from aiogram.exceptions import TelegramAPIError, TelegramBadRequest, TelegramRetryAfter
 from aiogram.filters.callback_data import CallbackData
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
 from dotenv import load_dotenv
 
+import ytdlp_worker
+from ytdlp_worker import YTDLP_BASE_OPTIONS, YoutubeDLPool, load_yt_dlp
+
 # Enable logging
 logging.basicConfig(level=logging.INFO)
 
@@ -44,52 +73,917 @@ else:
 
 dp = Dispatcher()
 
+# Webhook mode: set WEBHOOK_URL (public base URL, plain http is fine with a local Bot API server)
+# to receive updates on an embedded web server instead of long polling
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "").rstrip("/")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+# Checked against X-Telegram-Bot-Api-Secret-Token. Every instance behind the webhook needs the
+# same value: each start registers it with Telegram, so a random one would lock out the others
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+if WEBHOOK_URL and not WEBHOOK_SECRET:
+    raise RuntimeError("WEBHOOK_SECRET environment variable is not set (required with WEBHOOK_URL)")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))
+
+# Prometheus metrics endpoint, METRICS_PORT=0 disables it
+METRICS_HOST = os.getenv("METRICS_HOST", "0.0.0.0")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+SPEED_BUCKETS = tuple(1024 * kb for kb in (100, 250, 500, 1000, 2500, 5000, 10000, 25000, 50000, 100000))
+
+def format_labels(labels: tuple[tuple[str, str], ...]) -> str:
+    if not labels:
+        return ""
+    escape = lambda v: v.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    return "{" + ",".join(f'{name}="{escape(value)}"' for name, value in labels) + "}"
+
+class Counter:
+    """Monotonic counter with labels"""
+
+    kind = "counter"
+
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self._values: dict[tuple[tuple[str, str], ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        key = tuple(sorted(labels.items()))
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self) -> list[str]:
+        return [f"{self.name}{format_labels(key)} {value}" for key, value in self._values.items()]
+
+class Histogram:
+    """Cumulative histogram with labels"""
+
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, buckets: tuple[float, ...]):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        # labels -> [count per bucket..., +Inf count, sum]
+        self._values: dict[tuple[tuple[str, str], ...], list[float]] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = tuple(sorted(labels.items()))
+        counts = self._values.setdefault(key, [0] * (len(self.buckets) + 2))
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[i] += 1
+        counts[-2] += 1
+        counts[-1] += value
+
+    def samples(self) -> list[str]:
+        lines = []
+        for key, counts in self._values.items():
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                le = "+Inf" if bound == float("inf") else f"{bound:g}"
+                lines.append(f"{self.name}_bucket{format_labels(key + (('le', le),))} {bucket_count}")
+            lines.append(f"{self.name}_sum{format_labels(key)} {counts[-1]}")
+            lines.append(f"{self.name}_count{format_labels(key)} {counts[-2]}")
+        return lines
+
+class Gauge:
+    """Value read from the application when metrics are scraped"""
+
+    kind = "gauge"
+
+    def __init__(self, name: str, help: str, read: Callable[[], float]):
+        self.name = name
+        self.help = help
+        self.read = read
+
+    def samples(self) -> list[str]:
+        return [f"{self.name} {self.read()}"]
+
+class MetricsRegistry:
+    """Collects metrics and renders them in the Prometheus text format"""
+
+    def __init__(self):
+        self.metrics: list[Counter | Histogram | Gauge] = []
+
+    def add(self, metric: Any) -> Any:
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            try:
+                samples = metric.samples()
+            except Exception as e:
+                logging.debug(f"Metric {metric.name} failed: {e}")
+                continue
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(samples)
+        return "\n".join(lines) + "\n"
+
+metrics = MetricsRegistry()
+stage_seconds = metrics.add(Histogram(
+    "zavantazhuvator_stage_duration_seconds", "Time spent in each job stage", LATENCY_BUCKETS
+))
+job_seconds = metrics.add(Histogram(
+    "zavantazhuvator_job_duration_seconds", "Total time of download requests", LATENCY_BUCKETS
+))
+jobs_total = metrics.add(Counter("zavantazhuvator_jobs_total", "Download requests by source and outcome"))
+downloaded_bytes = metrics.add(Counter("zavantazhuvator_downloaded_bytes_total", "Bytes downloaded by source"))
+download_speed = metrics.add(Histogram(
+    "zavantazhuvator_download_speed_bytes_per_second", "Download throughput per file", SPEED_BUCKETS
+))
+cache_lookups = metrics.add(Counter("zavantazhuvator_cache_lookups_total", "Cache lookups by cache and result"))
+cobalt_errors = metrics.add(Counter("zavantazhuvator_cobalt_errors_total", "Cobalt error responses by code"))
+telegram_seconds = metrics.add(Histogram(
+    "zavantazhuvator_telegram_request_duration_seconds", "Bot API request time by method", LATENCY_BUCKETS
+))
+telegram_retry_after = metrics.add(Counter(
+    "zavantazhuvator_telegram_retry_after_total", "Bot API flood control (429) responses by method"
+))
+
+metrics.add(Gauge("zavantazhuvator_queued_downloads", "Downloads waiting for a slot", lambda: download_scheduler.queued))
+metrics.add(Gauge("zavantazhuvator_active_downloads", "Downloads holding a slot", lambda: download_scheduler.active))
+metrics.add(Gauge("zavantazhuvator_inflight_jobs", "Distinct files being fetched", lambda: len(inflight_jobs)))
+metrics.add(Gauge("zavantazhuvator_download_cache_bytes", "Bytes kept in the download cache", lambda: download_cache.used))
+
+class JobMetrics:
+    """Stage timings and byte counts of one download request"""
+
+    def __init__(self, source: str, variant: str, user_id: int):
+        self.source = source
+        self.variant = variant
+        self.user_id = user_id
+        self.outcome = "failed"
+        self.started = time.monotonic()
+        self.stages: dict[str, float] = {}
+        self.bytes = 0
+        self.download_seconds = 0.0
+
+    def add_stage(self, stage: str, seconds: float) -> None:
+        self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    def finish(self) -> None:
+        total = time.monotonic() - self.started
+        job_seconds.observe(total, source=self.source)
+        jobs_total.inc(source=self.source, outcome=self.outcome)
+        record = {
+            "source": self.source,
+            "variant": self.variant,
+            "user_id": self.user_id,
+            "outcome": self.outcome,
+            "total_ms": round(total * 1000),
+            "stages_ms": {stage: round(seconds * 1000) for stage, seconds in self.stages.items()},
+            "bytes": self.bytes,
+            "bytes_per_s": round(self.bytes / self.download_seconds) if self.download_seconds else None,
+        }
+        logging.info(f"job {json.dumps(record)}")
+
+# Job of the handler currently running, followed into tasks it starts
+current_job: contextvars.ContextVar[JobMetrics | None] = contextvars.ContextVar("current_job", default=None)
+
+# Journal row of the job being run, see JobJournal
+current_journal_job: contextvars.ContextVar[int | None] = contextvars.ContextVar("current_journal_job", default=None)
+
+@contextlib.contextmanager
+def track_stage(stage: str) -> Iterator[None]:
+    """Time a stage for the stage histogram and the current job"""
+    journal_id = current_journal_job.get()
+    if journal_id is not None and job_journal is not None:
+        job_journal.update(journal_id, stage=stage)
+    started = time.monotonic()
+    try:
+        yield
+    finally:
+        elapsed = time.monotonic() - started
+        stage_seconds.observe(elapsed, stage=stage)
+        job = current_job.get()
+        if job is not None:
+            job.add_stage(stage, elapsed)
+
+def record_download(source: str, size: int, seconds: float) -> None:
+    downloaded_bytes.inc(size, source=source)
+    if seconds > 0:
+        download_speed.observe(size / seconds)
+    job = current_job.get()
+    if job is not None:
+        job.bytes += size
+        job.download_seconds += seconds
+
+def mark_job(outcome: str) -> None:
+    """Set the outcome reported for the current job"""
+    job = current_job.get()
+    if job is not None:
+        job.outcome = outcome
+
+def tracked_job(source: str, variant: Callable[[Any], str]) -> Callable[[Any], Any]:
+    """Decorator for download callback handlers: one JobMetrics per button press"""
+    def decorator(handler: Callable[..., Awaitable[Any]]) -> Callable[..., Awaitable[Any]]:
+        @functools.wraps(handler)
+        async def wrapper(callback: types.CallbackQuery, callback_data: Any) -> Any:
+            job = JobMetrics(source, variant(callback_data), callback.from_user.id)
+            token = current_job.set(job)
+            try:
+                return await handler(callback, callback_data)
+            except BaseException:
+                job.outcome = "error"
+                raise
+            finally:
+                current_job.reset(token)
+                job.finish()
+        return wrapper
+    return decorator
+
+async def telegram_metrics_middleware(make_request: Any, bot: Bot, method: Any) -> Any:
+    """Bot API session middleware: request latency and flood control responses"""
+    started = time.monotonic()
+    name = getattr(method, "__api_method__", type(method).__name__)
+    try:
+        return await make_request(bot, method)
+    except TelegramRetryAfter:
+        telegram_retry_after.inc(method=name)
+        raise
+    finally:
+        telegram_seconds.observe(time.monotonic() - started, method=name)
+
+bot.session.middleware(telegram_metrics_middleware)
+
+class StartupReport:
+    """Cold start timings in seconds since IMPORT_STARTED, logged once the first update is handled"""
+
+    def __init__(self, started: float):
+        self.started = started
+        self.phases: dict[str, float] = {}
+
+    def mark(self, phase: str) -> None:
+        if phase in self.phases:
+            return
+        self.phases[phase] = time.perf_counter() - self.started
+        if phase == "first_update":
+            logging.info(f"startup {json.dumps({name: round(value, 3) for name, value in self.phases.items()})}")
+
+startup_report = StartupReport(IMPORT_STARTED)
+for phase in ("import", "ready", "first_update"):
+    metrics.add(Gauge(
+        f"zavantazhuvator_startup_{phase}_seconds", f"Seconds from process start to {phase.replace('_', ' ')}",
+        lambda phase=phase: startup_report.phases.get(phase, 0.0)
+    ))
+
+@dp.update.outer_middleware()
+async def first_update_middleware(handler: Callable[..., Awaitable[Any]], event: Any, data: dict[str, Any]) -> Any:
+    if "first_update" in startup_report.phases:
+        return await handler(event, data)
+    try:
+        return await handler(event, data)
+    finally:
+        startup_report.mark("first_update")
+
+async def handle_metrics(request: web.Request) -> web.Response:
+    return web.Response(text=metrics.render(), content_type="text/plain", charset="utf-8")
+
+async def start_metrics_server() -> web.AppRunner | None:
+    """Serve /metrics on METRICS_PORT if enabled"""
+    if not METRICS_PORT:
+        return None
+    app = web.Application()
+    app.router.add_get("/metrics", handle_metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, METRICS_HOST, METRICS_PORT).start()
+    logging.info(f"Metrics on http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+    return runner
+
 # Cobalt API configuration
 COBALT_API_URL = os.getenv("COBALT_API_URL", "https://co.wuk.sh")
 COBALT_API_KEY = os.getenv("COBALT_API_KEY")  # Optional API key for authentication
 
+# Optional pool of Cobalt instances: "https://a.example|API_KEY,https://b.example"
+# (instances without a key use JWT sessions). Defaults to COBALT_API_URL alone.
+COBALT_INSTANCES = os.getenv("COBALT_INSTANCES", "")
+COBALT_HEALTH_INTERVAL = float(os.getenv("COBALT_HEALTH_INTERVAL", "60"))
+COBALT_FAILURE_THRESHOLD = int(os.getenv("COBALT_FAILURE_THRESHOLD", "3"))
+COBALT_CIRCUIT_COOLDOWN = float(os.getenv("COBALT_CIRCUIT_COOLDOWN", "60"))
+COBALT_MAX_ATTEMPTS = int(os.getenv("COBALT_MAX_ATTEMPTS", "3"))
+
+# Telegram user IDs allowed to use service commands such as /cobalt_status
+ADMIN_IDS = {int(user_id) for user_id in os.getenv("ADMIN_IDS", "").replace(" ", "").split(",") if user_id}
+
 # File size limits
 MAX_FILE_SIZE = 2 * 1024 * 1024 * 1024 if bot_api_server else 50 * 1024 * 1024  # 2 GB or 50 MB
 
-# Cache for JWT tokens
-jwt_token_cache: dict[str, Any] = {}
+# JWT sessions for Cobalt instances, kept on disk so restarts reuse them
+COBALT_SESSION_PATH = os.getenv("COBALT_SESSION_PATH", "cobalt_sessions.json")
+COBALT_SESSION_REFRESH_AHEAD = float(os.getenv("COBALT_SESSION_REFRESH_AHEAD", "60"))
+COBALT_SESSION_BACKOFF_MAX = float(os.getenv("COBALT_SESSION_BACKOFF_MAX", "300"))
 
-# Temporary storage for video URLs (to avoid callback_data size limits)
-video_url_storage: dict[str, str] = {}
+# Shared HTTP connection pool for Cobalt API and file downloads
+HTTP_POOL_LIMIT = int(os.getenv("HTTP_POOL_LIMIT", "100"))
+HTTP_POOL_LIMIT_PER_HOST = int(os.getenv("HTTP_POOL_LIMIT_PER_HOST", "20"))
+HTTP_KEEPALIVE_TIMEOUT = float(os.getenv("HTTP_KEEPALIVE_TIMEOUT", "30"))
+HTTP_DNS_CACHE_TTL = int(os.getenv("HTTP_DNS_CACHE_TTL", "300"))
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "10"))
+HTTP_READ_TIMEOUT = float(os.getenv("HTTP_READ_TIMEOUT", "60"))
 
-async def get_jwt_token(api_url: str) -> str | None:
-    """Get JWT token from Cobalt API if required"""
-    # Check if we have a cached valid token
-    if api_url in jwt_token_cache:
-        cached = jwt_token_cache[api_url]
-        # Simple expiry check (tokens usually last 2 hours)
-        if cached.get("expires_at", 0) > asyncio.get_event_loop().time():
-            return cached.get("token")
-    
-    # Try to get a new token without turnstile (some instances allow this)
-    try:
-        headers = {
-            "Accept": "application/json",
-            "Content-Type": "application/json",
-        }
+http_session: aiohttp.ClientSession | None = None
+
+def get_http_session() -> aiohttp.ClientSession:
+    """Return the application-wide HTTP session, creating it on first use"""
+    global http_session
+    if http_session is None or http_session.closed:
+        connector = aiohttp.TCPConnector(
+            limit=HTTP_POOL_LIMIT,
+            limit_per_host=HTTP_POOL_LIMIT_PER_HOST,
+            keepalive_timeout=HTTP_KEEPALIVE_TIMEOUT,
+            ttl_dns_cache=HTTP_DNS_CACHE_TTL,
+        )
+        # No total timeout: large files may legitimately stream for minutes
+        timeout = aiohttp.ClientTimeout(
+            total=None,
+            connect=HTTP_CONNECT_TIMEOUT,
+            sock_read=HTTP_READ_TIMEOUT,
+        )
+        http_session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+    return http_session
+
+async def close_http_session() -> None:
+    """Close the shared HTTP session on shutdown"""
+    global http_session
+    if http_session is not None and not http_session.closed:
+        await http_session.close()
+    http_session = None
+
+# Storage for video URLs behind inline buttons (to avoid callback_data size limits):
+# "memory" or "sqlite" (survives restarts, can be shared by several bot processes)
+CALLBACK_STORE = os.getenv("CALLBACK_STORE", "memory")
+CALLBACK_STORE_PATH = os.getenv("CALLBACK_STORE_PATH", "callback_state.db")
+CALLBACK_TTL = float(os.getenv("CALLBACK_TTL", str(24 * 3600)))
+CALLBACK_MAX_ENTRIES = int(os.getenv("CALLBACK_MAX_ENTRIES", "100000"))
+CALLBACK_MAX_BYTES = int(os.getenv("CALLBACK_MAX_BYTES", str(32 * 1024 * 1024)))
+
+class ExpiringCache:
+    """Size-bounded LRU mapping whose entries expire after a TTL.
+    
+    With max_bytes set, entries are also evicted to keep the sum of
+    sizeof(key, value) under that cap.
+    """
+
+    def __init__(
+        self,
+        max_entries: int,
+        ttl: float,
+        max_bytes: int | None = None,
+        sizeof: Callable[[Any, Any], int] | None = None
+    ):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof or (lambda key, value: 0)
+        self.bytes = 0
+        self._data: OrderedDict[Any, tuple[float, Any, int]] = OrderedDict()
+
+    def get(self, key: Any, default: Any = None) -> Any:
+        entry = self._data.get(key)
+        if entry is None:
+            return default
+        expires_at, value, _ = entry
+        if expires_at <= time.monotonic():
+            self._remove(key)
+            return default
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key: Any, value: Any, ttl: float | None = None) -> None:
+        if key in self._data:
+            self._remove(key)
+        size = self.sizeof(key, value)
+        self._data[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), value, size)
+        self.bytes += size
+        if len(self._data) > self.max_entries or self._over_bytes():
+            self.purge_expired()
+            while len(self._data) > self.max_entries or self._over_bytes():
+                self._remove(next(iter(self._data)))
+
+    def pop(self, key: Any, default: Any = None) -> Any:
+        entry = self._data.get(key)
+        if entry is None:
+            return default
+        self._remove(key)
+        return default if entry[0] <= time.monotonic() else entry[1]
+
+    def purge_expired(self) -> None:
+        now = time.monotonic()
+        for key in [key for key, (expires_at, _, _) in self._data.items() if expires_at <= now]:
+            self._remove(key)
+
+    def _remove(self, key: Any) -> None:
+        self.bytes -= self._data.pop(key)[2]
+
+    def _over_bytes(self) -> bool:
+        return self.max_bytes is not None and self.bytes > self.max_bytes and len(self._data) > 1
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+# Cobalt API responses, reused between preview and button press
+COBALT_CACHE_TTL = float(os.getenv("COBALT_CACHE_TTL", "300"))
+COBALT_CACHE_MAX_ENTRIES = int(os.getenv("COBALT_CACHE_MAX_ENTRIES", "1000"))
+# Stop reusing a tunnel/redirect URL this long before Cobalt expires it
+COBALT_URL_EXPIRY_MARGIN = 30.0
+
+cobalt_response_cache = ExpiringCache(COBALT_CACHE_MAX_ENTRIES, COBALT_CACHE_TTL)
+
+def cobalt_result_ttl(result: dict[str, Any]) -> float:
+    """How long a Cobalt response may be reused, 0 if it must not be cached"""
+    status = result.get("status")
+    if status not in ("tunnel", "redirect", "picker"):
+        return 0.0
+    
+    # Tunnel URLs carry their expiry as a millisecond timestamp in ?exp=
+    ttl = COBALT_CACHE_TTL
+    media_url = result.get("url")
+    if media_url:
+        exp = dict(parse_qsl(urlsplit(media_url).query)).get("exp")
+        if exp and exp.isdigit():
+            ttl = min(ttl, int(exp) / 1000 - time.time() - COBALT_URL_EXPIRY_MARGIN)
+    return max(ttl, 0.0)
+
+# Extracted yt-dlp info from previews, reused by the download (stream URLs live ~6 hours)
+YTDLP_INFO_TTL = float(os.getenv("YTDLP_INFO_TTL", "1800"))
+YTDLP_INFO_MAX_ENTRIES = int(os.getenv("YTDLP_INFO_MAX_ENTRIES", "200"))
+
+youtube_info_cache = ExpiringCache(YTDLP_INFO_MAX_ENTRIES, YTDLP_INFO_TTL)
+
+class MemoryStateStore:
+    """In-process callback state with LRU + TTL eviction and a memory cap"""
+
+    def __init__(self, max_entries: int, ttl: float, max_bytes: int):
+        # Rough per-entry footprint: both strings plus dict/tuple overhead
+        sizeof = lambda key, value: len(key) + len(value) + 200
+        self._cache = ExpiringCache(max_entries, ttl, max_bytes, sizeof)
+
+    def get(self, key: str) -> str | None:
+        return self._cache.get(key)
+
+    def set(self, key: str, value: str) -> None:
+        self._cache.set(key, value)
+
+    def delete(self, key: str) -> None:
+        self._cache.pop(key)
+
+class SqliteStateStore:
+    """Callback state in SQLite, survives restarts and can be shared between processes"""
+
+    # Drop expired rows every this many writes
+    PURGE_EVERY = 500
+
+    def __init__(self, path: str, ttl: float, max_entries: int):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._writes = 0
+        self._db = sqlite3.connect(path, timeout=10)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS callback_state ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS callback_state_expiry ON callback_state (expires_at)")
+        self._db.commit()
+
+    def get(self, key: str) -> str | None:
+        row = self._db.execute(
+            "SELECT value FROM callback_state WHERE key = ? AND expires_at > ?", (key, time.time())
+        ).fetchone()
+        return row[0] if row else None
+
+    def set(self, key: str, value: str) -> None:
+        self._db.execute(
+            "INSERT OR REPLACE INTO callback_state (key, value, expires_at) VALUES (?, ?, ?)",
+            (key, value, time.time() + self.ttl)
+        )
+        self._writes += 1
+        if self._writes % self.PURGE_EVERY == 0:
+            self._purge()
+        self._db.commit()
+
+    def delete(self, key: str) -> None:
+        self._db.execute("DELETE FROM callback_state WHERE key = ?", (key,))
+        self._db.commit()
+
+    def _purge(self) -> None:
+        self._db.execute("DELETE FROM callback_state WHERE expires_at <= ?", (time.time(),))
+        # Oldest entries go first when over the cap
+        self._db.execute(
+            "DELETE FROM callback_state WHERE key IN (SELECT key FROM callback_state "
+            "ORDER BY expires_at DESC LIMIT -1 OFFSET ?)", (self.max_entries,)
+        )
+
+def create_callback_store() -> MemoryStateStore | SqliteStateStore:
+    """Build the callback state store selected by CALLBACK_STORE"""
+    if CALLBACK_STORE == "sqlite":
+        return SqliteStateStore(CALLBACK_STORE_PATH, CALLBACK_TTL, CALLBACK_MAX_ENTRIES)
+    return MemoryStateStore(CALLBACK_MAX_ENTRIES, CALLBACK_TTL, CALLBACK_MAX_BYTES)
+
+video_url_storage = create_callback_store()
+
+# Persistent Telegram file_id cache (set FILE_ID_CACHE_PATH to empty string to disable)
+FILE_ID_CACHE_PATH = os.getenv("FILE_ID_CACHE_PATH", "file_id_cache.db")
+FILE_ID_CACHE_MAX_ENTRIES = int(os.getenv("FILE_ID_CACHE_MAX_ENTRIES", "50000"))
+
+class FileIdCache:
+    """Persistent map of (canonical URL, quality/action) to an uploaded Telegram file_id"""
+
+    def __init__(self, path: str, max_entries: int):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._db = sqlite3.connect(path)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS file_ids ("
+            "url TEXT NOT NULL, variant TEXT NOT NULL, file_id TEXT NOT NULL, kind TEXT NOT NULL, "
+            "created_at REAL NOT NULL, last_used REAL NOT NULL, PRIMARY KEY (url, variant))"
+        )
+        self._db.commit()
+
+    def get(self, url: str, variant: str) -> tuple[str, str] | None:
+        """Return (file_id, kind) for a previously sent file, if any"""
+        row = self._db.execute(
+            "SELECT file_id, kind FROM file_ids WHERE url = ? AND variant = ?", (url, variant)
+        ).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._db.execute(
+            "UPDATE file_ids SET last_used = ? WHERE url = ? AND variant = ?", (time.time(), url, variant)
+        )
+        self._db.commit()
+        return row[0], row[1]
+
+    def contains(self, url: str, variant: str) -> bool:
+        """Whether a file_id is cached, without counting a lookup or touching last_used"""
+        row = self._db.execute(
+            "SELECT 1 FROM file_ids WHERE url = ? AND variant = ?", (url, variant)
+        ).fetchone()
+        return row is not None
+
+    def put(self, url: str, variant: str, file_id: str, kind: str) -> None:
+        """Remember file_id of a sent file and evict least recently used entries over the cap"""
+        now = time.time()
+        self._db.execute(
+            "INSERT OR REPLACE INTO file_ids (url, variant, file_id, kind, created_at, last_used) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (url, variant, file_id, kind, now, now)
+        )
+        overflow = self._db.execute("SELECT COUNT(*) FROM file_ids").fetchone()[0] - self.max_entries
+        if overflow > 0:
+            self._db.execute(
+                "DELETE FROM file_ids WHERE rowid IN "
+                "(SELECT rowid FROM file_ids ORDER BY last_used ASC LIMIT ?)", (overflow,)
+            )
+        self._db.commit()
+
+    def invalidate(self, url: str, variant: str | None = None) -> None:
+        """Forget cached file_id for one variant or for all variants of a URL"""
+        if variant is None:
+            self._db.execute("DELETE FROM file_ids WHERE url = ?", (url,))
+        else:
+            self._db.execute("DELETE FROM file_ids WHERE url = ? AND variant = ?", (url, variant))
+        self._db.commit()
+
+    def stats(self) -> dict[str, int]:
+        """Hit/miss counters and current number of entries"""
+        entries = self._db.execute("SELECT COUNT(*) FROM file_ids").fetchone()[0]
+        return {"hits": self.hits, "misses": self.misses, "entries": entries}
+
+file_id_cache = FileIdCache(FILE_ID_CACHE_PATH, FILE_ID_CACHE_MAX_ENTRIES) if FILE_ID_CACHE_PATH else None
+
+# Download scheduling: separate thread pools for yt-dlp and a global cap on active jobs
+MAX_ACTIVE_DOWNLOADS = int(os.getenv("MAX_ACTIVE_DOWNLOADS", "4"))
+MAX_QUEUED_DOWNLOADS = int(os.getenv("MAX_QUEUED_DOWNLOADS", "100"))
+YTDLP_METADATA_WORKERS = int(os.getenv("YTDLP_METADATA_WORKERS", "4"))
+YTDLP_DOWNLOAD_WORKERS = int(os.getenv("YTDLP_DOWNLOAD_WORKERS", str(MAX_ACTIVE_DOWNLOADS)))
+
+metadata_executor = ThreadPoolExecutor(max_workers=YTDLP_METADATA_WORKERS, thread_name_prefix="ytdlp-info")
+download_executor = ThreadPoolExecutor(max_workers=YTDLP_DOWNLOAD_WORKERS, thread_name_prefix="ytdlp-download")
+
+# Strong references to fire-and-forget tasks so they are not garbage collected
+background_tasks: set[asyncio.Task[Any]] = set()
+
+def run_in_background(coro: Coroutine[Any, Any, Any]) -> asyncio.Task[Any]:
+    """Start a task without awaiting it"""
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+class QueueFullError(Exception):
+    """Raised when the download queue cannot accept more jobs"""
+
+QUEUE_FULL_TEXT = "🚦 Зараз забагато завантажень. Спробуйте ще раз за хвилину."
+
+class QueuedJob:
+    """Job waiting for a download slot"""
+
+    def __init__(self, user_id: int, status: Any):
+        self.user_id = user_id
+        self.status = status
+        self.position = 0
+        self.future: asyncio.Future[None] = asyncio.get_event_loop().create_future()
+
+class DownloadScheduler:
+    """Hands out a limited number of download slots.
+    
+    Waiting jobs are served round-robin between users so one user with many
+    links cannot starve others; audio jobs are short and go first.
+    Speculative work may borrow idle slots and is cancelled as soon as a
+    real job has to wait.
+    """
+
+    def __init__(self, max_active: int, max_queued: int):
+        self.max_active = max_active
+        self.max_queued = max_queued
+        self.active = 0
+        # priority -> user_id -> that user's waiting jobs, users in round-robin order
+        self._queues: dict[bool, OrderedDict[int, deque[QueuedJob]]] = {True: OrderedDict(), False: OrderedDict()}
+        # Tasks holding a borrowed slot, and those already told to give it back
+        self._spare_holders: set[asyncio.Task[Any]] = set()
+        self._preempted: set[asyncio.Task[Any]] = set()
+
+    @property
+    def queued(self) -> int:
+        return sum(len(jobs) for users in self._queues.values() for jobs in users.values())
+
+    @contextlib.asynccontextmanager
+    async def slot(self, user_id: int, priority: bool = False, status: Any = None) -> AsyncIterator[bool]:
+        """Hold a download slot, yields True if the job had to wait in the queue"""
+        waited = await self._acquire(user_id, priority, status)
+        try:
+            yield waited
+        finally:
+            self._release()
+
+    @contextlib.asynccontextmanager
+    async def spare_slot(self) -> AsyncIterator[bool]:
+        """Borrow an idle slot for speculative work, yields False if none is free.
         
-        async with aiohttp.ClientSession() as session:
-            async with session.post(f"{api_url}/session", headers=headers, json={}) as response:
-                if response.status == 200:
-                    data = await response.json()
-                    token = data.get("token")
-                    exp = data.get("exp", 7200)  # Default 2 hours
-                    
-                    if token:
-                        jwt_token_cache[api_url] = {
-                            "token": token,
-                            "expires_at": asyncio.get_event_loop().time() + exp
-                        }
-                        return token
-    except Exception as e:
-        logging.debug(f"Could not get JWT token: {e}")
+        The holding task is cancelled when a real job has to queue.
+        """
+        task = asyncio.current_task()
+        if task is None or self.queued or self.active >= self.max_active:
+            yield False
+            return
+        self.active += 1
+        self._spare_holders.add(task)
+        try:
+            yield True
+        finally:
+            self._spare_holders.discard(task)
+            self._preempted.discard(task)
+            self._release()
+
+    def adopt(self, task: asyncio.Task[Any]) -> None:
+        """Keep a borrowed slot: the speculative work now serves a user"""
+        self._spare_holders.discard(task)
+
+    def _preempt(self) -> None:
+        """Cancel borrowed slots until every queued job has one coming"""
+        for task in list(self._spare_holders - self._preempted):
+            if self.queued <= len(self._preempted):
+                return
+            self._preempted.add(task)
+            task.cancel()
+
+    async def _acquire(self, user_id: int, priority: bool, status: Any) -> bool:
+        if self.active < self.max_active and self.queued == 0:
+            self.active += 1
+            return False
+        
+        if self.queued >= self.max_queued:
+            raise QueueFullError("Download queue is full")
+        
+        job = QueuedJob(user_id, status)
+        self._queues[priority].setdefault(user_id, deque()).append(job)
+        self._preempt()
+        self._announce_positions()
+        try:
+            await job.future
+        except asyncio.CancelledError:
+            if job.future.done() and not job.future.cancelled():
+                # Slot was granted right before cancellation, hand it on
+                self._release()
+            else:
+                users = self._queues[priority]
+                if job in users.get(user_id, ()):
+                    users[user_id].remove(job)
+                    if not users[user_id]:
+                        del users[user_id]
+                self._announce_positions()
+            raise
+        return True
+
+    def _release(self) -> None:
+        self.active -= 1
+        while self.active < self.max_active:
+            job = self._pop_next()
+            if job is None:
+                break
+            if job.future.done():
+                continue
+            self.active += 1
+            job.future.set_result(None)
+        self._announce_positions()
+
+    def _pop_next(self) -> QueuedJob | None:
+        for priority in (True, False):
+            users = self._queues[priority]
+            if users:
+                user_id, jobs = next(iter(users.items()))
+                job = jobs.popleft()
+                # Move the user to the back of the round-robin order
+                del users[user_id]
+                if jobs:
+                    users[user_id] = jobs
+                return job
+        return None
+
+    def _dispatch_order(self) -> list[QueuedJob]:
+        """Order in which queued jobs will get slots"""
+        order: list[QueuedJob] = []
+        for priority in (True, False):
+            pending = [list(jobs) for jobs in self._queues[priority].values()]
+            depth = max((len(jobs) for jobs in pending), default=0)
+            for round_idx in range(depth):
+                order.extend(jobs[round_idx] for jobs in pending if round_idx < len(jobs))
+        return order
+
+    def _announce_positions(self) -> None:
+        """Tell queued users their current place in line"""
+        for position, job in enumerate(self._dispatch_order(), start=1):
+            if job.position != position and job.status is not None:
+                job.position = position
+                job.status.report(f"⏳ Ви в черзі: {position}\n\nЗавантаження почнеться автоматично.")
+
+download_scheduler = DownloadScheduler(MAX_ACTIVE_DOWNLOADS, MAX_QUEUED_DOWNLOADS)
+
+def with_download_slot(
+    user_id: int,
+    priority: bool,
+    start_text: str,
+    job: Callable[[Any], Awaitable[Any]]
+) -> Callable[[Any], Awaitable[Any]]:
+    """Wrap a download job so it runs only while holding a scheduler slot"""
+    async def scheduled(status: Any) -> Any:
+        started = time.monotonic()
+        async with download_scheduler.slot(user_id, priority, status) as waited:
+            elapsed = time.monotonic() - started
+            stage_seconds.observe(elapsed, stage="queue")
+            job_metrics = current_job.get()
+            if job_metrics is not None:
+                job_metrics.add_stage("queue", elapsed)
+            if waited:
+                await status.edit_text(start_text)
+            return await job(status)
+    return scheduled
+
+class CobaltSessionManager:
+    """JWT tokens for Cobalt instances.
     
-    return None
+    Only one /session request per instance is in flight at a time, tokens are
+    refreshed in the background shortly before they expire, failed requests
+    back off with jitter, and tokens are persisted to a JSON file.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._tokens: dict[str, dict[str, Any]] = self._load()
+        self._inflight: dict[str, asyncio.Task[str | None]] = {}
+        self._refresh: dict[str, asyncio.Task[None]] = {}
+        self._failures: dict[str, int] = {}
+        self._retry_at: dict[str, float] = {}
+
+    def _load(self) -> dict[str, dict[str, Any]]:
+        if not self.path:
+            return {}
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            logging.warning(f"Could not load Cobalt sessions: {e}")
+            return {}
+        return {url: entry for url, entry in data.items() if entry.get("expires_at", 0) > time.time()}
+
+    def _save(self) -> None:
+        if not self.path:
+            return
+        tmp_path = f"{self.path}.tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(self._tokens, f)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            logging.warning(f"Could not save Cobalt sessions: {e}")
+
+    def _valid_token(self, api_url: str) -> str | None:
+        entry = self._tokens.get(api_url)
+        if entry and entry["expires_at"] - 5 > time.time():
+            return entry["token"]
+        return None
+
+    async def get_token(self, api_url: str) -> str | None:
+        """Return a valid token, requesting one if needed (None if the instance gives none)"""
+        token = self._valid_token(api_url)
+        if token:
+            # Tokens loaded from disk have no refresh scheduled yet
+            if api_url not in self._refresh:
+                self._schedule_refresh(api_url)
+            return token
+        
+        if time.time() < self._retry_at.get(api_url, 0):
+            return None
+        return await self._acquire(api_url)
+
+    def invalidate(self, api_url: str) -> None:
+        """Forget a token the instance rejected"""
+        self._tokens.pop(api_url, None)
+        refresh = self._refresh.pop(api_url, None)
+        if refresh is not None:
+            refresh.cancel()
+        self._save()
+
+    async def _acquire(self, api_url: str) -> str | None:
+        """Join the running /session request for this instance or start one"""
+        task = self._inflight.get(api_url)
+        if task is None:
+            task = asyncio.create_task(self._request(api_url))
+            self._inflight[api_url] = task
+            task.add_done_callback(lambda _: self._inflight.pop(api_url, None))
+        return await asyncio.shield(task)
+
+    async def _request(self, api_url: str) -> str | None:
+        # Try to get a new token without turnstile (some instances allow this)
+        try:
+            headers = {
+                "Accept": "application/json",
+                "Content-Type": "application/json",
+            }
+            
+            session = get_http_session()
+            async with session.post(f"{api_url}/session", headers=headers, json={}) as response:
+                if response.status != 200:
+                    raise CobaltInstanceError(f"HTTP {response.status}")
+                data = await response.json()
+            
+            token = data.get("token")
+            if not token:
+                raise CobaltInstanceError("No token in response")
+        except Exception as e:
+            failures = self._failures.get(api_url, 0) + 1
+            self._failures[api_url] = failures
+            backoff = min(COBALT_SESSION_BACKOFF_MAX, 2.0 ** failures) * random.uniform(0.5, 1.5)
+            self._retry_at[api_url] = time.time() + backoff
+            logging.debug(f"Could not get JWT token from {api_url}: {e}, next try in {backoff:.0f}s")
+            return None
+        
+        lifetime = float(data.get("exp", 7200))  # Default 2 hours
+        self._tokens[api_url] = {"token": token, "expires_at": time.time() + lifetime}
+        self._failures.pop(api_url, None)
+        self._retry_at.pop(api_url, None)
+        self._save()
+        self._schedule_refresh(api_url)
+        return token
+
+    def _schedule_refresh(self, api_url: str) -> None:
+        previous = self._refresh.pop(api_url, None)
+        if previous is not None:
+            previous.cancel()
+        # Jitter spreads refreshes of tokens that were issued together
+        expires_at = self._tokens[api_url]["expires_at"]
+        delay = expires_at - time.time() - COBALT_SESSION_REFRESH_AHEAD - random.uniform(0, 10)
+        self._refresh[api_url] = asyncio.create_task(self._refresh_later(api_url, max(delay, 0.0)))
+
+    async def _refresh_later(self, api_url: str, delay: float) -> None:
+        while True:
+            await asyncio.sleep(delay)
+            # A successful request schedules the next refresh itself
+            if await self._acquire(api_url):
+                return
+            if not self._valid_token(api_url):
+                # Token is gone, the next request will ask for one
+                self._refresh.pop(api_url, None)
+                return
+            delay = max(self._retry_at.get(api_url, 0) - time.time(), 1.0)
+
+cobalt_sessions = CobaltSessionManager(COBALT_SESSION_PATH)
+
+async def get_jwt_token(api_url: str) -> str | None:
+    """Get JWT token from Cobalt API if required"""
+    with track_stage("cobalt_jwt"):
+        return await cobalt_sessions.get_token(api_url)
 
 def progress_bar(current: int, total: int, width: int = 20) -> str:
     """Generate a progress bar string"""
@@ -114,6 +1008,322 @@ def is_youtube_url(url: str) -> bool:
     """Check if URL is from YouTube"""
     return "youtube.com" in url or "youtu.be" in url
 
+# Query parameters that only track the sharer and never change the media: utm_* and these
+# on every site, the rest only on the site that adds them ("t" is a timestamp elsewhere, say)
+TRACKING_PARAMS = {"fbclid", "gclid"}
+SITE_TRACKING_PARAMS = {
+    "youtube.com": {"si", "feature", "t"},
+    "youtu.be": {"si", "feature", "t"},
+    "x.com": {"s", "t", "ref_src"},
+    "twitter.com": {"s", "t", "ref_src"},
+    "instagram.com": {"igshid", "igsh"},
+    "tiktok.com": {"is_from_webapp", "sender_device"},
+}
+
+def site_tracking_params(host: str) -> set[str]:
+    """Tracking parameters of the site host belongs to, subdomains included"""
+    for domain, params in SITE_TRACKING_PARAMS.items():
+        if host == domain or host.endswith("." + domain):
+            return params
+    return set()
+
+def canonicalize_url(url: str) -> str:
+    """Normalize URL so that links to the same media share one cache key"""
+    parts = urlsplit(url.strip())
+    host = parts.netloc.lower()
+    for prefix in ("www.", "m.", "music."):
+        if host.startswith(prefix):
+            host = host[len(prefix):]
+    path = parts.path.rstrip("/")
+
+    # Collapse all YouTube URL shapes into watch?v=<id>
+    if host in ("youtube.com", "youtu.be"):
+        query = dict(parse_qsl(parts.query))
+        video = query.get("v")
+        if host == "youtu.be":
+            video = path.lstrip("/")
+        elif path.startswith(("/shorts/", "/embed/", "/live/")):
+            video = path.split("/")[2]
+        if video:
+            return f"https://youtube.com/watch?v={video}"
+
+    site_params = site_tracking_params(host)
+    query_items = sorted(
+        (key, value) for key, value in parse_qsl(parts.query)
+        if key not in TRACKING_PARAMS and key not in site_params and not key.startswith("utm_")
+    )
+    return urlunsplit(("https", host, path, urlencode(query_items), ""))
+
+def sent_media(sent: types.Message) -> tuple[str, str] | None:
+    """Return (file_id, kind) of the media in a sent message"""
+    # Telegram may store a video as document or animation, keep the actual kind
+    for kind in ("video", "audio", "document", "animation"):
+        media = getattr(sent, kind, None)
+        if media is not None:
+            return media.file_id, kind
+    return None
+
+async def send_by_file_id(chat_id: int, file_id: str, kind: str) -> types.Message:
+    """Send already uploaded media by its file_id"""
+    if kind == "audio":
+        return await bot.send_audio(chat_id, audio=file_id)
+    if kind == "document":
+        return await bot.send_document(chat_id, document=file_id)
+    if kind == "animation":
+        return await bot.send_animation(chat_id, animation=file_id)
+    return await bot.send_video(chat_id, video=file_id)
+
+async def send_cached_file(chat_id: int, url: str, variant: str) -> bool:
+    """Re-send a previously uploaded file by its file_id, returns False on cache miss"""
+    if file_id_cache is None:
+        return False
+    
+    cache_key = canonicalize_url(url)
+    cached = file_id_cache.get(cache_key, variant)
+    cache_lookups.inc(cache="file_id", result="hit" if cached else "miss")
+    if not cached:
+        return False
+    
+    file_id, kind = cached
+    try:
+        await send_by_file_id(chat_id, file_id, kind)
+    except Exception as e:
+        # file_id is no longer usable, drop it and download again
+        logging.warning(f"Cached file_id failed for {cache_key} ({variant}): {e}")
+        file_id_cache.invalidate(cache_key, variant)
+        return False
+    
+    logging.info(f"file_id cache hit for {cache_key} ({variant}): {file_id_cache.stats()}")
+    mark_job("file_id_cache")
+    return True
+
+def remember_file_id(url: str, variant: str, sent: types.Message) -> None:
+    """Store file_id of a freshly uploaded file for later re-sends"""
+    if file_id_cache is None:
+        return
+    
+    media = sent_media(sent)
+    if media is not None:
+        file_id_cache.put(canonicalize_url(url), variant, *media)
+
+# Budgets for cosmetic progress edits (Telegram throttles bots that edit too often)
+PROGRESS_EDITS_PER_SECOND = float(os.getenv("PROGRESS_EDITS_PER_SECOND", "20"))
+PROGRESS_CHAT_INTERVAL = float(os.getenv("PROGRESS_CHAT_INTERVAL", "3"))
+# Share of the edit budget left for progress while files are being uploaded
+PROGRESS_UPLOAD_SHARE = float(os.getenv("PROGRESS_UPLOAD_SHARE", "0.25"))
+
+class ProgressReporter:
+    """Single place through which status messages are edited.
+    
+    Progress updates are coalesced per message (only the newest text is
+    sent), unchanged text is skipped, and edits are paced by a global and a
+    per-chat budget. A 429 pauses progress edits for retry_after seconds, and
+    running uploads shrink the progress budget so they are not delayed.
+    """
+
+    def __init__(self, edits_per_second: float, chat_interval: float):
+        self.edits_per_second = edits_per_second
+        self.chat_interval = chat_interval
+        self.active_uploads = 0
+        self.blocked_until = 0.0
+        self._pending: dict[tuple[int, int], tuple[types.Message, str, dict[str, Any]]] = {}
+        self._inflight: dict[tuple[int, int], asyncio.Task[None]] = {}
+        self._last_text = ExpiringCache(10000, 3600)
+        self._chat_last_edit = ExpiringCache(10000, 3600)
+        self._wakeup = asyncio.Event()
+        self._worker: asyncio.Task[None] | None = None
+
+    @staticmethod
+    def _key(message: types.Message) -> tuple[int, int]:
+        return message.chat.id, message.message_id
+
+    def report(self, message: types.Message, text: str, **kwargs: Any) -> None:
+        """Queue a cosmetic progress edit, replacing any older pending text"""
+        key = self._key(message)
+        if self._last_text.get(key) == text:
+            self._pending.pop(key, None)
+            return
+        self._pending[key] = (message, text, kwargs)
+        if self._worker is None or self._worker.done():
+            self._worker = asyncio.create_task(self._run())
+        self._wakeup.set()
+
+    async def edit(self, message: types.Message, text: str, **kwargs: Any) -> None:
+        """Apply a state change edit now, superseding pending progress for that message"""
+        key = self._key(message)
+        self._pending.pop(key, None)
+        # Let a progress edit already on the wire land first so it cannot overwrite this one
+        inflight = self._inflight.get(key)
+        if inflight is not None:
+            await asyncio.wait([inflight])
+        if self._last_text.get(key) == text:
+            return
+        
+        delay = self.blocked_until - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        try:
+            await message.edit_text(text, **kwargs)
+        except TelegramRetryAfter as e:
+            self._block(e.retry_after)
+            await asyncio.sleep(e.retry_after)
+            await message.edit_text(text, **kwargs)
+        self._last_text.set(key, text)
+        self._chat_last_edit.set(message.chat.id, time.monotonic())
+
+    def forget(self, message: types.Message) -> None:
+        """Drop state for a status message that is about to be deleted"""
+        key = self._key(message)
+        self._pending.pop(key, None)
+        self._last_text.pop(key)
+
+    @contextlib.asynccontextmanager
+    async def uploading(self) -> AsyncIterator[None]:
+        """Mark an upload as running so progress edits back off"""
+        self.active_uploads += 1
+        try:
+            yield
+        finally:
+            self.active_uploads -= 1
+
+    def _block(self, retry_after: float) -> None:
+        logging.warning(f"Telegram flood control, pausing progress edits for {retry_after}s")
+        self.blocked_until = max(self.blocked_until, time.monotonic() + retry_after)
+
+    async def _run(self) -> None:
+        while True:
+            if not self._pending:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            
+            now = time.monotonic()
+            if now < self.blocked_until:
+                await asyncio.sleep(self.blocked_until - now)
+                continue
+            
+            # Oldest pending message whose chat budget allows an edit
+            wait = PROGRESS_INTERVAL
+            for key in self._pending:
+                ready_at = self._chat_last_edit.get(key[0], 0.0) + self.chat_interval
+                if ready_at <= now:
+                    break
+                wait = min(wait, ready_at - now)
+            else:
+                await asyncio.sleep(wait)
+                continue
+            
+            message, text, kwargs = self._pending.pop(key)
+            self._chat_last_edit.set(key[0], now)
+            task = run_in_background(self._apply(message, text, kwargs))
+            self._inflight[key] = task
+            task.add_done_callback(lambda done, key=key: self._inflight.pop(key, None) if self._inflight.get(key) is done else None)
+            
+            rate = self.edits_per_second * (PROGRESS_UPLOAD_SHARE if self.active_uploads else 1.0)
+            await asyncio.sleep(1 / max(rate, 0.01))
+
+    async def _apply(self, message: types.Message, text: str, kwargs: dict[str, Any]) -> None:
+        try:
+            await message.edit_text(text, **kwargs)
+            self._last_text.set(self._key(message), text)
+        except TelegramRetryAfter as e:
+            self._block(e.retry_after)
+            # Retry later unless a newer update has been queued meanwhile
+            self._pending.setdefault(self._key(message), (message, text, kwargs))
+        except Exception as e:
+            logging.debug(f"Progress update error: {e}")
+
+progress_reporter = ProgressReporter(PROGRESS_EDITS_PER_SECOND, PROGRESS_CHAT_INTERVAL)
+
+class SharedStatus:
+    """Status message fan-out for every user waiting on the same download job"""
+
+    def __init__(self, message: types.Message | None = None):
+        self.messages = [message] if message is not None else []
+        self.last_text: str | None = None
+        self.last_kwargs: dict[str, Any] = {}
+
+    async def attach(self, message: types.Message) -> None:
+        """Add a waiter's status message and bring it up to date"""
+        self.messages.append(message)
+        if self.last_text is not None:
+            try:
+                await progress_reporter.edit(message, self.last_text, **self.last_kwargs)
+            except Exception as e:
+                logging.debug(f"Status update error: {e}")
+
+    async def edit_text(self, text: str, **kwargs: Any) -> None:
+        """Edit every attached status message right away"""
+        self.last_text = text
+        self.last_kwargs = kwargs
+        results = await asyncio.gather(
+            *(progress_reporter.edit(message, text, **kwargs) for message in list(self.messages)),
+            return_exceptions=True
+        )
+        for result in results:
+            if isinstance(result, Exception):
+                logging.debug(f"Status update error: {result}")
+
+    def report(self, text: str) -> None:
+        """Queue a progress update for every attached status message"""
+        self.last_text = text
+        self.last_kwargs = {}
+        for message in self.messages:
+            progress_reporter.report(message, text)
+
+class InflightJob:
+    """Download/upload job shared by all concurrent requests for the same media"""
+
+    def __init__(self, status: SharedStatus):
+        self.status = status
+        self.future: asyncio.Future[types.Message | None] = asyncio.get_event_loop().create_future()
+
+# Running jobs keyed by (canonical URL, quality/action)
+inflight_jobs: dict[tuple[str, str], InflightJob] = {}
+
+async def run_coalesced(
+    url: str,
+    variant: str,
+    status_message: types.Message,
+    job: Callable[[SharedStatus], Awaitable[types.Message | None]]
+) -> tuple[types.Message | None, bool]:
+    """Run job once per (URL, variant); concurrent callers attach to the running one.
+    
+    Returns the message the job sent (or None if it reported failure itself)
+    and whether this caller was the one that ran the job.
+    """
+    key = (canonicalize_url(url), variant)
+    running = inflight_jobs.get(key)
+    if running is not None:
+        await running.status.attach(status_message)
+        # Shield so a cancelled waiter does not cancel the job for everyone else
+        return await asyncio.shield(running.future), False
+    
+    inflight = InflightJob(SharedStatus(status_message))
+    inflight_jobs[key] = inflight
+    try:
+        result = await job(inflight.status)
+    except asyncio.CancelledError:
+        inflight.future.cancel()
+        raise
+    except Exception as e:
+        inflight.future.set_exception(e)
+        inflight.future.exception()  # Mark as retrieved when nobody else is waiting
+        raise
+    else:
+        inflight.future.set_result(result)
+        return result, True
+    finally:
+        del inflight_jobs[key]
+
+async def deliver_shared_result(chat_id: int, sent: types.Message | None, leader: bool) -> None:
+    """Send the job's media to a waiter that did not upload it itself"""
+    if sent is None or leader:
+        return
+    media = sent_media(sent)
+    if media is not None:
+        await send_by_file_id(chat_id, *media)
+
 class VideoDownload(CallbackData, prefix="video"):
     """Callback data for video download buttons"""
     quality: str
@@ -124,23 +1334,173 @@ class CobaltDownload(CallbackData, prefix="cobalt"):
     action: str  # "download" or "audio"
     video_id: str
 
-async def get_video_info(url: str) -> dict[str, Any] | None:
-    """Get video metadata without downloading"""
+class CancelPreview(CallbackData, prefix="cancel"):
+    """Callback data for the preview cancel button"""
+    video_id: str
+
+# Long-lived YoutubeDL instances: extractors, cookie jars, HTTP handlers and player JS stay warm
+YTDLP_POOL_SIZE = int(os.getenv("YTDLP_POOL_SIZE", str(YTDLP_METADATA_WORKERS + YTDLP_DOWNLOAD_WORKERS)))
+YTDLP_POOL_WARM = int(os.getenv("YTDLP_POOL_WARM", str(YTDLP_METADATA_WORKERS)))
+YTDLP_WORKER_MAX_JOBS = int(os.getenv("YTDLP_WORKER_MAX_JOBS", "50"))
+
+ytdlp_pool = YoutubeDLPool(YTDLP_BASE_OPTIONS, YTDLP_POOL_SIZE, YTDLP_WORKER_MAX_JOBS)
+
+# Where yt-dlp extraction runs: "thread" (shared thread pool) or "process" (worker processes,
+# extraction and signature solving are CPU-bound Python and otherwise share one core).
+# Downloads are I/O-bound and always run on download_executor, so long downloads never
+# hold up previews and no download waits for a worker process to start.
+YTDLP_EXECUTION_MODE = os.getenv("YTDLP_EXECUTION_MODE", "thread")
+YTDLP_PROCESS_WORKERS = int(os.getenv("YTDLP_PROCESS_WORKERS", str(os.cpu_count() or 1)))
+
+@contextlib.contextmanager
+def hidden_main_module() -> Iterator[None]:
+    """Keep worker processes started in this block from re-importing the main script.
+    
+    Spawned processes normally run the parent's __main__ again, which for
+    this bot would create the Bot, open the databases and start executors.
+    Their jobs only need ytdlp_worker.
+    """
+    main_module = sys.modules["__main__"]
+    saved = {name: main_module.__dict__[name] for name in ("__file__", "__spec__") if name in main_module.__dict__}
+    main_module.__dict__.pop("__file__", None)
+    main_module.__spec__ = None
     try:
-        ydl_opts: dict[str, Any] = {
-            'quiet': True,
-            'no_warnings': True,
-            'skip_download': True,
-        }
-        
-        loop = asyncio.get_event_loop()
+        yield
+    finally:
+        main_module.__dict__.update(saved)
+
+class YtdlpRunner:
+    """Runs yt-dlp extraction on the metadata thread pool or in worker processes, downloads on download_executor"""
+
+    def __init__(self, mode: str, process_workers: int):
+        self.mode = mode
+        self.process_workers = process_workers
+        self._job_ids = count(1)
+        # Downloads started on download_executor and those told to stop, guarded by _jobs_lock
+        self._running: set[int] = set()
+        self._cancelled: set[int] = set()
+        self._jobs_lock = threading.Lock()
+        self._processes: ProcessPoolExecutor | None = None
+        self._start_lock = threading.Lock()
+
+    def start_processes(self) -> ProcessPoolExecutor:
+        """Start the worker pool on first use (blocking)"""
+        with self._start_lock:
+            if self._processes is None:
+                # Spawn: forking a process that runs an event loop and threads is unsafe
+                self._processes = ProcessPoolExecutor(
+                    max_workers=self.process_workers,
+                    mp_context=multiprocessing.get_context("spawn"),
+                    initializer=ytdlp_worker.init_process,
+                    initargs=(1, YTDLP_WORKER_MAX_JOBS)
+                )
+                # Workers start on submit; start them all now, while they cannot import this script
+                with hidden_main_module():
+                    for _ in range(self.process_workers):
+                        self._processes.submit(ytdlp_worker.ping)
+                logging.info(f"yt-dlp extraction runs in {self.process_workers} worker processes")
+            return self._processes
+
+    async def _metadata_executor(self) -> ProcessPoolExecutor | ThreadPoolExecutor:
+        if self.mode != "process":
+            return metadata_executor
+        if self._processes is not None:
+            return self._processes
+        return await asyncio.get_running_loop().run_in_executor(metadata_executor, self.start_processes)
+
+    async def warm(self, count: int) -> None:
+        """Build YoutubeDL instances (and worker processes) before the first request"""
+        loop = asyncio.get_running_loop()
+        if self.mode == "process":
+            processes = await self._metadata_executor()
+            await asyncio.gather(*(loop.run_in_executor(processes, ytdlp_worker.ping) for _ in range(count)))
+        # Downloads run in this process either way
+        await loop.run_in_executor(metadata_executor, ytdlp_pool.warm, count)
+
+    async def extract_info(self, url: str) -> dict[str, Any]:
+        executor = await self._metadata_executor()
+        if isinstance(executor, ProcessPoolExecutor):
+            return await asyncio.get_running_loop().run_in_executor(executor, ytdlp_worker.extract_job, url)
+        return await asyncio.get_running_loop().run_in_executor(executor, ytdlp_worker.extract_info, ytdlp_pool, url)
+
+    def _download_job(
+        self,
+        job_id: int,
+        url: str,
+        format_string: str,
+        outtmpl: str,
+        info: dict[str, Any] | None,
+        progress_hook: Callable[[dict[str, Any]], None] | None
+    ) -> Path:
+        """Download (blocking), aborting at the next progress event once the job is cancelled"""
+        yt_dlp = load_yt_dlp()
         
-        def extract_info():
-            with yt_dlp.YoutubeDL(ydl_opts) as ydl:  # type: ignore
-                return ydl.extract_info(url, download=False)
+        def hook(d: dict[str, Any]) -> None:
+            if job_id in self._cancelled:
+                raise yt_dlp.utils.DownloadCancelled()
+            if progress_hook is not None:
+                try:
+                    progress_hook(d)
+                except Exception as e:
+                    logging.debug(f"yt-dlp progress hook error: {e}")
         
-        info = await loop.run_in_executor(None, extract_info)
-        return info  # type: ignore
+        try:
+            return ytdlp_worker.download(ytdlp_pool, url, format_string, outtmpl, info, hook)
+        finally:
+            with self._jobs_lock:
+                self._running.discard(job_id)
+                self._cancelled.discard(job_id)
+
+    async def download(
+        self,
+        url: str,
+        format_string: str,
+        outtmpl: str,
+        info: dict[str, Any] | None = None,
+        progress_hook: Callable[[dict[str, Any]], None] | None = None
+    ) -> Path:
+        """Download a video; cancelling the awaiting task aborts the job at its next progress event"""
+        job_id = next(self._job_ids)
+        self._running.add(job_id)
+        future = download_executor.submit(self._download_job, job_id, url, format_string, outtmpl, info, progress_hook)
+        try:
+            return await asyncio.wrap_future(future)
+        except asyncio.CancelledError:
+            with self._jobs_lock:
+                if future.cancel():
+                    # Never started
+                    self._running.discard(job_id)
+                elif job_id in self._running:
+                    self._cancelled.add(job_id)
+            raise
+
+    def shutdown(self) -> None:
+        with self._jobs_lock:
+            self._cancelled.update(self._running)
+        if self._processes is not None:
+            self._processes.shutdown(wait=False, cancel_futures=True)
+
+ytdlp_runner = YtdlpRunner(YTDLP_EXECUTION_MODE, YTDLP_PROCESS_WORKERS)
+
+# Import yt-dlp and build YoutubeDL workers in the background shortly after start,
+# once the bot is already serving updates
+YTDLP_WARMUP = os.getenv("YTDLP_WARMUP", "1") == "1"
+YTDLP_WARMUP_DELAY = float(os.getenv("YTDLP_WARMUP_DELAY", "5"))
+
+async def warm_ytdlp_pool() -> None:
+    """Build the first YoutubeDL workers in the background"""
+    await asyncio.sleep(YTDLP_WARMUP_DELAY)
+    try:
+        await ytdlp_runner.warm(YTDLP_POOL_WARM)
+        logging.info(f"yt-dlp warmed up ({ytdlp_runner.mode} mode)")
+    except Exception as e:
+        logging.warning(f"yt-dlp warm-up failed: {e}")
+
+async def get_video_info(url: str) -> dict[str, Any] | None:
+    """Get video metadata without downloading"""
+    try:
+        with track_stage("metadata"):
+            return await ytdlp_runner.extract_info(url)
     except Exception as e:
         logging.error(f"Error extracting video info: {e}")
         return None
@@ -154,20 +1514,325 @@ async def get_cobalt_info(url: str) -> dict[str, Any] | None:
         logging.error(f"Error getting Cobalt info: {e}")
         return None
 
-async def download_youtube_video(url: str, status_message: types.Message, quality: str = "720") -> Path | None:
-    """Download YouTube video using yt-dlp"""
-    downloads_dir = Path("downloads")
-    downloads_dir.mkdir(exist_ok=True)
+# Fallback format selectors used when the info dict has no size data
+YOUTUBE_FORMATS = {
+    "720": 'best[height<=720][ext=mp4]/best[height<=720]/best[ext=mp4]/best',
+    "480": 'best[height<=480][ext=mp4]/best[height<=480]/best',
+    "360": 'best[height<=360][ext=mp4]/best[height<=360]/best',
+    "audio": 'bestaudio[ext=m4a]/bestaudio',
+}
+
+# Height range (exclusive, inclusive] each quality button stands for
+QUALITY_BANDS = {"720": (480, 720), "480": (360, 480), "360": (0, 360)}
+
+# Headroom for sizes that are only estimated
+APPROX_SIZE_MARGIN = 1.1
+
+def estimate_format_size(fmt: dict[str, Any], duration: float | None) -> int | None:
+    """Expected file size of a format in bytes, None if unknown"""
+    if fmt.get("filesize"):
+        return int(fmt["filesize"])
+    if fmt.get("filesize_approx"):
+        return int(fmt["filesize_approx"] * APPROX_SIZE_MARGIN)
+    # tbr is in kbit/s
+    if fmt.get("tbr") and duration:
+        return int(fmt["tbr"] * 1000 / 8 * duration * APPROX_SIZE_MARGIN)
+    return None
+
+def youtube_format_candidates(info: dict[str, Any], quality: str) -> list[tuple[dict[str, Any], int | None]]:
+    """Single-file formats usable for quality, best first, with estimated sizes"""
+    formats = info.get("formats") or []
+    has_audio = lambda f: f.get("acodec") not in (None, "none")
+    has_video = lambda f: f.get("vcodec") not in (None, "none")
+    
+    if quality == "audio":
+        candidates = [f for f in formats if has_audio(f) and f.get("vcodec") == "none"]
+        order = lambda f: (f.get("ext") == "m4a", f.get("abr") or f.get("tbr") or 0)
+    else:
+        # Only formats with both streams, merging would need ffmpeg
+        max_height = QUALITY_BANDS.get(quality, QUALITY_BANDS["720"])[1]
+        candidates = [
+            f for f in formats
+            if has_audio(f) and has_video(f) and (f.get("height") or 0) <= max_height
+        ]
+        order = lambda f: (f.get("height") or 0, f.get("ext") == "mp4", f.get("tbr") or 0)
+    
+    duration = info.get("duration")
+    return [(f, estimate_format_size(f, duration)) for f in sorted(candidates, key=order, reverse=True)]
+
+def plan_youtube_format(info: dict[str, Any], quality: str, max_size: int) -> str | None:
+    """Format selector for the best format that fits max_size, None if nothing fits.
+    
+    Falls back to a generic selector when no candidate has size data.
+    """
+    sized = [(f, size) for f, size in youtube_format_candidates(info, quality) if size is not None]
+    if not sized:
+        return YOUTUBE_FORMATS.get(quality, YOUTUBE_FORMATS["720"])
+    
+    for fmt, size in sized:
+        if size <= max_size:
+            return fmt["format_id"]
+    return None
+
+def smallest_format_size(info: dict[str, Any], quality: str) -> int:
+    """Smallest known size among candidate formats, for error messages"""
+    sizes = [size for _, size in youtube_format_candidates(info, quality) if size is not None]
+    return min(sizes, default=0)
+
+def fitting_qualities(info: dict[str, Any], max_size: int) -> list[str]:
+    """Quality buttons worth offering: ones that have a format of their own which fits"""
+    qualities = []
+    for quality, (min_height, _) in QUALITY_BANDS.items():
+        candidates = youtube_format_candidates(info, quality)
+        if all(size is None for _, size in candidates):
+            # Nothing to judge by, let the download decide
+            qualities.append(quality)
+        elif any(
+            size is not None and size <= max_size and (f.get("height") or 0) > min_height
+            for f, size in candidates
+        ):
+            qualities.append(quality)
+        elif transcoder is not None and transcode_video_kbps(info.get("duration"), max_size) >= TRANSCODE_MIN_VIDEO_KBPS and any(
+            size is not None and size <= VIDEO_SOURCE_MAX_SIZE and (f.get("height") or 0) > min_height
+            for f, size in candidates
+        ):
+            # Too large as is, but small enough to fetch and shrink
+            qualities.append(quality)
+    
+    if plan_youtube_format(info, "audio", max_size) is not None:
+        qualities.append("audio")
+    return qualities
+
+def too_large_text(size: int) -> str:
+    """Message for a video that does not fit the Telegram limit"""
+    limit_text = "2 ГБ" if bot_api_server else "50 МБ"
+    return (
+        f"❌ Відео занадто велике ({size / (1024 * 1024):.1f} МБ).\n\n"
+        f"Ліміт Telegram: {limit_text}. Спробуйте коротше відео."
+    )
+
+# Optional ffmpeg stage: videos over the Telegram limit are re-encoded to a bitrate that fits
+# instead of being refused, and containers Telegram cannot stream are remuxed to mp4 with
+# +faststart. Sources up to TRANSCODE_MAX_INPUT bytes are fetched for this.
+TRANSCODE = os.getenv("TRANSCODE", "0") == "1"
+FFMPEG_PATH = os.getenv("FFMPEG_PATH", "ffmpeg")
+FFPROBE_PATH = os.getenv("FFPROBE_PATH", "ffprobe")
+TRANSCODE_MAX_INPUT = int(os.getenv("TRANSCODE_MAX_INPUT", str(MAX_FILE_SIZE * 8)))
+TRANSCODE_CONCURRENCY = int(os.getenv("TRANSCODE_CONCURRENCY", "1"))
+TRANSCODE_PRESET = os.getenv("TRANSCODE_PRESET", "veryfast")
+TRANSCODE_AUDIO_KBPS = int(os.getenv("TRANSCODE_AUDIO_KBPS", "96"))
+TRANSCODE_MIN_VIDEO_KBPS = int(os.getenv("TRANSCODE_MIN_VIDEO_KBPS", "150"))
+
+# Share of the limit the encoder aims for, the rest absorbs rate control overshoot and muxing
+TRANSCODE_SIZE_TARGET = 0.92
+
+# Output height for a video bitrate in kbit/s, highest first
+TRANSCODE_LADDER = ((2000, 720), (1000, 480), (500, 360), (0, 240))
+
+# Codecs that can go into mp4 without re-encoding
+MP4_VIDEO_CODECS = {"h264", "hevc", "av1", "vp9", "mpeg4"}
+MP4_AUDIO_CODECS = {"aac", "mp3", "opus", "alac", "ac3", "eac3", "flac"}
+
+class TranscodeError(Exception):
+    """Raised when ffmpeg or ffprobe fails"""
+
+def transcode_video_kbps(duration: float | None, max_size: int, audio_kbps: float = TRANSCODE_AUDIO_KBPS) -> float:
+    """Video bitrate that keeps a file of this duration within max_size, 0 if unknown"""
+    if not duration:
+        return 0
+    return max_size * 8 * TRANSCODE_SIZE_TARGET / duration / 1000 - audio_kbps
+
+def transcode_height(video_kbps: float) -> int:
+    """Output height worth spending video_kbps on"""
+    return next(height for min_kbps, height in TRANSCODE_LADDER if video_kbps >= min_kbps)
+
+def mp4_needs_faststart(path: Path) -> bool:
+    """Whether an mp4 keeps its moov box after the media data, so players must read to the end first (blocking)"""
+    with open(path, "rb") as f:
+        while len(header := f.read(8)) == 8:
+            size = int.from_bytes(header[:4], "big")
+            kind = header[4:8]
+            if kind == b"moov":
+                return False
+            if kind == b"mdat":
+                return True
+            if size == 1:
+                size = int.from_bytes(f.read(8), "big") - 8
+            elif size < 8:
+                return False
+            f.seek(size - 8, os.SEEK_CUR)
+    return False
+
+class Transcoder:
+    """Runs ffprobe/ffmpeg subprocesses, at most `concurrency` encodes at a time"""
+
+    def __init__(self, concurrency: int):
+        self._slots = asyncio.Semaphore(concurrency)
+
+    async def probe(self, path: Path) -> dict[str, Any]:
+        process = await asyncio.create_subprocess_exec(
+            FFPROBE_PATH, "-v", "error", "-print_format", "json", "-show_format", "-show_streams", str(path),
+            stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
+        )
+        stdout, stderr = await process.communicate()
+        if process.returncode:
+            raise TranscodeError(f"ffprobe failed: {stderr.decode(errors='replace').strip()[-300:]}")
+        return json.loads(stdout)
+
+    async def run(self, args: list[str], duration: float, on_progress: Callable[[float], None] | None) -> None:
+        """Run ffmpeg, reporting the share of duration already written"""
+        async with self._slots:
+            with track_stage("transcode"):
+                process = await asyncio.create_subprocess_exec(
+                    FFMPEG_PATH, "-hide_banner", "-nostdin", "-v", "error", "-nostats", "-progress", "pipe:1", "-y", *args,
+                    stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
+                )
+                assert process.stdout is not None and process.stderr is not None
+                stderr_task = asyncio.create_task(process.stderr.read())
+                try:
+                    async for line in process.stdout:
+                        key, _, value = line.decode(errors="replace").strip().partition("=")
+                        if key == "out_time_us" and value.isdigit() and duration and on_progress:
+                            on_progress(min(int(value) / 1_000_000 / duration, 1.0))
+                    await process.wait()
+                except BaseException:
+                    if process.returncode is None:
+                        process.kill()
+                        await process.wait()
+                    stderr_task.cancel()
+                    raise
+                stderr = await stderr_task
+                if process.returncode:
+                    raise TranscodeError(f"ffmpeg failed: {stderr.decode(errors='replace').strip()[-300:]}")
+
+    async def fit(
+        self,
+        path: Path,
+        max_size: int,
+        on_progress: Callable[[float], None] | None = None,
+        duration_hint: float | None = None
+    ) -> Path | None:
+        """Streamable mp4 version of a video within max_size, None if it cannot be made to fit.
+        
+        Files that already fit are stream-copied when only the container needs fixing and
+        left alone otherwise; larger ones are re-encoded. The source is removed once replaced.
+        """
+        probe = await self.probe(path)
+        streams = probe.get("streams") or []
+        video = next((
+            stream for stream in streams
+            if stream.get("codec_type") == "video" and not (stream.get("disposition") or {}).get("attached_pic")
+        ), None)
+        audio = next((stream for stream in streams if stream.get("codec_type") == "audio"), None)
+        duration = float((probe.get("format") or {}).get("duration") or duration_hint or 0)
+        size = path.stat().st_size
+        
+        output_dir = path.parent / "fit"
+        output_dir.mkdir(exist_ok=True)
+        output = output_dir / f"{path.stem}.mp4"
+        
+        if size <= max_size:
+            if video is None:
+                return path
+            is_mp4 = "mp4" in (probe.get("format") or {}).get("format_name", "")
+            if is_mp4 and not await asyncio.get_running_loop().run_in_executor(file_io_executor, mp4_needs_faststart, path):
+                return path
+            if video.get("codec_name") not in MP4_VIDEO_CODECS or (audio and audio.get("codec_name") not in MP4_AUDIO_CODECS):
+                # Not worth re-encoding a file that already fits
+                return path
+            await self.run(
+                ["-i", str(path), "-map", "0:v:0", "-map", "0:a:0?", "-c", "copy", "-movflags", "+faststart", str(output)],
+                duration, on_progress
+            )
+            path.unlink()
+            return output
+        
+        if video is None:
+            return None
+        audio_kbps = TRANSCODE_AUDIO_KBPS if audio else 0
+        video_kbps = transcode_video_kbps(duration, max_size, audio_kbps)
+        
+        # One more pass at a proportionally lower bitrate if the encoder overshoots
+        for _ in range(2):
+            if video_kbps < TRANSCODE_MIN_VIDEO_KBPS:
+                break
+            height = min(int(video.get("height") or 720), transcode_height(video_kbps)) // 2 * 2
+            await self.run([
+                "-i", str(path), "-map", "0:v:0", "-map", "0:a:0?",
+                "-vf", f"scale=-2:{height}", "-pix_fmt", "yuv420p",
+                "-c:v", "libx264", "-preset", TRANSCODE_PRESET,
+                "-b:v", f"{int(video_kbps)}k", "-maxrate", f"{int(video_kbps)}k", "-bufsize", f"{int(video_kbps * 2)}k",
+                "-c:a", "aac", "-b:a", f"{audio_kbps}k",
+                "-movflags", "+faststart", str(output)
+            ], duration, on_progress)
+            output_size = output.stat().st_size
+            if output_size <= max_size:
+                path.unlink()
+                return output
+            logging.info(f"Transcode of {path.name} came out at {output_size} bytes, retrying at a lower bitrate")
+            video_kbps *= max_size / output_size * TRANSCODE_SIZE_TARGET
+        
+        output.unlink(missing_ok=True)
+        return None
+
+if TRANSCODE and not (shutil.which(FFMPEG_PATH) and shutil.which(FFPROBE_PATH)):
+    logging.warning(f"TRANSCODE is on but {FFMPEG_PATH}/{FFPROBE_PATH} was not found, large videos will be refused")
+transcoder = Transcoder(TRANSCODE_CONCURRENCY) if TRANSCODE and shutil.which(FFMPEG_PATH) and shutil.which(FFPROBE_PATH) else None
+
+# Largest source worth downloading for a video, and the staging space it needs next to its output
+VIDEO_SOURCE_MAX_SIZE = max(TRANSCODE_MAX_INPUT, MAX_FILE_SIZE) if transcoder else MAX_FILE_SIZE
+VIDEO_STAGING_RESERVE = VIDEO_SOURCE_MAX_SIZE + MAX_FILE_SIZE if transcoder else MAX_FILE_SIZE
+
+def plan_transcode_source(info: dict[str, Any], quality: str, max_size: int) -> str | None:
+    """Smallest format that still has the height the re-encode can afford, None if nothing can be shrunk to fit"""
+    video_kbps = transcode_video_kbps(info.get("duration"), max_size)
+    sized = [
+        (f, size) for f, size in youtube_format_candidates(info, quality)
+        if size is not None and size <= VIDEO_SOURCE_MAX_SIZE
+    ]
+    if not sized or video_kbps < TRANSCODE_MIN_VIDEO_KBPS:
+        return None
+    height = transcode_height(video_kbps)
+    sharp = [(f, size) for f, size in sized if (f.get("height") or 0) >= height]
+    return min(sharp or sized, key=lambda candidate: candidate[1])[0]["format_id"]
+
+async def fit_video(path: Path, status_message: SharedStatus, duration: float | None = None) -> Path | None:
+    """Video ready for Telegram, shrunk or remuxed by ffmpeg when enabled; None if it is too large"""
+    if transcoder is None:
+        return path if path.stat().st_size <= MAX_FILE_SIZE else None
     
+    size = path.stat().st_size
+    target = min(size, int(MAX_FILE_SIZE * TRANSCODE_SIZE_TARGET))
+    title = "🎞 Стискаю відео під ліміт Telegram..." if size > MAX_FILE_SIZE else "🎞 Готую відео..."
+    
+    def report_progress(share: float) -> None:
+        status_message.report(f"{title}\n\n{progress_bar(int(target * share), target)}")
+    
+    status_message.report(title)
+    return await transcoder.fit(path, MAX_FILE_SIZE, report_progress, duration)
+
+async def download_youtube_video(
+    url: str,
+    status_message: SharedStatus,
+    downloads_dir: Path,
+    quality: str = "720",
+    info: dict[str, Any] | None = None
+) -> Path | None:
+    """Download YouTube video into downloads_dir using yt-dlp, reusing preview info when available"""
+
     max_file_size = MAX_FILE_SIZE
     
-    # Format string based on quality
-    format_map = {
-        "720": 'best[height<=720][ext=mp4]/best[height<=720]/best[ext=mp4]/best',
-        "480": 'best[height<=480][ext=mp4]/best[height<=480]/best',
-        "360": 'best[height<=360][ext=mp4]/best[height<=360]/best',
-    }
-    format_string = format_map.get(quality, format_map["720"])
+    # Pick a format that fits the limit up front when sizes are known
+    if info is not None:
+        planned = plan_youtube_format(info, quality, max_file_size)
+        if planned is None and transcoder is not None:
+            planned = plan_transcode_source(info, quality, max_file_size)
+        if planned is None:
+            await status_message.edit_text(too_large_text(smallest_format_size(info, quality)))
+            return None
+        format_string = planned
+    else:
+        format_string = YOUTUBE_FORMATS.get(quality, YOUTUBE_FORMATS["720"])
     
     # Progress tracking
     progress_data = {'downloaded': 0, 'total': 0, 'status': 'starting'}
@@ -192,11 +1857,12 @@ async def download_youtube_video(url: str, status_message: types.Message, qualit
                 if progress_data['total'] > 0 and progress_data['status'] == 'downloading':
                     # Show real progress bar
                     progress_text = f"⏬ Завантажую YouTube відео...\n\n{progress_bar(progress_data['downloaded'], progress_data['total'])}"
-                    await status_message.edit_text(progress_text)
+                    status_message.report(progress_text)
+                    journal_progress(progress_data['downloaded'])
                 else:
                     # Show animation while waiting for progress data
                     frame_idx[0] = (frame_idx[0] + 1) % len(animation_frames)
-                    await status_message.edit_text(f"{animation_frames[frame_idx[0]]} Завантажую YouTube відео...")
+                    status_message.report(f"{animation_frames[frame_idx[0]]} Завантажую YouTube відео...")
             except Exception as e:
                 logging.debug(f"Progress update error: {e}")
                 pass
@@ -207,24 +1873,13 @@ async def download_youtube_video(url: str, status_message: types.Message, qualit
     try:
         # Always use single file format to avoid ffmpeg dependency issues
         # This ensures compatibility across all systems
-        ydl_opts: dict[str, Any] = {
-            'format': format_string,
-            'outtmpl': str(downloads_dir / '%(title)s.%(ext)s'),
-            'quiet': True,
-            'no_warnings': True,
-            'no_abort_on_error': True,  # Don't abort on errors, try next format
-            'progress_hooks': [progress_hook],
-        }
-        
-        # Run yt-dlp in thread pool to not block event loop
-        loop = asyncio.get_event_loop()
-        
-        def download():
-            with yt_dlp.YoutubeDL(ydl_opts) as ydl:  # type: ignore
-                info = ydl.extract_info(url, download=True)
-                return Path(ydl.prepare_filename(info))
+        outtmpl = str(downloads_dir / '%(title)s.%(ext)s')
         
-        video_filename = await loop.run_in_executor(None, download)
+        # Run yt-dlp off the event loop
+        started = time.monotonic()
+        with track_stage("download"):
+            video_filename = await ytdlp_runner.download(url, format_string, outtmpl, info, progress_hook)
+        record_download("youtube", video_filename.stat().st_size, time.monotonic() - started)
     finally:
         # Stop progress updater
         progress_task.cancel()
@@ -236,85 +1891,1434 @@ async def download_youtube_video(url: str, status_message: types.Message, qualit
     # Check file size
     file_size = video_filename.stat().st_size
     
-    # If too large, try lower quality
-    if file_size > max_file_size:
-        video_filename.unlink()
-        await status_message.edit_text("📉 Файл занадто великий, завантажую у 480p...")
+    # With ffmpeg, shrink or remux the file instead of downloading it again
+    if transcoder is not None:
+        fitted = await fit_video(video_filename, status_message, info.get("duration") if info else None)
+        if fitted is None:
+            video_filename.unlink(missing_ok=True)
+            await status_message.edit_text(too_large_text(file_size))
+        return fitted
+    
+    # If too large, try lower quality
+    if file_size > max_file_size:
+        video_filename.unlink()
+        await status_message.edit_text("📉 Файл занадто великий, завантажую у 480p...")
+        
+        # Reset progress data for new download
+        progress_data['downloaded'] = 0
+        progress_data['total'] = 0
+        
+        # Start new progress updater
+        progress_task = asyncio.create_task(update_progress())
+        
+        try:
+            lower_format = 'best[height<=480][ext=mp4]/best[height<=480]/best[height<=360]'
+            started = time.monotonic()
+            with track_stage("download"):
+                video_filename = await ytdlp_runner.download(url, lower_format, outtmpl, info, progress_hook)
+            record_download("youtube", video_filename.stat().st_size, time.monotonic() - started)
+        finally:
+            progress_task.cancel()
+            try:
+                await progress_task
+            except asyncio.CancelledError:
+                pass
+        
+        file_size = video_filename.stat().st_size
+        
+        # If still too large, inform user
+        if file_size > max_file_size:
+            video_filename.unlink()
+            await status_message.edit_text(too_large_text(file_size))
+            return None
+    
+    return video_filename
+
+# Cobalt error codes that mean "this instance can't serve us right now"
+INSTANCE_ERROR_PREFIXES = (
+    "error.api.rate_exceeded", "error.api.auth", "error.api.capacity",
+    "error.api.fetch.rate", "error.api.fetch.fail", "error.api.fetch.critical",
+)
+
+class CobaltInstanceError(Exception):
+    """Raised when a Cobalt instance failed in a way another instance may not"""
+
+def is_instance_failure(status: int, body: str | dict[str, Any]) -> bool:
+    """Whether a Cobalt response should be retried on another instance"""
+    if status >= 500 or status in (401, 403, 429):
+        return True
+    if isinstance(body, str):
+        try:
+            body = json.loads(body)
+        except ValueError:
+            return False
+    if not isinstance(body, dict) or body.get("status") != "error":
+        return False
+    code = str(body.get("error", {}).get("code", ""))
+    return code.startswith(INSTANCE_ERROR_PREFIXES)
+
+class CobaltInstance:
+    """One Cobalt API instance with its latency and error statistics"""
+
+    def __init__(self, url: str, api_key: str | None):
+        self.url = url.rstrip("/")
+        self.api_key = api_key
+        self.latency: float | None = None  # Exponentially weighted, seconds
+        self.error_rate = 0.0  # Exponentially weighted share of failed calls
+        self.requests = 0
+        self.errors = 0
+        # Health checks, kept apart from the requests users made
+        self.probes = 0
+        self.probe_failures = 0
+        self.consecutive_failures = 0
+        self.open_until = 0.0
+        self.last_error: str | None = None
+
+    @property
+    def available(self) -> bool:
+        """False while the circuit breaker is open"""
+        return self.open_until <= time.monotonic()
+
+    def record_success(self, latency: float) -> None:
+        self.requests += 1
+        self.consecutive_failures = 0
+        self.open_until = 0.0
+        self.error_rate *= 0.8
+        self.latency = latency if self.latency is None else 0.7 * self.latency + 0.3 * latency
+
+    def record_failure(self, error: str) -> None:
+        self.requests += 1
+        self.errors += 1
+        self.error_rate = 0.8 * self.error_rate + 0.2
+        self._count_failure(error)
+
+    def record_probe_success(self, latency: float) -> None:
+        """A passed health check only half-opens the breaker, a real request closes it"""
+        self.probes += 1
+        self.latency = latency if self.latency is None else 0.7 * self.latency + 0.3 * latency
+        if not self.available:
+            # consecutive_failures stays over the threshold, so one failed request opens it again
+            self.open_until = 0.0
+
+    def record_probe_failure(self, error: str) -> None:
+        self.probes += 1
+        self.probe_failures += 1
+        self._count_failure(error)
+
+    def _count_failure(self, error: str) -> None:
+        self.consecutive_failures += 1
+        self.last_error = error
+        logging.warning(f"Cobalt instance {self.url} failed: {error}")
+        if self.consecutive_failures >= COBALT_FAILURE_THRESHOLD:
+            self.open_until = time.monotonic() + COBALT_CIRCUIT_COOLDOWN
+            logging.warning(f"Cobalt instance {self.url} disabled for {COBALT_CIRCUIT_COOLDOWN:.0f}s")
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "url": self.url,
+            "available": self.available,
+            "latency_ms": round(self.latency * 1000) if self.latency is not None else None,
+            "error_rate": round(self.error_rate, 3),
+            "requests": self.requests,
+            "errors": self.errors,
+            "probes": self.probes,
+            "probe_failures": self.probe_failures,
+            "last_error": self.last_error,
+        }
+
+class CobaltPool:
+    """Routes Cobalt requests to the fastest healthy instance"""
+
+    def __init__(self, instances: list[CobaltInstance]):
+        self.instances = instances
+
+    def ranked(self) -> list[CobaltInstance]:
+        """Available instances fastest first, then the ones with open circuits as a last resort"""
+        # Recent errors make an instance look slower than it answers
+        by_score = lambda i: i.latency * (1 + 4 * i.error_rate) if i.latency is not None else float("inf")
+        available = sorted((i for i in self.instances if i.available), key=by_score)
+        tripped = sorted((i for i in self.instances if not i.available), key=lambda i: i.open_until)
+        return available + tripped
+
+    async def probe(self, instance: CobaltInstance) -> None:
+        """Measure instance latency with its info endpoint"""
+        started = time.monotonic()
+        try:
+            session = get_http_session()
+            timeout = aiohttp.ClientTimeout(total=HTTP_CONNECT_TIMEOUT)
+            async with session.get(f"{instance.url}/", headers={"Accept": "application/json"}, timeout=timeout) as response:
+                await response.read()
+                if response.status != 200:
+                    raise CobaltInstanceError(f"Health check HTTP {response.status}")
+        except Exception as e:
+            instance.record_probe_failure(f"Health check failed: {e or type(e).__name__}")
+            return
+        instance.record_probe_success(time.monotonic() - started)
+
+    async def run_health_checks(self) -> None:
+        """Probe all instances periodically (runs until cancelled)"""
+        while True:
+            await asyncio.gather(*(self.probe(instance) for instance in self.instances))
+            logging.debug(f"Cobalt instances: {self.stats()}")
+            await asyncio.sleep(COBALT_HEALTH_INTERVAL)
+
+    def stats(self) -> list[dict[str, Any]]:
+        return [instance.stats() for instance in self.instances]
+
+def parse_cobalt_instances(spec: str) -> list[CobaltInstance]:
+    """Parse COBALT_INSTANCES, falling back to COBALT_API_URL/COBALT_API_KEY"""
+    instances = []
+    for entry in spec.split(","):
+        url, _, api_key = entry.strip().partition("|")
+        if url:
+            instances.append(CobaltInstance(url.strip(), api_key.strip() or None))
+    return instances or [CobaltInstance(COBALT_API_URL, COBALT_API_KEY)]
+
+cobalt_pool = CobaltPool(parse_cobalt_instances(COBALT_INSTANCES))
+
+async def request_cobalt_instance(instance: CobaltInstance, payload: dict[str, Any]) -> dict[str, Any]:
+    """POST payload to one Cobalt instance, renewing a rejected JWT once"""
+    session = get_http_session()
+    for attempt in range(2):
+        headers = {
+            "Accept": "application/json",
+            "Content-Type": "application/json",
+            "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36"
+        }
+        
+        # Add authentication if available
+        if instance.api_key:
+            headers["Authorization"] = f"Api-Key {instance.api_key}"
+        else:
+            # Try to get JWT token
+            jwt_token = await get_jwt_token(instance.url)
+            if jwt_token:
+                headers["Authorization"] = f"Bearer {jwt_token}"
+        
+        async with session.post(f"{instance.url}/", headers=headers, json=payload) as response:
+            response_text = await response.text()
+            
+            if response.status == 401 and "Authorization" in headers and not instance.api_key and attempt == 0:
+                # Token expired early or was revoked, get a fresh one and retry once
+                logging.info(f"Cobalt rejected JWT for {instance.url}, renewing")
+                cobalt_sessions.invalidate(instance.url)
+                continue
+            
+            if response.status != 200:
+                logging.error(f"Cobalt API error {response.status} from {instance.url}: {response_text}")
+                error = f"Cobalt API error: {response.status} - {response_text[:200]}"
+                if is_instance_failure(response.status, response_text):
+                    raise CobaltInstanceError(error)
+                # The request itself is bad, another instance will not help
+                raise Exception(error)
+            
+            try:
+                return await response.json()
+            except Exception as e:
+                logging.error(f"Failed to parse JSON response: {response_text}")
+                raise CobaltInstanceError(f"Invalid JSON response from Cobalt API")
+    
+    raise CobaltInstanceError("Cobalt API rejected authentication")
+
+async def download_with_cobalt(url: str, download_mode: str = "auto") -> dict[str, Any]:
+    """Download video using Cobalt API"""
+    payload = {
+        "url": url,
+        "videoQuality": "max",
+        "filenameStyle": "basic",
+        "downloadMode": download_mode
+    }
+    
+    # Preview and button press ask for the same thing, reuse the first answer
+    cache_key = (canonicalize_url(url), json.dumps({k: v for k, v in payload.items() if k != "url"}, sort_keys=True))
+    cached = cobalt_response_cache.get(cache_key)
+    cache_lookups.inc(cache="cobalt_response", result="miss" if cached is None else "hit")
+    if cached is not None:
+        return cached
+    
+    with track_stage("cobalt_api"):
+        # Try the fastest healthy instances in turn until one answers
+        last_error: Exception | None = None
+        last_result: dict[str, Any] | None = None
+        for instance in cobalt_pool.ranked()[:COBALT_MAX_ATTEMPTS]:
+            started = time.monotonic()
+            try:
+                result = await request_cobalt_instance(instance, payload)
+            except (aiohttp.ClientError, asyncio.TimeoutError, CobaltInstanceError) as e:
+                instance.record_failure(str(e) or type(e).__name__)
+                cobalt_errors.inc(code="instance_unavailable")
+                last_error = e
+                continue
+            
+            if is_instance_failure(200, result):
+                code = str(result.get("error", {}).get("code"))
+                instance.record_failure(code)
+                cobalt_errors.inc(code=code)
+                last_result = result
+                continue
+            
+            instance.record_success(time.monotonic() - started)
+            # Files are fetched with this instance as Referer, see cobalt_file_headers
+            result["instance"] = instance.url
+            break
+        else:
+            # Every attempt failed, report the most specific answer we got
+            if last_result is not None:
+                return last_result
+            raise Exception(f"All Cobalt instances failed: {last_error}")
+    
+    if result.get("status") == "error":
+        cobalt_errors.inc(code=str(result.get("error", {}).get("code")))
+    
+    ttl = cobalt_result_ttl(result)
+    if ttl > 0:
+        cobalt_response_cache.set(cache_key, result, ttl)
+    return result
+
+# Parallel range downloads for Cobalt redirect/tunnel files
+DOWNLOAD_SEGMENTS = int(os.getenv("DOWNLOAD_SEGMENTS", "4"))
+DOWNLOAD_SEGMENT_MIN_SIZE = int(os.getenv("DOWNLOAD_SEGMENT_MIN_SIZE", str(8 * 1024 * 1024)))
+DOWNLOAD_SEGMENT_RETRIES = 2
+PROGRESS_INTERVAL = 0.5
+
+# Disk writes for streamed downloads happen off the event loop in large blocks
+DOWNLOAD_CHUNK_SIZE = int(os.getenv("DOWNLOAD_CHUNK_SIZE", str(256 * 1024)))
+DOWNLOAD_WRITE_BUFFER = int(os.getenv("DOWNLOAD_WRITE_BUFFER", str(4 * 1024 * 1024)))
+DOWNLOAD_PREALLOCATE = os.getenv("DOWNLOAD_PREALLOCATE", "1") == "1"
+FILE_IO_WORKERS = int(os.getenv("FILE_IO_WORKERS", "4"))
+
+file_io_executor = ThreadPoolExecutor(max_workers=FILE_IO_WORKERS, thread_name_prefix="file-io")
+
+def preallocate_file(path: Path, size: int) -> None:
+    """Create or truncate path and reserve size bytes for it (blocking)"""
+    with open(path, "wb") as f:
+        if size <= 0:
+            return
+        if DOWNLOAD_PREALLOCATE and hasattr(os, "posix_fallocate"):
+            try:
+                os.posix_fallocate(f.fileno(), 0, size)
+                return
+            except OSError as e:
+                logging.debug(f"fallocate failed, using sparse file: {e}")
+        f.truncate(size)
+
+def write_at(f: Any, data: bytes | bytearray, offset: int) -> None:
+    """Write data at offset (blocking)"""
+    f.seek(offset)
+    f.write(data)
+
+class BufferedFileWriter:
+    """Write-behind buffer for a file region.
+    
+    Chunks are collected in memory and written as large blocks from
+    file_io_executor. Only one block per writer is in flight, so memory stays
+    below two buffers per writer and a slow disk slows the download instead of
+    the event loop. segment[0], if given, follows flushed for checkpoints.
+    """
+
+    def __init__(
+        self,
+        path: Path,
+        offset: int = 0,
+        buffer_size: int = DOWNLOAD_WRITE_BUFFER,
+        segment: list[int] | None = None
+    ):
+        self.buffer_size = buffer_size
+        self._file = open(path, "r+b")
+        self._offset = offset
+        # End of the data already handed to the OS, safe to resume from after a crash
+        self.flushed = offset
+        self.segment = segment
+        self._buffer = bytearray()
+        self._pending: asyncio.Future[None] | None = None
+
+    async def write(self, chunk: bytes) -> None:
+        self._buffer += chunk
+        if len(self._buffer) >= self.buffer_size:
+            await self._flush_buffer()
+
+    def _written(self, end: int, future: asyncio.Future[None]) -> None:
+        # Blocks are written one at a time, so everything before end is on disk too
+        if not future.cancelled() and future.exception() is None:
+            self.flushed = end
+            if self.segment is not None:
+                self.segment[0] = end
+
+    async def _wait_pending(self) -> None:
+        if self._pending is not None:
+            # Shielded: a cancelled download still lets its last block land, abort waits for it
+            await asyncio.shield(self._pending)
+            self._pending = None
+
+    async def _flush_buffer(self) -> None:
+        await self._wait_pending()
+        if not self._buffer:
+            return
+        data, self._buffer = self._buffer, bytearray()
+        end = self._offset + len(data)
+        loop = asyncio.get_event_loop()
+        self._pending = loop.run_in_executor(file_io_executor, write_at, self._file, data, self._offset)
+        self._pending.add_done_callback(functools.partial(self._written, end))
+        self._offset = end
+
+    async def close(self) -> None:
+        """Write what is left and close the file"""
+        try:
+            await self._flush_buffer()
+            await self._wait_pending()
+        finally:
+            self._pending = None
+            self._file.close()
+
+    async def abort(self) -> None:
+        """Write what is buffered and close the file without raising, so an interrupted download keeps its bytes"""
+        try:
+            with contextlib.suppress(Exception):
+                await self._flush_buffer()
+                await self._wait_pending()
+        finally:
+            self._buffer = bytearray()
+            self._pending = None
+            self._file.close()
+
+class FileTooLargeError(Exception):
+    """Raised when a remote file exceeds the Telegram upload limit"""
+
+    def __init__(self, size: int):
+        super().__init__(f"File is too large: {size} bytes")
+        self.size = size
+
+class DownloadProgress:
+    """Byte counter shared by all segments, reports at most every PROGRESS_INTERVAL"""
+
+    def __init__(self, total: int, on_progress: Callable[[int, int], Awaitable[None]] | None):
+        self.total = total
+        self.downloaded = 0
+        self.on_progress = on_progress
+        self.last_update = 0.0
+
+    async def add(self, size: int) -> None:
+        self.downloaded += size
+        current_time = asyncio.get_event_loop().time()
+        if self.on_progress and self.total > 0 and current_time - self.last_update >= PROGRESS_INTERVAL:
+            self.last_update = current_time
+            await self.on_progress(self.downloaded, self.total)
+
+class DownloadCheckpoint:
+    """Byte ranges of a download still missing, enough to resume it after a restart"""
+
+    def __init__(self, total: int | None = None, ranges: list[list[int]] | None = None):
+        self.total = total
+        # [next offset, end] per segment, end inclusive; updated as data reaches the disk
+        self.ranges = ranges or []
+
+    @property
+    def resumable(self) -> bool:
+        return self.total is not None and bool(self.ranges)
+
+    @property
+    def done(self) -> int:
+        """Bytes already on disk"""
+        return (self.total or 0) - sum(max(end + 1 - offset, 0) for offset, end in self.ranges)
+
+    def to_json(self) -> str:
+        return json.dumps({"total": self.total, "ranges": self.ranges})
+
+    @classmethod
+    def from_json(cls, data: str | None) -> "DownloadCheckpoint":
+        if not data:
+            return cls()
+        state = json.loads(data)
+        return cls(state.get("total"), state.get("ranges"))
+
+def content_range_total(header: str | None) -> int | None:
+    """Total size from a 'bytes 0-0/12345' Content-Range header"""
+    if not header or "/" not in header:
+        return None
+    total = header.rsplit("/", 1)[1].strip()
+    return int(total) if total.isdigit() else None
+
+async def download_http_file(
+    url: str,
+    path: Path,
+    headers: dict[str, str],
+    max_size: int,
+    on_progress: Callable[[int, int], Awaitable[None]] | None = None,
+    segments: int = DOWNLOAD_SEGMENTS,
+    on_size: Callable[[int], None] | None = None,
+    checkpoint: DownloadCheckpoint | None = None
+) -> int:
+    """Download url to path, fetching byte ranges in parallel when the server allows it.
+    
+    Raises FileTooLargeError before downloading if the file exceeds max_size.
+    on_size gets the expected size (max_size if the server does not say) before
+    the body is read and may raise to abort. checkpoint is kept up to date with
+    the ranges still missing; if it already has some and path exists, only those
+    are fetched. Returns the number of bytes written.
+    """
+    session = get_http_session()
+    checkpoint = checkpoint or DownloadCheckpoint()
+    
+    # Probe with a one-byte range: 206 means ranges work and tells the total size
+    async with session.get(url, headers={**headers, "Range": "bytes=0-0"}) as response:
+        if response.status == 200:
+            # Ranges not supported, this response already is the whole file
+            checkpoint.total, checkpoint.ranges = None, []
+            if on_size:
+                on_size(response.content_length or max_size)
+            return await stream_to_file(response, path, max_size, on_progress)
+        if response.status != 206:
+            raise Exception(f"Failed to download: HTTP {response.status}")
+        total_size = content_range_total(response.headers.get("Content-Range"))
+    
+    resuming = checkpoint.resumable and checkpoint.total == total_size and path.exists()
+    if resuming and total_size is not None:
+        if on_size:
+            on_size(total_size)
+        remaining = [segment for segment in checkpoint.ranges if segment[0] <= segment[1]]
+        logging.info(f"Resuming {path.name}: {sum(end + 1 - offset for offset, end in remaining)} of {total_size} bytes left")
+    elif total_size is None or segments <= 1 or total_size < DOWNLOAD_SEGMENT_MIN_SIZE:
+        if total_size is not None and total_size > max_size:
+            raise FileTooLargeError(total_size)
+        # One segment covering the whole file, resumable when the size is known
+        checkpoint.total = total_size
+        checkpoint.ranges = [[0, total_size - 1]] if total_size else []
+        async with session.get(url, headers=headers) as response:
+            if response.status != 200:
+                raise Exception(f"Failed to download: HTTP {response.status}")
+            if on_size:
+                on_size(total_size or response.content_length or max_size)
+            return await stream_to_file(response, path, max_size, on_progress, checkpoint.ranges[0] if checkpoint.ranges else None)
+    else:
+        if total_size > max_size:
+            raise FileTooLargeError(total_size)
+        if on_size:
+            on_size(total_size)
+        
+        # Preallocate so every segment can write at its own offset
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(file_io_executor, preallocate_file, path, total_size)
+        
+        segment_size = -(-total_size // segments)
+        checkpoint.total = total_size
+        checkpoint.ranges = [[start, min(start + segment_size, total_size) - 1] for start in range(0, total_size, segment_size)]
+        remaining = checkpoint.ranges
+    
+    progress = DownloadProgress(total_size, on_progress)
+    progress.downloaded = total_size - sum(end + 1 - offset for offset, end in remaining)
+    tasks = [
+        asyncio.create_task(download_range(url, path, headers, segment[0], segment[1], progress, segment))
+        for segment in remaining
+    ]
+    try:
+        await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+    return total_size
+
+async def download_range(
+    url: str,
+    path: Path,
+    headers: dict[str, str],
+    start: int,
+    end: int,
+    progress: DownloadProgress,
+    segment: list[int] | None = None
+) -> None:
+    """Fetch bytes start..end (inclusive) into the same offsets of path, resuming on connection errors.
+    
+    segment[0] follows the offset written so far, for checkpoints.
+    """
+    session = get_http_session()
+    offset = start
+    attempts = 0
+    writer = BufferedFileWriter(path, offset, segment=segment)
+    try:
+        while offset <= end:
+            try:
+                async with session.get(url, headers={**headers, "Range": f"bytes={offset}-{end}"}) as response:
+                    if response.status != 206:
+                        raise Exception(f"Range request failed: HTTP {response.status}")
+                    
+                    async for chunk in response.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+                        chunk = chunk[:end + 1 - offset]
+                        await writer.write(chunk)
+                        offset += len(chunk)
+                        await progress.add(len(chunk))
+                    
+                    if offset <= end:
+                        raise aiohttp.ClientPayloadError(f"Range {start}-{end} ended at {offset}")
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                attempts += 1
+                if attempts > DOWNLOAD_SEGMENT_RETRIES:
+                    raise
+                logging.warning(f"Segment {start}-{end} failed at {offset}, retrying: {e}")
+    except BaseException:
+        await writer.abort()
+        raise
+    await writer.close()
+
+async def stream_to_file(
+    response: aiohttp.ClientResponse,
+    path: Path,
+    max_size: int,
+    on_progress: Callable[[int, int], Awaitable[None]] | None,
+    segment: list[int] | None = None
+) -> int:
+    """Write a whole-file response to path over a single connection, segment[0] following the written offset"""
+    total_size = response.content_length or 0
+    if total_size > max_size:
+        raise FileTooLargeError(total_size)
+    
+    loop = asyncio.get_event_loop()
+    await loop.run_in_executor(file_io_executor, preallocate_file, path, total_size)
+    
+    progress = DownloadProgress(total_size, on_progress)
+    writer = BufferedFileWriter(path, segment=segment)
+    try:
+        async for chunk in response.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+            await writer.write(chunk)
+            await progress.add(len(chunk))
+            # Tunnels often have no Content-Length, stop as soon as the limit is passed
+            if progress.downloaded > max_size:
+                raise FileTooLargeError(progress.downloaded)
+    except BaseException:
+        await writer.abort()
+        raise
+    await writer.close()
+    
+    # Drop preallocated space the server did not fill
+    if total_size and progress.downloaded != total_size:
+        await loop.run_in_executor(file_io_executor, os.truncate, path, progress.downloaded)
+    return progress.downloaded
+
+# Downloaded files are kept on disk, keyed by (canonical URL, format), within a byte quota.
+# DOWNLOAD_CACHE_MAX_BYTES=0 keeps the old behaviour of deleting files right after upload.
+DOWNLOAD_CACHE_DIR = Path(os.getenv("DOWNLOAD_CACHE_DIR", "downloads"))
+DOWNLOAD_CACHE_MAX_BYTES = int(os.getenv("DOWNLOAD_CACHE_MAX_BYTES", str(10 * 1024 * 1024 * 1024)))
+DOWNLOAD_CACHE_MIN_FREE = int(os.getenv("DOWNLOAD_CACHE_MIN_FREE", str(1024 * 1024 * 1024)))
+
+class DownloadCache:
+    """Content-addressed file cache: one directory per key holding the finished file.
+    
+    Downloads go to a private staging directory and are moved into place with
+    os.replace, so a cache entry is either complete or absent. Entries in use
+    by an upload are pinned and never evicted.
+    """
+
+    STAGING = ".staging"
+
+    def __init__(self, root: Path, max_bytes: int, min_free: int):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.min_free = min_free
+        self.used = 0
+        self.reserved = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[str, int] = OrderedDict()  # key -> size, least recently used first
+        self._pins: dict[str, int] = {}
+        # Set on shutdown so named staging directories survive for resumed jobs
+        self.keep_staging = False
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    @staticmethod
+    def key(url: str, variant: str) -> str:
+        return hashlib.sha256(f"{canonicalize_url(url)}|{variant}".encode()).hexdigest()
+
+    def _entry_file(self, key: str) -> Path | None:
+        try:
+            return next(path for path in (self.root / key).iterdir() if path.is_file())
+        except (FileNotFoundError, StopIteration):
+            return None
+
+    def sweep(self, keep_staging: Collection[str] = ()) -> None:
+        """Drop staging leftovers and stray files of crashed jobs, then index entries (blocking).
+        
+        Staging directories named in keep_staging hold partial downloads of jobs to resume.
+        """
+        self.root.mkdir(parents=True, exist_ok=True)
+        staging_root = self.root / self.STAGING
+        if staging_root.is_dir():
+            for path in staging_root.iterdir():
+                if path.name not in keep_staging:
+                    shutil.rmtree(path, ignore_errors=True)
+        entries = []
+        for path in self.root.iterdir():
+            if path.name == self.STAGING:
+                continue
+            entry_file = self._entry_file(path.name) if path.is_dir() else None
+            if entry_file is None:
+                # Loose files from the old layout, .part files and empty entries
+                if path.is_dir():
+                    shutil.rmtree(path, ignore_errors=True)
+                else:
+                    path.unlink(missing_ok=True)
+                continue
+            stat = entry_file.stat()
+            entries.append((stat.st_mtime, path.name, stat.st_size))
+        self._entries.clear()
+        self.used = 0
+        for _, key, size in sorted(entries):
+            self._entries[key] = size
+            self.used += size
+        self._evict()
+        logging.info(f"Download cache: {len(self._entries)} files, {self.used / (1024 * 1024):.0f} MB")
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._entries
+
+    def acquire(self, key: str) -> Path | None:
+        """Cached file for key, pinned until release(); None on a miss"""
+        if not self.enabled or key not in self._entries:
+            self.misses += 1
+            return None
+        path = self._entry_file(key)
+        if path is None:
+            self.used -= self._entries.pop(key)
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._entries.move_to_end(key)
+        # mtime carries the LRU order across restarts
+        os.utime(path)
+        self._pins[key] = self._pins.get(key, 0) + 1
+        return path
+
+    @contextlib.contextmanager
+    def staging(self, reserve: int, name: str | None = None) -> Iterator[Path]:
+        """Private directory for one download, removed afterwards; reserve bytes for it in the quota.
+        
+        A named directory is reused if it exists, and kept when the job is
+        cancelled or the bot shuts down so a resumed job can continue from it.
+        """
+        path = self.root / self.STAGING / (name or secrets.token_hex(8))
+        path.mkdir(parents=True, exist_ok=name is not None)
+        self.reserved += reserve
+        self._evict()
+        keep = False
+        try:
+            yield path
+        except BaseException as e:
+            keep = name is not None and (self.keep_staging or not isinstance(e, Exception))
+            raise
+        finally:
+            self.reserved -= reserve
+            if not keep:
+                shutil.rmtree(path, ignore_errors=True)
+
+    def discard_staging(self, name: str) -> None:
+        """Remove a named staging directory left for a job that will not be resumed (blocking)"""
+        shutil.rmtree(self.root / self.STAGING / name, ignore_errors=True)
+
+    def commit(self, key: str, staged: Path) -> Path:
+        """Move a finished download into the cache; the entry is pinned until release()"""
+        entry_dir = self.root / key
+        if key in self._entries:
+            self.used -= self._entries.pop(key)
+        shutil.rmtree(entry_dir, ignore_errors=True)
+        entry_dir.mkdir(parents=True)
+        path = entry_dir / staged.name
+        os.replace(staged, path)
+        size = path.stat().st_size
+        self._entries[key] = size
+        self.used += size
+        self._pins[key] = self._pins.get(key, 0) + 1
+        self._evict()
+        return path
+
+    def release(self, key: str) -> None:
+        """Unpin an entry; with the cache disabled the file is deleted once unused"""
+        pins = self._pins.get(key, 0) - 1
+        if pins > 0:
+            self._pins[key] = pins
+            return
+        self._pins.pop(key, None)
+        if not self.enabled:
+            self._remove(key)
+        else:
+            self._evict()
+
+    def _remove(self, key: str) -> None:
+        self.used -= self._entries.pop(key, 0)
+        shutil.rmtree(self.root / key, ignore_errors=True)
+
+    def _over_limit(self) -> bool:
+        if self.used + self.reserved > self.max_bytes:
+            return True
+        try:
+            return shutil.disk_usage(self.root).free < self.min_free
+        except FileNotFoundError:
+            return False
+
+    def _evict(self) -> None:
+        """Remove least recently used unpinned entries until quota and free space allow"""
+        if not self.enabled:
+            return
+        for key in list(self._entries):
+            if not self._over_limit():
+                return
+            if key not in self._pins:
+                self._remove(key)
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "entries": len(self._entries),
+            "used_mb": round(self.used / (1024 * 1024)),
+            "reserved_mb": round(self.reserved / (1024 * 1024)),
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+download_cache = DownloadCache(DOWNLOAD_CACHE_DIR, DOWNLOAD_CACHE_MAX_BYTES, DOWNLOAD_CACHE_MIN_FREE)
+
+# A local Bot API server started with --local reads files by path instead of receiving them
+# over HTTP. LOCAL_UPLOAD_DIR is a directory the server can read, on the same filesystem as
+# DOWNLOAD_CACHE_DIR so files are hard-linked into it rather than copied;
+# LOCAL_UPLOAD_SERVER_DIR is that directory as the server sees it (e.g. inside its container).
+LOCAL_UPLOAD_DIR = os.getenv("LOCAL_UPLOAD_DIR", "")
+LOCAL_UPLOAD_SERVER_DIR = os.getenv("LOCAL_UPLOAD_SERVER_DIR", "")
+
+class LocalUploader:
+    """Publishes downloaded files to a local Bot API server by path"""
+
+    def __init__(self, directory: Path, server_directory: str):
+        self.directory = directory
+        self.server_directory = server_directory.rstrip("/")
+
+    def sweep(self) -> None:
+        """Remove links left behind by a crash (blocking)"""
+        self.directory.mkdir(parents=True, exist_ok=True)
+        for path in self.directory.iterdir():
+            shutil.rmtree(path, ignore_errors=True)
+
+    @contextlib.contextmanager
+    def publish(self, path: Path) -> Iterator[str | None]:
+        """file:// URI of a hard link to path, removed on exit; None if the file cannot be linked"""
+        link_dir = self.directory / secrets.token_hex(8)
+        try:
+            link_dir.mkdir(parents=True)
+            os.link(path, link_dir / path.name)
+        except OSError as e:
+            logging.warning(f"Cannot link {path} into {self.directory}, uploading over HTTP: {e}")
+            shutil.rmtree(link_dir, ignore_errors=True)
+            yield None
+            return
+        try:
+            yield f"file://{self.server_directory}/{link_dir.name}/{path.name}"
+        finally:
+            shutil.rmtree(link_dir, ignore_errors=True)
+
+local_uploader = LocalUploader(
+    Path(LOCAL_UPLOAD_DIR).resolve(), LOCAL_UPLOAD_SERVER_DIR or str(Path(LOCAL_UPLOAD_DIR).resolve())
+) if bot_api_server and LOCAL_UPLOAD_DIR else None
+
+async def send_media(chat_id: int, media: str | FSInputFile, audio: bool) -> types.Message:
+    if audio:
+        return await bot.send_audio(chat_id, audio=media)
+    return await bot.send_video(chat_id, video=media)
+
+async def send_downloaded_file(chat_id: int, path: Path, audio: bool) -> types.Message:
+    """Upload a local file as audio or video, by path when a local Bot API server can read it"""
+    with track_stage("upload"):
+        if local_uploader is not None:
+            with local_uploader.publish(path) as local_uri:
+                if local_uri is not None:
+                    try:
+                        return await send_media(chat_id, local_uri, audio)
+                    except TelegramBadRequest as e:
+                        # Server not in --local mode or cannot see the directory
+                        logging.warning(f"Upload by path failed, uploading over HTTP: {e}")
+        
+        async with progress_reporter.uploading():
+            return await send_media(chat_id, FSInputFile(path), audio)
+
+async def send_from_download_cache(chat_id: int, url: str, variant: str) -> bool:
+    """Upload a file kept on disk instead of downloading it again; False on a miss"""
+    key = download_cache.key(url, variant)
+    path = download_cache.acquire(key)
+    if download_cache.enabled:
+        cache_lookups.inc(cache="download", result="miss" if path is None else "hit")
+    if path is None:
+        return False
+    try:
+        status_message = await bot.send_message(chat_id, "📤 Відправляю...")
+        try:
+            sent = await send_downloaded_file(chat_id, path, variant == "audio")
+        finally:
+            progress_reporter.forget(status_message)
+            await status_message.delete()
+        remember_file_id(url, variant, sent)
+        mark_job("disk_cache")
+        return True
+    except Exception as e:
+        logging.warning(f"Sending cached download failed, downloading again: {e}")
+        return False
+    finally:
+        download_cache.release(key)
+
+# Every download job is recorded in a SQLite journal until it finishes, so jobs cut off by a
+# restart resume on startup: Cobalt files continue with Range requests from the last
+# checkpoint, yt-dlp continues its .part files, and the user's status message is reused.
+JOB_JOURNAL_PATH = os.getenv("JOB_JOURNAL_PATH", "jobs.db")
+JOB_JOURNAL_MAX_RESUMES = int(os.getenv("JOB_JOURNAL_MAX_RESUMES", "3"))
+JOB_JOURNAL_MAX_AGE = float(os.getenv("JOB_JOURNAL_MAX_AGE", str(24 * 3600)))
+
+# Progress is written at most this often per job (seconds), stage changes always
+JOB_JOURNAL_PROGRESS_INTERVAL = 2.0
+
+# How long shutdown waits for cancelled jobs to save their checkpoints (seconds)
+JOB_JOURNAL_SHUTDOWN_TIMEOUT = 10.0
+
+class JobJournal:
+    """Unfinished download jobs in SQLite: who asked, for what, and how far it got"""
+
+    def __init__(self, path: str):
+        self._db = sqlite3.connect(path, timeout=10)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, chat_id INTEGER NOT NULL, message_id INTEGER NOT NULL, "
+            "source TEXT NOT NULL, url TEXT NOT NULL, variant TEXT NOT NULL, download_key TEXT NOT NULL, "
+            "stage TEXT NOT NULL DEFAULT 'queued', bytes_done INTEGER NOT NULL DEFAULT 0, checkpoint TEXT, "
+            "attempts INTEGER NOT NULL DEFAULT 0, created_at REAL NOT NULL, updated_at REAL NOT NULL)"
+        )
+        self._db.commit()
+        self._last_progress: dict[int, float] = {}
+        # Progress held back by the throttle, written when the job is interrupted
+        self._unsaved: dict[int, tuple[int | None, DownloadCheckpoint | None]] = {}
+        # Live checkpoint of each job, saved again on interruption since it moves between updates
+        self._checkpoints: dict[int, DownloadCheckpoint] = {}
+        # Set on shutdown: jobs interrupted from then on stay in the journal
+        self.frozen = False
+        self._tasks: dict[int, asyncio.Task[Any]] = {}
+
+    def add(self, chat_id: int, message_id: int, source: str, url: str, variant: str) -> int:
+        now = time.time()
+        cursor = self._db.execute(
+            "INSERT INTO jobs (chat_id, message_id, source, url, variant, download_key, created_at, updated_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (chat_id, message_id, source, url, variant, download_cache.key(url, variant), now, now)
+        )
+        self._db.commit()
+        return cursor.lastrowid or 0
+
+    def update(
+        self,
+        job_id: int,
+        stage: str | None = None,
+        bytes_done: int | None = None,
+        checkpoint: DownloadCheckpoint | None = None
+    ) -> None:
+        """Record a stage change right away, progress at most every JOB_JOURNAL_PROGRESS_INTERVAL"""
+        if checkpoint is not None:
+            self._checkpoints[job_id] = checkpoint
+            if checkpoint.total is not None:
+                # What a resume will skip, not what was received: buffered bytes are lost on a crash
+                bytes_done = checkpoint.done
+        now = time.monotonic()
+        if stage is None:
+            if now - self._last_progress.get(job_id, 0.0) < JOB_JOURNAL_PROGRESS_INTERVAL:
+                self._unsaved[job_id] = (bytes_done, checkpoint)
+                return
+            self._last_progress[job_id] = now
+        self._unsaved.pop(job_id, None)
+        self._db.execute(
+            "UPDATE jobs SET stage = COALESCE(?, stage), bytes_done = COALESCE(?, bytes_done), "
+            "checkpoint = COALESCE(?, checkpoint), updated_at = ? WHERE id = ?",
+            (stage, bytes_done, checkpoint.to_json() if checkpoint else None, time.time(), job_id)
+        )
+        self._db.commit()
+
+    def checkpoint(self, download_key: str) -> DownloadCheckpoint:
+        """Latest checkpoint of any job for this download; jobs sharing a download save it under the one that ran"""
+        row = self._db.execute(
+            "SELECT checkpoint FROM jobs WHERE download_key = ? AND checkpoint IS NOT NULL "
+            "ORDER BY updated_at DESC LIMIT 1", (download_key,)
+        ).fetchone()
+        return DownloadCheckpoint.from_json(row[0] if row else None)
+
+    def save(self, job_id: int) -> None:
+        """Write progress the throttle held back, so a resumed job starts from the latest checkpoint"""
+        bytes_done, checkpoint = self._unsaved.pop(job_id, (None, self._checkpoints.get(job_id)))
+        self._last_progress.pop(job_id, None)
+        if bytes_done is not None or checkpoint is not None:
+            self.update(job_id, bytes_done=bytes_done, checkpoint=checkpoint)
+        self._last_progress.pop(job_id, None)
+        self._checkpoints.pop(job_id, None)
+
+    def finish(self, job_id: int) -> None:
+        if self.frozen:
+            # Shutting down: the job was cut off, keep it for the next start
+            self.save(job_id)
+            return
+        self._last_progress.pop(job_id, None)
+        self._unsaved.pop(job_id, None)
+        self._checkpoints.pop(job_id, None)
+        self._db.execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+        self._db.commit()
+
+    def unfinished(self) -> list[dict[str, Any]]:
+        self._db.row_factory = sqlite3.Row
+        try:
+            return [dict(row) for row in self._db.execute("SELECT * FROM jobs ORDER BY id")]
+        finally:
+            self._db.row_factory = None
+
+    def resumed(self, job_id: int, message_id: int) -> None:
+        """Count a resume attempt and point the job at its current status message"""
+        self._db.execute(
+            "UPDATE jobs SET attempts = attempts + 1, message_id = ?, updated_at = ? WHERE id = ?",
+            (message_id, time.time(), job_id)
+        )
+        self._db.commit()
+
+    @contextlib.contextmanager
+    def running(self, job_id: int) -> Iterator[None]:
+        """Run a job under its journal row; the row goes once the job ends, unless it was interrupted"""
+        token = current_journal_job.set(job_id)
+        task = asyncio.current_task()
+        if task is not None:
+            self._tasks[job_id] = task
+        try:
+            yield
+        except Exception:
+            self.finish(job_id)
+            raise
+        except BaseException:
+            self.save(job_id)
+            raise
+        else:
+            self.finish(job_id)
+        finally:
+            self._tasks.pop(job_id, None)
+            current_journal_job.reset(token)
+
+    async def interrupt(self) -> None:
+        """Freeze the journal, cancel running jobs and wait for them to save where they stopped"""
+        self.frozen = True
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            await asyncio.wait(tasks, timeout=JOB_JOURNAL_SHUTDOWN_TIMEOUT)
+            logging.info(f"Job journal: {len(tasks)} running jobs interrupted for the next start")
+
+job_journal = JobJournal(JOB_JOURNAL_PATH) if JOB_JOURNAL_PATH else None
+
+@contextlib.contextmanager
+def journaled(chat_id: int, message_id: int, source: str, url: str, variant: str) -> Iterator[None]:
+    """Record a job started by a user in the journal while it runs"""
+    if job_journal is None:
+        yield
+        return
+    with job_journal.running(job_journal.add(chat_id, message_id, source, url, variant)):
+        yield
+
+def job_interrupted() -> bool:
+    """Whether the current job failed because of shutdown; it resumes later, so its error is not shown"""
+    return job_journal is not None and job_journal.frozen and current_journal_job.get() is not None
+
+def journal_progress(bytes_done: int, checkpoint: DownloadCheckpoint | None = None) -> None:
+    """Note how far the current job's download got"""
+    job_id = current_journal_job.get()
+    if job_journal is not None and job_id is not None:
+        job_journal.update(job_id, bytes_done=bytes_done, checkpoint=checkpoint)
+
+def journal_checkpoint(download_key: str) -> DownloadCheckpoint:
+    """Checkpoint saved by an interrupted run of this download, empty for a new one"""
+    if job_journal is None or current_journal_job.get() is None:
+        return DownloadCheckpoint()
+    return job_journal.checkpoint(download_key)
+
+# Speculative prefetch: while a preview is shown, the option users pick most often is
+# downloaded ahead of the click. PREFETCH_MAX_BYTES caps the bytes being fetched this way.
+PREFETCH = os.getenv("PREFETCH", "0") == "1"
+PREFETCH_MAX_BYTES = int(os.getenv("PREFETCH_MAX_BYTES", str(1024 * 1024 * 1024)))
+PREFETCH_MIN_SHARE = float(os.getenv("PREFETCH_MIN_SHARE", "0.5"))
+PREFETCH_TTL = min(float(os.getenv("PREFETCH_TTL", "300")), CALLBACK_TTL)
+
+# Clicks needed before the stats are trusted over the first offered option
+PREFETCH_MIN_CLICKS = 20
+
+class ClickStats:
+    """How often each preview option gets picked, per source"""
+
+    def __init__(self):
+        self._counts: dict[str, dict[str, int]] = {}
+
+    def record(self, source: str, variant: str) -> None:
+        counts = self._counts.setdefault(source, {})
+        counts[variant] = counts.get(variant, 0) + 1
+
+    def favourite(self, source: str, options: list[str]) -> str | None:
+        """Option worth prefetching, None if no option is picked often enough"""
+        if not options:
+            return None
+        counts = self._counts.get(source, {})
+        total = sum(counts.get(option, 0) for option in options)
+        if total < PREFETCH_MIN_CLICKS:
+            return options[0]
+        best = max(options, key=lambda option: counts.get(option, 0))
+        return best if counts.get(best, 0) / total >= PREFETCH_MIN_SHARE else None
+
+class Prefetch:
+    """Download started for a preview before the user picked anything"""
+
+    def __init__(self, url: str, variant: str, reserved: int):
+        self.url = url
+        self.variant = variant
+        self.reserved = reserved
+        # Nobody watches the progress until the user picks this option
+        self.status = SharedStatus()
+        self.ready: asyncio.Future[Path | None] = asyncio.get_event_loop().create_future()
+        self.task: asyncio.Task[None] | None = None
+        self.timer: asyncio.TimerHandle | None = None
+
+class Prefetcher:
+    """Runs speculative downloads for shown previews, keyed by preview id.
+    
+    A prefetch is cancelled when the user picks another option, gets the file
+    from a cache, cancels the preview or it expires; a finished file stays
+    pinned in the download cache until then.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.reserved = 0
+        self.clicks = ClickStats()
+        self._prefetches: dict[str, Prefetch] = {}
+
+    def start(
+        self,
+        video_id: str,
+        source: str,
+        url: str,
+        options: list[str],
+        fetch: Callable[[Prefetch, Path], Awaitable[Path | None]],
+        size: Callable[[str], int | None] | None = None
+    ) -> None:
+        """Prefetch the favourite option if the budget and idle download slots allow.
         
-        # Reset progress data for new download
-        progress_data['downloaded'] = 0
-        progress_data['total'] = 0
+        The download runs on a borrowed scheduler slot, so real jobs that
+        need it cancel the prefetch. Without size, fetch must call reserve()
+        once it learns the size.
+        """
+        variant = self.clicks.favourite(source, options)
+        if variant is None or video_id in self._prefetches:
+            return
+        # Real downloads come first
+        if download_scheduler.queued or download_scheduler.active >= download_scheduler.max_active:
+            return
+        if download_cache.key(url, variant) in download_cache:
+            return
+        if file_id_cache is not None and file_id_cache.contains(canonicalize_url(url), variant):
+            return
         
-        # Start new progress updater
-        progress_task = asyncio.create_task(update_progress())
+        reserved = 0
+        if size is not None:
+            expected = size(variant)
+            if expected is None or self.reserved + expected > self.max_bytes:
+                return
+            reserved = expected
         
+        prefetch = Prefetch(url, variant, reserved)
+        self.reserved += reserved
+        self._prefetches[video_id] = prefetch
+        prefetch.task = asyncio.create_task(self._run(prefetch, fetch))
+        prefetch.task.add_done_callback(lambda _: self._finished(video_id, prefetch))
+        prefetch.timer = asyncio.get_running_loop().call_later(PREFETCH_TTL, self.cancel, video_id)
+
+    def reserve(self, prefetch: Prefetch, size: int) -> None:
+        """Set a prefetch's share of the budget; raises FileTooLargeError if it does not fit"""
+        if self.reserved - prefetch.reserved + size > self.max_bytes:
+            raise FileTooLargeError(size)
+        self.reserved += size - prefetch.reserved
+        prefetch.reserved = size
+
+    def cancel(self, video_id: str) -> None:
+        """Drop the prefetch for a preview, releasing its file"""
+        prefetch = self._prefetches.pop(video_id, None)
+        if prefetch is not None and prefetch.task is not None:
+            prefetch.task.cancel()
+
+    def _finished(self, video_id: str, prefetch: Prefetch) -> None:
+        # Runs even for a task cancelled before it started
+        self.reserved -= prefetch.reserved
+        prefetch.reserved = 0
+        if not prefetch.ready.done():
+            prefetch.ready.cancel()
+        if prefetch.timer is not None:
+            prefetch.timer.cancel()
+        if self._prefetches.get(video_id) is prefetch:
+            del self._prefetches[video_id]
+
+    async def _run(self, prefetch: Prefetch, fetch: Callable[[Prefetch, Path], Awaitable[Path | None]]) -> None:
+        key = download_cache.key(prefetch.url, prefetch.variant)
+        committed = False
         try:
-            ydl_opts['format'] = 'best[height<=480][ext=mp4]/best[height<=480]/best[height<=360]'
-            
-            def download_lower():
-                with yt_dlp.YoutubeDL(ydl_opts) as ydl:  # type: ignore
-                    info = ydl.extract_info(url, download=True)
-                    return Path(ydl.prepare_filename(info))
-            
-            video_filename = await loop.run_in_executor(None, download_lower)
+            async with download_scheduler.spare_slot() as idle:
+                if not idle:
+                    return
+                staging_reserve = prefetch.reserved or (MAX_FILE_SIZE if prefetch.variant == "audio" else VIDEO_STAGING_RESERVE)
+                with download_cache.staging(staging_reserve) as staging_dir:
+                    with track_stage("prefetch"):
+                        path = await fetch(prefetch, staging_dir)
+                    if path is not None:
+                        path = download_cache.commit(key, path)
+                        committed = True
+            self.reserved -= prefetch.reserved
+            prefetch.reserved = 0
+            prefetch.ready.set_result(path)
+            # Hold the file until the user picks it or the preview goes away
+            await asyncio.Event().wait()
+        except Exception as e:
+            logging.info(f"Prefetch of {prefetch.url} ({prefetch.variant}) failed: {e}")
+            if not prefetch.ready.done():
+                prefetch.ready.set_result(None)
         finally:
-            progress_task.cancel()
-            try:
-                await progress_task
-            except asyncio.CancelledError:
-                pass
+            if committed:
+                download_cache.release(key)
+
+    def picked(self, video_id: str, source: str, variant: str) -> None:
+        """Count a click and drop a prefetch of another option"""
+        self.clicks.record(source, variant)
+        prefetch = self._prefetches.get(video_id)
+        if prefetch is not None and prefetch.variant != variant:
+            self.cancel(video_id)
+
+    async def deliver(self, video_id: str, variant: str, chat_id: int, status_message: types.Message) -> bool:
+        """Send the prefetched file for the option the user picked.
         
-        file_size = video_filename.stat().st_size
+        Waits for a prefetch that is still running, showing its progress in
+        status_message. Returns False when the download has to run normally.
+        """
+        prefetch = self._prefetches.get(video_id)
+        if prefetch is None or prefetch.variant != variant:
+            return False
         
-        # If still too large, inform user
-        if file_size > max_file_size:
-            video_filename.unlink()
-            limit_text = "2 ГБ" if bot_api_server else "50 МБ"
-            await status_message.edit_text(
-                f"❌ Відео занадто велике ({file_size / (1024 * 1024):.1f} МБ).\n\n"
-                f"Ліміт Telegram: {limit_text}. Спробуйте коротше відео."
-            )
-            return None
+        await prefetch.status.attach(status_message)
+        if prefetch.task is not None:
+            download_scheduler.adopt(prefetch.task)
+        try:
+            path = await asyncio.shield(prefetch.ready)
+        except asyncio.CancelledError:
+            if prefetch.ready.cancelled():
+                # Expired while we were waiting
+                return False
+            raise
+        if path is None:
+            self.cancel(video_id)
+            return False
+        
+        try:
+            await prefetch.status.edit_text("📤 Відправляю аудіо..." if variant == "audio" else "📤 Відправляю відео...")
+            sent = await send_downloaded_file(chat_id, path, variant == "audio")
+            remember_file_id(prefetch.url, variant, sent)
+            mark_job("prefetch")
+            return True
+        except Exception as e:
+            logging.warning(f"Sending prefetched download failed, downloading again: {e}")
+            return False
+        finally:
+            self.cancel(video_id)
+
+prefetcher = Prefetcher(PREFETCH_MAX_BYTES) if PREFETCH else None
+
+def youtube_expected_size(info: dict[str, Any], quality: str) -> int | None:
+    """Size of the format a YouTube download for quality would fetch, None if unknown"""
+    planned = plan_youtube_format(info, quality, MAX_FILE_SIZE)
+    return next((size for f, size in youtube_format_candidates(info, quality) if f["format_id"] == planned), None)
+
+async def fetch_youtube(
+    url: str,
+    quality: str,
+    info: dict[str, Any] | None,
+    status_message: SharedStatus,
+    staging_dir: Path
+) -> Path | None:
+    """Download a YouTube video or its audio into staging_dir; None if it was refused (status already says why)"""
+    if quality != "audio":
+        return await download_youtube_video(url, status_message, staging_dir, quality, info)
     
-    return video_filename
+    # Pick an audio format that fits the limit up front when sizes are known
+    audio_format = plan_youtube_format(info, quality, MAX_FILE_SIZE) if info else YOUTUBE_FORMATS["audio"]
+    if audio_format is None:
+        await status_message.edit_text(too_large_text(smallest_format_size(info or {}, quality)))
+        return None
+    
+    outtmpl = str(staging_dir / '%(title)s.%(ext)s')
+    started = time.monotonic()
+    with track_stage("download"):
+        media_path = await ytdlp_runner.download(url, audio_format, outtmpl, info)
+    record_download("youtube", media_path.stat().st_size, time.monotonic() - started)
+    return media_path
 
-async def download_with_cobalt(url: str) -> dict[str, Any]:
-    """Download video using Cobalt API"""
-    headers = {
-        "Accept": "application/json",
-        "Content-Type": "application/json",
-        "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36"
-    }
+# Cobalt tunnels sit behind Cloudflare, which wants a browser-like request
+COBALT_FILE_HEADERS = {
+    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36",
+    "Accept": "*/*",
+    "Referer": COBALT_API_URL
+}
+
+def cobalt_file_headers(result: dict[str, Any]) -> dict[str, str]:
+    """Headers for fetching the files of a Cobalt answer, from the instance that gave it"""
+    return {**COBALT_FILE_HEADERS, "Referer": result.get("instance", COBALT_API_URL)}
+
+async def prefetch_cobalt(url: str, prefetch: Prefetch, staging_dir: Path) -> Path | None:
+    """Resolve and download a Cobalt file ahead of the click; None if there is no single file to fetch"""
+    audio = prefetch.variant == "audio"
+    result = await download_with_cobalt(url, download_mode="audio" if audio else "auto")
+    download_url = result.get("url")
+    if result.get("status") not in ("tunnel", "redirect") or not download_url:
+        return None
     
-    # Add authentication if available
-    if COBALT_API_KEY:
-        headers["Authorization"] = f"Api-Key {COBALT_API_KEY}"
-    else:
-        # Try to get JWT token
-        jwt_token = await get_jwt_token(COBALT_API_URL)
-        if jwt_token:
-            headers["Authorization"] = f"Bearer {jwt_token}"
+    async def report_progress(downloaded: int, total_size: int) -> None:
+        prefetch.status.report(f"⏬ Завантажую файл...\n\n{progress_bar(downloaded, total_size)}")
     
-    payload = {
-        "url": url,
-        "videoQuality": "max",
-        "filenameStyle": "basic",
-        "downloadMode": "auto"
-    }
+    def reserve(size: int) -> None:
+        if prefetcher is not None:
+            prefetcher.reserve(prefetch, size)
     
-    async with aiohttp.ClientSession() as session:
-        async with session.post(f"{COBALT_API_URL}/", headers=headers, json=payload) as response:
-            response_text = await response.text()
-            
-            if response.status != 200:
-                logging.error(f"Cobalt API error {response.status}: {response_text}")
-                raise Exception(f"Cobalt API error: {response.status} - {response_text[:200]}")
-            
+    file_path = staging_dir / Path(result.get("filename", "audio.m4a" if audio else "video.mp4")).name
+    started = time.monotonic()
+    with track_stage("download"):
+        size = await download_http_file(
+            download_url, file_path, cobalt_file_headers(result),
+            MAX_FILE_SIZE if audio else VIDEO_SOURCE_MAX_SIZE, report_progress, on_size=reserve
+        )
+    record_download("cobalt", size, time.monotonic() - started)
+    return file_path if audio else await fit_video(file_path, prefetch.status)
+
+# Picker (carousel/slideshow) delivery
+PICKER_MAX_ITEMS = int(os.getenv("PICKER_MAX_ITEMS", "50"))
+PICKER_FETCH_CONCURRENCY = int(os.getenv("PICKER_FETCH_CONCURRENCY", "5"))
+MEDIA_GROUP_SIZE = 10  # Telegram limit for one album
+PICKER_PHOTO_MAX_SIZE = 10 * 1024 * 1024  # Telegram limit for photos
+
+PickerMedia = InputMediaPhoto | InputMediaVideo
+
+async def fetch_picker_photo(url: str, headers: dict[str, str]) -> bytes:
+    """Read a photo into memory, stopping as soon as it passes the photo limit"""
+    session = get_http_session()
+    async with session.get(url, headers=headers) as response:
+        if response.status != 200:
+            raise Exception(f"HTTP {response.status}")
+        if (response.content_length or 0) > PICKER_PHOTO_MAX_SIZE:
+            raise FileTooLargeError(response.content_length or 0)
+        # Tunnels often have no Content-Length, so the limit is checked while reading
+        data = bytearray()
+        async for chunk in response.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+            data += chunk
+            if len(data) > PICKER_PHOTO_MAX_SIZE:
+                raise FileTooLargeError(len(data))
+        return bytes(data)
+
+async def fetch_picker_item(
+    item: dict[str, Any],
+    index: int,
+    semaphore: asyncio.Semaphore,
+    staging_dir: Path,
+    headers: dict[str, str]
+) -> PickerMedia | None:
+    """Download one picker item, falling back to letting Telegram fetch the URL.
+    
+    Photos are kept in memory, videos are streamed to staging_dir.
+    """
+    item_url = item.get("url")
+    if not item_url:
+        return None
+    
+    is_photo = item.get("type") == "photo"
+    video_path = staging_dir / f"{index}.mp4"
+    try:
+        async with semaphore:
+            if is_photo:
+                data = await fetch_picker_photo(item_url, headers)
+            else:
+                await download_http_file(item_url, video_path, headers, MAX_FILE_SIZE)
+    except Exception as e:
+        logging.warning(f"Could not fetch picker item {index}, sending by URL: {e}")
+        video_path.unlink(missing_ok=True)
+        if is_photo:
+            return InputMediaPhoto(media=item_url)
+        return InputMediaVideo(media=URLInputFile(item_url))
+    
+    if is_photo:
+        return InputMediaPhoto(media=BufferedInputFile(data, filename=f"{index}.jpg"))
+    return InputMediaVideo(media=FSInputFile(video_path))
+
+async def send_single_media(chat_id: int, media: PickerMedia) -> None:
+    if isinstance(media, InputMediaPhoto):
+        await bot.send_photo(chat_id, photo=media.media)
+    else:
+        await bot.send_video(chat_id, video=media.media)
+
+async def send_album(chat_id: int, media: list[PickerMedia]) -> None:
+    """Send items as one album, item by item if the album is rejected"""
+    if not media:
+        return
+    
+    async with progress_reporter.uploading():
+        if len(media) > 1:
             try:
-                return await response.json()
+                await bot.send_media_group(chat_id, media=media)
+                return
             except Exception as e:
-                logging.error(f"Failed to parse JSON response: {response_text}")
-                raise Exception(f"Invalid JSON response from Cobalt API")
+                logging.error(f"Error sending album, sending items one by one: {e}")
+        
+        for item in media:
+            try:
+                await send_single_media(chat_id, item)
+            except Exception as e:
+                logging.error(f"Error sending picker item: {e}")
+
+def remove_picker_files(media: list[PickerMedia]) -> None:
+    """Delete the staged video files of an album that has been sent (blocking)"""
+    for item in media:
+        if isinstance(item.media, FSInputFile):
+            Path(item.media.path).unlink(missing_ok=True)
+
+async def send_picker_items(chat_id: int, picker_items: list[dict[str, Any]], headers: dict[str, str]) -> None:
+    """Send picker items as albums of up to 10.
+    
+    Items are fetched concurrently; the next album is fetched while the
+    current one is being sent, so at most two albums are held at a time:
+    photos in memory, videos on disk until their album is sent.
+    """
+    semaphore = asyncio.Semaphore(PICKER_FETCH_CONCURRENCY)
+    items = picker_items[:PICKER_MAX_ITEMS]
+    chunks = [list(enumerate(items))[i:i + MEDIA_GROUP_SIZE] for i in range(0, len(items), MEDIA_GROUP_SIZE)]
+    loop = asyncio.get_running_loop()
+    
+    # Carousel videos are short, so one file's worth of quota is reserved as for a single download
+    with download_cache.staging(MAX_FILE_SIZE) as staging_dir:
+        def start(chunk: list[tuple[int, dict[str, Any]]]) -> list[asyncio.Task[PickerMedia | None]]:
+            return [
+                asyncio.create_task(fetch_picker_item(item, index, semaphore, staging_dir, headers))
+                for index, item in chunk
+            ]
+        
+        next_tasks = start(chunks[0]) if chunks else []
+        try:
+            for chunk_idx in range(len(chunks)):
+                tasks = next_tasks
+                next_tasks = start(chunks[chunk_idx + 1]) if chunk_idx + 1 < len(chunks) else []
+                media = [item for item in await asyncio.gather(*tasks) if item is not None]
+                await send_album(chat_id, media)
+                await loop.run_in_executor(file_io_executor, remove_picker_files, media)
+        finally:
+            for task in next_tasks:
+                task.cancel()
+            # Let cancelled downloads close their files before the staging directory goes
+            await asyncio.gather(*next_tasks, return_exceptions=True)
 
 # /start handler
 @dp.message(Command("start"))
@@ -339,6 +3343,23 @@ async def cmd_start(message: types.Message):
     )
     await message.answer(welcome_text)
 
+@dp.message(Command("cobalt_status"), F.from_user.id.in_(ADMIN_IDS))
+async def cmd_cobalt_status(message: types.Message):
+    """Show per-instance Cobalt statistics to admins"""
+    lines = ["🛰 Cobalt інстанси:\n"]
+    for stats in cobalt_pool.stats():
+        state = "✅" if stats["available"] else "⛔"
+        latency = f"{stats['latency_ms']} мс" if stats["latency_ms"] is not None else "—"
+        lines.append(
+            f"{state} {stats['url']}\n"
+            f"   затримка: {latency}, запитів: {stats['requests']}, помилок: {stats['errors']} "
+            f"({stats['error_rate'] * 100:.0f}% нещодавно)\n"
+            f"   перевірок: {stats['probes']}, невдалих: {stats['probe_failures']}"
+        )
+        if stats["last_error"]:
+            lines.append(f"   остання помилка: {stats['last_error'][:100]}")
+    await message.answer("\n".join(lines), disable_web_page_preview=True)
+
 # Universal video handler - detects URLs and downloads using Cobalt or yt-dlp
 @dp.message(F.text.regexp(r'https?://'))
 async def video_handler(message: types.Message):
@@ -385,22 +3406,29 @@ async def video_handler(message: types.Message):
         )
         
         # Generate unique video ID and store URL
-        import hashlib
         video_id = hashlib.md5(url.encode()).hexdigest()[:16]
-        video_url_storage[video_id] = url
+        video_url_storage.set(video_id, url)
+        
+        # Keep extracted info so the download does not extract it again
+        youtube_info_cache.set(video_id, video_info)
         
-        # Create quality selection buttons
+        # Create quality selection buttons, only for qualities that fit the limit
+        quality_labels = {"720": "🎥 720p", "480": "📹 480p", "360": "📱 360p", "audio": "🎵 Audio"}
+        qualities = fitting_qualities(video_info, MAX_FILE_SIZE)
+        quality_buttons = [
+            InlineKeyboardButton(text=quality_labels[quality], callback_data=VideoDownload(quality=quality, video_id=video_id).pack())
+            for quality in qualities
+        ]
+        if not quality_buttons:
+            limit_text = "2 ГБ" if bot_api_server else "50 МБ"
+            preview_text = preview_text.replace(
+                "Оберіть якість завантаження:",
+                f"❌ Відео занадто велике для Telegram (ліміт {limit_text})."
+            )
         keyboard = InlineKeyboardMarkup(inline_keyboard=[
+            *(quality_buttons[i:i + 2] for i in range(0, len(quality_buttons), 2)),
             [
-                InlineKeyboardButton(text="🎥 720p", callback_data=VideoDownload(quality="720", video_id=video_id).pack()),
-                InlineKeyboardButton(text="📹 480p", callback_data=VideoDownload(quality="480", video_id=video_id).pack()),
-            ],
-            [
-                InlineKeyboardButton(text="📱 360p", callback_data=VideoDownload(quality="360", video_id=video_id).pack()),
-                InlineKeyboardButton(text="🎵 Audio", callback_data=VideoDownload(quality="audio", video_id=video_id).pack()),
-            ],
-            [
-                InlineKeyboardButton(text="❌ Скасувати", callback_data="cancel")
+                InlineKeyboardButton(text="❌ Скасувати", callback_data=CancelPreview(video_id=video_id).pack())
             ]
         ])
         
@@ -420,6 +3448,14 @@ async def video_handler(message: types.Message):
         else:
             await status_message.edit_text(preview_text, reply_markup=keyboard, parse_mode="HTML")
         
+        # Start on the likely pick while the user is choosing
+        if prefetcher is not None:
+            prefetcher.start(
+                video_id, "youtube", url, qualities,
+                lambda prefetch, staging_dir: fetch_youtube(url, prefetch.variant, video_info, prefetch.status, staging_dir),
+                lambda quality: youtube_expected_size(video_info, quality)
+            )
+        
         return
     
 
@@ -441,27 +3477,15 @@ async def video_handler(message: types.Message):
         picker_items = result.get("picker", [])
         await status_message.edit_text(f"🎬 Знайдено {len(picker_items)} елементів. Завантажую...")
         
-        for item in picker_items[:10]:  # Limit to 10 items
-            item_url = item.get("url")
-            if item_url:
-                try:
-                    if item.get("type") == "photo":
-                        await message.answer_photo(photo=item_url)
-                    else:
-                        await message.answer_video(video=URLInputFile(item_url))
-                except Exception as e:
-                    logging.error(f"Error sending picker item: {e}")
-                    continue
-        
+        await send_picker_items(message.chat.id, picker_items, cobalt_file_headers(result))
         await status_message.delete()
         return
     
     # For single video, show preview
     if status in ["tunnel", "redirect"]:
         # Generate unique video ID and store URL
-        import hashlib
         video_id = hashlib.md5(url.encode()).hexdigest()[:16]
-        video_url_storage[video_id] = url
+        video_url_storage.set(video_id, url)
         
         # Try to get thumbnail from result
         thumbnail = result.get("thumbnail")
@@ -483,7 +3507,7 @@ async def video_handler(message: types.Message):
                 InlineKeyboardButton(text="🎵 Тільки аудіо", callback_data=CobaltDownload(action="audio", video_id=video_id).pack()),
             ],
             [
-                InlineKeyboardButton(text="❌ Скасувати", callback_data="cancel")
+                InlineKeyboardButton(text="❌ Скасувати", callback_data=CancelPreview(video_id=video_id).pack())
             ]
         ])
         
@@ -502,6 +3526,13 @@ async def video_handler(message: types.Message):
         else:
             await status_message.edit_text(preview_text, reply_markup=keyboard, parse_mode="HTML")
         
+        # Start on the likely pick while the user is choosing
+        if prefetcher is not None:
+            prefetcher.start(
+                video_id, "cobalt", url, ["download", "audio"],
+                lambda prefetch, staging_dir: prefetch_cobalt(url, prefetch, staging_dir)
+            )
+        
         return
     
     # Handle errors
@@ -513,32 +3544,11 @@ async def video_handler(message: types.Message):
     # Unsupported status
     await status_message.edit_text(f"❌ Непідтримуваний тип: {status}")
 
-@dp.callback_query(CobaltDownload.filter())
-async def cobalt_callback_handler(callback: types.CallbackQuery, callback_data: CobaltDownload):
-    """Handle Cobalt download callback"""
-    await callback.answer()
-    
-    action = callback_data.action
-    video_id = callback_data.video_id
-    
-    # Retrieve URL from storage
-    url = video_url_storage.get(video_id)
-    if not url:
-        await callback.answer("❌ Посилання застаріло. Надішліть його знову.", show_alert=True)
-        if callback.message and hasattr(callback.message, 'delete'):
-            await callback.message.delete()  # type: ignore
-        return
-    
-    # Delete preview message
-    if callback.message and hasattr(callback.message, 'delete'):
-        await callback.message.delete()  # type: ignore
-    
-    # Send status message
-    status_message = await bot.send_message(
-        callback.from_user.id,
-        "⚡ Завантажую відео..."
-    )
+async def run_cobalt_job(chat_id: int, url: str, action: str, status_message: types.Message) -> bool:
+    """Resolve a link through Cobalt and deliver the file, reporting in status_message.
     
+    Returns True once the preview's stored URL is no longer needed.
+    """
     try:
         # Get download info from Cobalt API
         result = await download_with_cobalt(url)
@@ -546,157 +3556,151 @@ async def cobalt_callback_handler(callback: types.CallbackQuery, callback_data:
         
         if status == "error":
             error_code = result.get("error", {}).get("code", "unknown")
-            await status_message.edit_text(f"❌ Помилка: {error_code}\n\nПеревірте посилання та спробуйте ще раз.")
-            return
+            await progress_reporter.edit(status_message, f"❌ Помилка: {error_code}\n\nПеревірте посилання та спробуйте ще раз.")
+            return False
         
         if status == "picker":
             # Multiple items (like Instagram carousel or TikTok slideshow)
             picker_items = result.get("picker", [])
-            await status_message.edit_text(f"� Знайдено {len(picker_items)} елементів. Завантажую...")
-            
-            for item in picker_items[:10]:  # Limit to 10 items
-                item_url = item.get("url")
-                if item_url:
-                    try:
-                        if item.get("type") == "photo":
-                            await bot.send_photo(callback.from_user.id, photo=item_url)
-                        else:
-                            await bot.send_video(callback.from_user.id, video=URLInputFile(item_url))
-                    except Exception as e:
-                        logging.error(f"Error sending picker item: {e}")
-                        continue
+            await progress_reporter.edit(status_message, f"� Знайдено {len(picker_items)} елементів. Завантажую...")
             
+            await send_picker_items(chat_id, picker_items, cobalt_file_headers(result))
+            mark_job("sent")
             await status_message.delete()
-            return
+            return False
         
         if status in ["tunnel", "redirect"]:
             # Check if user wants audio only
             if action == "audio":
-                # Re-request with audio quality
-                audio_result = await download_with_cobalt(url)
+                # Re-request in audio mode
+                audio_result = await download_with_cobalt(url, download_mode="audio")
                 download_url = audio_result.get("url")
-                filename = "audio.m4a"
+                filename = audio_result.get("filename", "audio.m4a")
+                file_headers = cobalt_file_headers(audio_result)
             else:
                 # Single video/audio file
                 download_url = result.get("url")
                 filename = result.get("filename", "video.mp4")
+                file_headers = cobalt_file_headers(result)
             
             if not download_url:
-                await status_message.edit_text("❌ Не вдалося отримати посилання на завантаження.")
-                return
+                await progress_reporter.edit(status_message, "❌ Не вдалося отримати посилання на завантаження.")
+                return False
             
-            # Download file through server to bypass Cloudflare protection
-            file_path = None
-            try:
-                await status_message.edit_text("📥 Завантажую файл...")
-                
-                downloads_dir = Path("downloads")
-                downloads_dir.mkdir(exist_ok=True)
-                file_path = downloads_dir / filename
-                
-                # Download file with proper headers
-                headers = {
-                    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36",
-                    "Accept": "*/*",
-                    "Referer": COBALT_API_URL
-                }
-                
-                async with aiohttp.ClientSession() as session:
-                    async with session.get(download_url, headers=headers) as response:
-                        if response.status != 200:
-                            raise Exception(f"Failed to download: HTTP {response.status}")
-                        
-                        # Check file size
-                        content_length = response.headers.get("Content-Length")
-                        total_size = int(content_length) if content_length else 0
-                        
-                        if total_size > 0 and total_size > MAX_FILE_SIZE:
+            async def fetch_and_send(shared_status: SharedStatus) -> types.Message | None:
+                """Download file through server to bypass Cloudflare protection and send it"""
+                cache_key = download_cache.key(url, action)
+                cached_path = None
+                try:
+                    await shared_status.edit_text("📥 Завантажую файл...")
+                    
+                    # Ranges still missing from a run cut off by a restart, if any
+                    checkpoint = journal_checkpoint(cache_key)
+                    
+                    async def report_progress(downloaded: int, total_size: int) -> None:
+                        progress_text = f"⏬ Завантажую файл...\n\n{progress_bar(downloaded, total_size)}"
+                        shared_status.report(progress_text)
+                        journal_progress(downloaded, checkpoint)
+                    
+                    # Download file with progress, in parallel ranges when possible
+                    audio = action == "audio"
+                    with download_cache.staging(MAX_FILE_SIZE if audio else VIDEO_STAGING_RESERVE, cache_key) as staging_dir:
+                        file_path = staging_dir / Path(filename).name
+                        try:
+                            started = time.monotonic()
+                            with track_stage("download"):
+                                size = await download_http_file(
+                                    download_url, file_path, file_headers,
+                                    MAX_FILE_SIZE if audio else VIDEO_SOURCE_MAX_SIZE, report_progress,
+                                    checkpoint=checkpoint
+                                )
+                            record_download("cobalt", size, time.monotonic() - started)
+                            if not audio:
+                                fitted = await fit_video(file_path, shared_status)
+                                if fitted is None:
+                                    raise FileTooLargeError(size)
+                                file_path = fitted
+                        except FileTooLargeError as e:
                             limit_text = "2 ГБ" if bot_api_server else "50 МБ"
-                            await status_message.edit_text(
-                                f"⚠️ Відео занадто велике ({total_size / (1024 * 1024):.1f} МБ).\n\n"
+                            await shared_status.edit_text(
+                                f"⚠️ Відео занадто велике ({e.size / (1024 * 1024):.1f} МБ).\n\n"
                                 f"Ліміт Telegram: {limit_text}. Ось пряме посилання:\n"
                                 f"📥 [Завантажити відео]({download_url})",
                                 parse_mode="Markdown",
                                 disable_web_page_preview=True
                             )
-                            return
-                        
-                        # Download file with progress
-                        downloaded = 0
-                        last_update = 0.0
-                        
-                        with open(file_path, "wb") as f:
-                            async for chunk in response.content.iter_chunked(8192):
-                                f.write(chunk)
-                                downloaded += len(chunk)
-                                
-                                # Update progress every 2 seconds
-                                current_time = asyncio.get_event_loop().time()
-                                if total_size > 0 and current_time - last_update >= 0.5:
-                                    last_update = current_time
-                                    progress_text = f"⏬ Завантажую файл...\n\n{progress_bar(downloaded, total_size)}"
-                                    try:
-                                        await status_message.edit_text(progress_text)
-                                    except Exception:
-                                        pass  # Ignore rate limit errors
-                
-                # Send video or audio
-                if action == "audio":
-                    await status_message.edit_text("📤 Відправляю аудіо...")
-                    audio_file = FSInputFile(file_path)
-                    await bot.send_audio(callback.from_user.id, audio=audio_file)
-                else:
-                    await status_message.edit_text("📤 Відправляю відео...")
-                    video_file = FSInputFile(file_path)
-                    await bot.send_video(callback.from_user.id, video=video_file)
-                await status_message.delete()
+                            return None
+                        cached_path = download_cache.commit(cache_key, file_path)
+                    
+                    # Send video or audio
+                    if action == "audio":
+                        await shared_status.edit_text("📤 Відправляю аудіо...")
+                    else:
+                        await shared_status.edit_text("📤 Відправляю відео...")
+                    sent = await send_downloaded_file(chat_id, cached_path, action == "audio")
+                    remember_file_id(url, action, sent)
+                    return sent
                 
-                # Clean up
-                if file_path.exists():
-                    file_path.unlink()
+                except Exception as e:
+                    if job_interrupted():
+                        raise
+                    logging.error(f"Error downloading/sending video: {e}")
+                    await shared_status.edit_text(
+                        f"❌ Помилка при завантаженні.\n\n"
+                        f"Спробуйте пряме посилання:\n"
+                        f"📥 [Завантажити відео]({download_url})",
+                        parse_mode="Markdown",
+                        disable_web_page_preview=True
+                    )
+                    return None
                 
-                # Remove URL from storage
-                if video_id in video_url_storage:
-                    del video_url_storage[video_id]
-                    
-            except Exception as e:
-                logging.error(f"Error downloading/sending video: {e}")
-                await status_message.edit_text(
-                    f"❌ Помилка при завантаженні.\n\n"
-                    f"Спробуйте пряме посилання:\n"
-                    f"📥 [Завантажити відео]({download_url})",
-                    parse_mode="Markdown",
-                    disable_web_page_preview=True
-                )
-                # Clean up on error
-                if file_path and file_path.exists():
-                    file_path.unlink()
-            return
+                finally:
+                    if cached_path is not None:
+                        download_cache.release(cache_key)
+            
+            # Users asking for the same file at the same time share one download
+            job = with_download_slot(chat_id, action == "audio", "⚡ Завантажую відео...", fetch_and_send)
+            sent, leader = await run_coalesced(url, action, status_message, job)
+            if sent is not None:
+                mark_job("sent" if leader else "shared")
+                await deliver_shared_result(chat_id, sent, leader)
+                progress_reporter.forget(status_message)
+                await status_message.delete()
+                return True
+            return False
         
         # Unsupported status
-        await status_message.edit_text(f"❌ Непідтримуваний тип відповіді: {status}")
+        await progress_reporter.edit(status_message, f"❌ Непідтримуваний тип відповіді: {status}")
+        return False
         
+    except QueueFullError:
+        mark_job("queue_full")
+        await progress_reporter.edit(status_message, QUEUE_FULL_TEXT)
+        return False
     except Exception as e:
+        if job_interrupted():
+            raise
         logging.error(f"Error downloading video: {e}")
-        await status_message.edit_text(
+        await progress_reporter.edit(
+            status_message,
             f"❌ Помилка при завантаженні: {str(e)}\n\n"
             f"Можливо, платформа не підтримується або посилання неправильне."
         )
-        # Remove URL from storage on error
-        if video_id in video_url_storage:
-            del video_url_storage[video_id]
+        return True
 
-@dp.callback_query(VideoDownload.filter())
-async def quality_callback_handler(callback: types.CallbackQuery, callback_data: VideoDownload):
-    """Handle quality selection callback"""
+@dp.callback_query(CobaltDownload.filter())
+@tracked_job("cobalt", lambda data: data.action)
+async def cobalt_callback_handler(callback: types.CallbackQuery, callback_data: CobaltDownload):
+    """Handle Cobalt download callback"""
     await callback.answer()
     
-    quality = callback_data.quality
+    action = callback_data.action
     video_id = callback_data.video_id
     
     # Retrieve URL from storage
     url = video_url_storage.get(video_id)
     if not url:
+        mark_job("expired")
         await callback.answer("❌ Посилання застаріло. Надішліть його знову.", show_alert=True)
         if callback.message and hasattr(callback.message, 'delete'):
             await callback.message.delete()  # type: ignore
@@ -706,73 +3710,155 @@ async def quality_callback_handler(callback: types.CallbackQuery, callback_data:
     if callback.message and hasattr(callback.message, 'delete'):
         await callback.message.delete()  # type: ignore
     
+    if prefetcher is not None:
+        prefetcher.picked(video_id, "cobalt", action)
+    
+    # Re-send by file_id if this file was already uploaded, or upload it from disk if still cached
+    if await send_cached_file(callback.from_user.id, url, action) or \
+            await send_from_download_cache(callback.from_user.id, url, action):
+        if prefetcher is not None:
+            # A prefetch of this option is no longer needed, unpin it now rather than at PREFETCH_TTL
+            prefetcher.cancel(video_id)
+        video_url_storage.delete(video_id)
+        return
+    
     # Send status message
     status_message = await bot.send_message(
         callback.from_user.id,
-        f"⚡ Завантажую YouTube відео ({quality})..."
+        "⚡ Завантажую відео..."
     )
     
+    # Downloaded ahead of the click
+    if prefetcher is not None and await prefetcher.deliver(video_id, action, callback.from_user.id, status_message):
+        progress_reporter.forget(status_message)
+        await status_message.delete()
+        video_url_storage.delete(video_id)
+        return
+    
+    with journaled(callback.from_user.id, status_message.message_id, "cobalt", url, action):
+        done = await run_cobalt_job(callback.from_user.id, url, action, status_message)
+    if done:
+        video_url_storage.delete(video_id)
+
+async def run_youtube_job(
+    chat_id: int,
+    url: str,
+    quality: str,
+    info: dict[str, Any] | None,
+    status_message: types.Message
+) -> bool:
+    """Download a YouTube video or its audio and deliver it, reporting in status_message.
+    
+    Returns True once the preview's stored URL is no longer needed.
+    """
+    async def download_and_send(shared_status: SharedStatus) -> types.Message | None:
+        """Download with selected quality and send to the first requester"""
+        cache_key = download_cache.key(url, quality)
+        # Named after the download so yt-dlp can continue its .part file after a restart
+        with download_cache.staging(MAX_FILE_SIZE if quality == "audio" else VIDEO_STAGING_RESERVE, cache_key) as staging_dir:
+            media_path = await fetch_youtube(url, quality, info, shared_status, staging_dir)
+            if not media_path or not media_path.exists():
+                return None
+            cached_path = download_cache.commit(cache_key, media_path)
+        
+        try:
+            await shared_status.edit_text("📤 Відправляю аудіо..." if quality == "audio" else "📤 Відправляю відео...")
+            sent = await send_downloaded_file(chat_id, cached_path, quality == "audio")
+            remember_file_id(url, quality, sent)
+            return sent
+        finally:
+            download_cache.release(cache_key)
+    
     try:
-        # Prepare download with selected quality
-        if quality == "audio":
-            # Download audio only
-            downloads_dir = Path("downloads")
-            downloads_dir.mkdir(exist_ok=True)
-            
-            ydl_opts: dict[str, Any] = {
-                'format': 'bestaudio[ext=m4a]/bestaudio',
-                'outtmpl': str(downloads_dir / '%(title)s.%(ext)s'),
-                'quiet': True,
-                'no_warnings': True,
-            }
-            
-            loop = asyncio.get_event_loop()
-            
-            def download_audio():
-                with yt_dlp.YoutubeDL(ydl_opts) as ydl:  # type: ignore
-                    info = ydl.extract_info(url, download=True)
-                    return Path(ydl.prepare_filename(info))
-            
-            audio_path = await loop.run_in_executor(None, download_audio)
-            
-            await status_message.edit_text("📤 Відправляю аудіо...")
-            audio_file = FSInputFile(audio_path)
-            await bot.send_audio(callback.from_user.id, audio=audio_file)
+        # Users asking for the same video at the same time share one download
+        job = with_download_slot(
+            chat_id, quality == "audio", f"⚡ Завантажую YouTube відео ({quality})...", download_and_send
+        )
+        sent, leader = await run_coalesced(url, quality, status_message, job)
+        if sent is not None:
+            mark_job("sent" if leader else "shared")
+            await deliver_shared_result(chat_id, sent, leader)
+            progress_reporter.forget(status_message)
             await status_message.delete()
+        return True
             
-            # Clean up
-            if audio_path.exists():
-                audio_path.unlink()
-        else:
-            # Download video with selected quality
-            video_path = await download_youtube_video(url, status_message, quality)
-            
-            if video_path and video_path.exists():
-                await status_message.edit_text("📤 Відправляю відео...")
-                video_file = FSInputFile(video_path)
-                await bot.send_video(callback.from_user.id, video=video_file)
-                await status_message.delete()
-                
-                # Clean up
-                video_path.unlink()
-        
-        # Remove URL from storage after successful download
-        if video_id in video_url_storage:
-            del video_url_storage[video_id]
-            
+    except QueueFullError:
+        mark_job("queue_full")
+        await progress_reporter.edit(status_message, QUEUE_FULL_TEXT)
+        return False
     except Exception as e:
+        if job_interrupted():
+            raise
         logging.error(f"Error downloading video: {e}")
-        await status_message.edit_text(
+        await progress_reporter.edit(
+            status_message,
             f"❌ Помилка: {str(e)}\n\nСпробуйте інше посилання."
         )
-        # Remove URL from storage on error too
-        if video_id in video_url_storage:
-            del video_url_storage[video_id]
+        return True
+
+@dp.callback_query(VideoDownload.filter())
+@tracked_job("youtube", lambda data: data.quality)
+async def quality_callback_handler(callback: types.CallbackQuery, callback_data: VideoDownload):
+    """Handle quality selection callback"""
+    await callback.answer()
+    
+    quality = callback_data.quality
+    video_id = callback_data.video_id
+    
+    # Retrieve URL from storage
+    url = video_url_storage.get(video_id)
+    if not url:
+        mark_job("expired")
+        await callback.answer("❌ Посилання застаріло. Надішліть його знову.", show_alert=True)
+        if callback.message and hasattr(callback.message, 'delete'):
+            await callback.message.delete()  # type: ignore
+        return
+    
+    # Delete preview message
+    if callback.message and hasattr(callback.message, 'delete'):
+        await callback.message.delete()  # type: ignore
+    
+    if prefetcher is not None:
+        prefetcher.picked(video_id, "youtube", quality)
+    
+    # Re-send by file_id if this file was already uploaded, or upload it from disk if still cached
+    if await send_cached_file(callback.from_user.id, url, quality) or \
+            await send_from_download_cache(callback.from_user.id, url, quality):
+        if prefetcher is not None:
+            # A prefetch of this option is no longer needed, unpin it now rather than at PREFETCH_TTL
+            prefetcher.cancel(video_id)
+        video_url_storage.delete(video_id)
+        return
+    
+    # Send status message
+    status_message = await bot.send_message(
+        callback.from_user.id,
+        f"⚡ Завантажую YouTube відео ({quality})..."
+    )
+    
+    # Downloaded ahead of the click
+    if prefetcher is not None and await prefetcher.deliver(video_id, quality, callback.from_user.id, status_message):
+        progress_reporter.forget(status_message)
+        await status_message.delete()
+        video_url_storage.delete(video_id)
+        return
+    
+    # Info extracted for the preview, if it is still fresh
+    info = youtube_info_cache.get(video_id)
+    cache_lookups.inc(cache="ytdlp_info", result="miss" if info is None else "hit")
+    
+    with journaled(callback.from_user.id, status_message.message_id, "youtube", url, quality):
+        done = await run_youtube_job(callback.from_user.id, url, quality, info, status_message)
+    if done:
+        video_url_storage.delete(video_id)
 
+@dp.callback_query(CancelPreview.filter())
 @dp.callback_query(F.data == "cancel")
-async def cancel_callback_handler(callback: types.CallbackQuery):
+async def cancel_callback_handler(callback: types.CallbackQuery, callback_data: CancelPreview | None = None):
     """Handle cancel button"""
     await callback.answer("Скасовано")
+    if callback_data is not None and prefetcher is not None:
+        prefetcher.cancel(callback_data.video_id)
     if callback.message and hasattr(callback.message, 'delete'):
         await callback.message.delete()  # type: ignore
 
@@ -785,8 +3871,127 @@ async def other_handler(message: types.Message):
         "Facebook, Dailymotion, Vine, Tumblr, Bilibili та інші!"
     )
 
+RESUME_TEXT = "🔄 Продовжую завантаження після перезапуску..."
+
+async def resume_job(job: dict[str, Any]) -> None:
+    """Continue a journaled job in its chat, reusing the status message if it is still there"""
+    chat_id, url, variant = job["chat_id"], job["url"], job["variant"]
+    with job_journal.running(job["id"]):
+        try:
+            status_message = await bot.edit_message_text(RESUME_TEXT, chat_id=chat_id, message_id=job["message_id"])
+        except TelegramBadRequest:
+            status_message = await bot.send_message(chat_id, RESUME_TEXT)
+        assert isinstance(status_message, types.Message)
+        job_journal.resumed(job["id"], status_message.message_id)
+        
+        # The file may have been finished or even sent just before the restart
+        if await send_cached_file(chat_id, url, variant) or await send_from_download_cache(chat_id, url, variant):
+            progress_reporter.forget(status_message)
+            await status_message.delete()
+            return
+        if job["source"] == "youtube":
+            # Same format as before so yt-dlp continues its .part file
+            info = await get_video_info(url)
+            await run_youtube_job(chat_id, url, variant, info, status_message)
+        else:
+            await run_cobalt_job(chat_id, url, variant, status_message)
+
+async def resume_jobs() -> None:
+    """Restart the jobs the previous run left unfinished, give up on stale ones"""
+    jobs = job_journal.unfinished()
+    resumed = 0
+    for job in jobs:
+        stale = time.time() - job["created_at"] > JOB_JOURNAL_MAX_AGE
+        if stale or job["attempts"] >= JOB_JOURNAL_MAX_RESUMES:
+            job_journal.finish(job["id"])
+            if not any(other["download_key"] == job["download_key"] and other is not job for other in jobs):
+                await asyncio.get_running_loop().run_in_executor(
+                    file_io_executor, download_cache.discard_staging, job["download_key"]
+                )
+            with contextlib.suppress(TelegramAPIError):
+                await bot.edit_message_text(
+                    "❌ Завантаження перервано. Надішліть посилання ще раз.",
+                    chat_id=job["chat_id"],
+                    message_id=job["message_id"]
+                )
+            continue
+        run_in_background(resume_job(job))
+        resumed += 1
+    if jobs:
+        logging.info(f"Job journal: resuming {resumed} of {len(jobs)} unfinished jobs")
+
+@dp.startup()
+async def on_startup() -> None:
+    startup_report.mark("ready")
+    if YTDLP_WARMUP:
+        run_in_background(warm_ytdlp_pool())
+    if job_journal is not None:
+        run_in_background(resume_jobs())
+
+async def run_polling() -> None:
+    """Receive updates with long polling"""
+    # Telegram refuses getUpdates while a webhook from webhook mode is still set
+    await bot.delete_webhook()
+    # The bot session stays open for jobs unwinding on shutdown, main() closes it
+    await dp.start_polling(bot, close_bot_session=False)
+
+async def run_webhook() -> None:
+    """Receive updates on an embedded web server; runs until cancelled"""
+    app = web.Application()
+    # Answer 200 right away and process the update in a task, slow handlers never delay the ack
+    SimpleRequestHandler(
+        dispatcher=dp,
+        bot=bot,
+        handle_in_background=True,
+        secret_token=WEBHOOK_SECRET
+    ).register(app, path=WEBHOOK_PATH)
+    setup_application(app, dp, bot=bot)
+    
+    runner = web.AppRunner(app)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT).start()
+        await bot.set_webhook(
+            f"{WEBHOOK_URL}{WEBHOOK_PATH}",
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=dp.resolve_used_update_types(),
+            max_connections=WEBHOOK_MAX_CONNECTIONS
+        )
+        logging.info(f"Webhook mode: listening on {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+        # The webhook stays registered on exit so other instances and the next start keep receiving updates
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
+startup_report.mark("import")
+
 async def main():
-    await dp.start_polling(bot)
+    get_http_session()
+    # Partial downloads of unfinished jobs survive the sweep so they can be resumed
+    keep_staging = {job["download_key"] for job in job_journal.unfinished()} if job_journal is not None else set()
+    await asyncio.get_running_loop().run_in_executor(file_io_executor, download_cache.sweep, keep_staging)
+    if local_uploader is not None:
+        await asyncio.get_running_loop().run_in_executor(file_io_executor, local_uploader.sweep)
+    metrics_runner = await start_metrics_server()
+    health_task = asyncio.create_task(cobalt_pool.run_health_checks())
+    try:
+        if WEBHOOK_URL:
+            await run_webhook()
+        else:
+            await run_polling()
+    finally:
+        # Jobs cut off from here on stay journaled and keep their partial files for the next start
+        download_cache.keep_staging = True
+        if job_journal is not None:
+            # Before the sessions close, so jobs stop as interrupted rather than failing
+            await job_journal.interrupt()
+        health_task.cancel()
+        ytdlp_runner.shutdown()
+        await close_http_session()
+        await bot.session.close()
+        ytdlp_pool.close()
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
 
 if __name__ == "__main__":
     asyncio.run(main())
\ No newline at end of file
@@ -0,0 +1,191 @@
+"""yt-dlp jobs, importable by worker processes.
+
+Worker processes of the extraction pool import only this module, so it has
+no side effects at import: no bot, databases, executors or environment.
+"""
+
+import contextlib
+import logging
+import threading
+import time
+from collections import deque
+from pathlib import Path
+from typing import Any, Callable, Iterator
+
+# yt-dlp is imported on first use: it is only needed for YouTube, most traffic goes to Cobalt
+yt_dlp: Any = None
+
+def load_yt_dlp() -> Any:
+    """Import yt-dlp once, on the first YouTube job (blocking)"""
+    global yt_dlp
+    if yt_dlp is None:
+        started = time.perf_counter()
+        import yt_dlp as module
+        yt_dlp = module
+        logging.info(f"yt-dlp imported in {time.perf_counter() - started:.2f}s")
+    return yt_dlp
+
+YTDLP_BASE_OPTIONS: dict[str, Any] = {
+    'quiet': True,
+    'no_warnings': True,
+    'noprogress': True,  # Progress goes to users through hooks, not to stdout
+    'continuedl': True,  # Pick up .part files left by a job cut off by a restart
+}
+
+# Format selected when only extracting info; yt-dlp's default when ffmpeg can merge
+EXTRACT_FORMAT = 'bestvideo*+bestaudio/best'
+
+class YoutubeDLWorker:
+    """One YoutubeDL instance, the settings of its current job and the number of jobs it has served"""
+
+    def __init__(self, options: dict[str, Any]):
+        # yt-dlp accepts a callable format and fixes format and hooks at init, so both go through the worker
+        self.ydl = load_yt_dlp().YoutubeDL({**options, 'format': self.select_formats})
+        self.ydl.add_progress_hook(self.report_progress)
+        # Create the extractor now so its player/signature caches live with the worker
+        self.ydl.get_info_extractor("Youtube")
+        self.format_selector = self.ydl.build_format_selector(EXTRACT_FORMAT)
+        self.progress_hook: Callable[[dict[str, Any]], None] | None = None
+        self.jobs = 0
+
+    def select_formats(self, ctx: dict[str, Any]) -> Iterator[dict[str, Any]]:
+        return self.format_selector(ctx)
+
+    def report_progress(self, d: dict[str, Any]) -> None:
+        if self.progress_hook is not None:
+            self.progress_hook(d)
+
+    def configure(
+        self,
+        format: str | None,
+        outtmpl: str | None,
+        progress_hook: Callable[[dict[str, Any]], None] | None
+    ) -> None:
+        """Set up the instance for one job"""
+        self.format_selector = self.ydl.build_format_selector(format or EXTRACT_FORMAT)
+        self.ydl.params['outtmpl']['default'] = outtmpl or yt_dlp.utils.DEFAULT_OUTTMPL['default']
+        self.progress_hook = progress_hook
+
+class YoutubeDLPool:
+    """Hands out pre-built YoutubeDL workers to blocking jobs and recycles them after max_jobs"""
+
+    def __init__(self, options: dict[str, Any], size: int, max_jobs: int):
+        self.options = options
+        self.size = size
+        self.max_jobs = max_jobs
+        self.created = 0
+        self.recycled = 0
+        self._idle: deque[YoutubeDLWorker] = deque()
+        self._lock = threading.Lock()
+
+    def _create(self) -> YoutubeDLWorker:
+        worker = YoutubeDLWorker(self.options)
+        with self._lock:
+            self.created += 1
+        return worker
+
+    def warm(self, count: int) -> None:
+        """Build workers ahead of the first request (blocking)"""
+        while True:
+            with self._lock:
+                if len(self._idle) >= min(count, self.size):
+                    return
+            worker = self._create()
+            with self._lock:
+                self._idle.append(worker)
+
+    @contextlib.contextmanager
+    def checkout(
+        self,
+        format: str | None = None,
+        outtmpl: str | None = None,
+        progress_hook: Callable[[dict[str, Any]], None] | None = None
+    ) -> Iterator[Any]:
+        """Borrow a worker configured for one job (blocking, run in an executor)"""
+        load_yt_dlp()
+        with self._lock:
+            # Most recently used first, its caches are the warmest
+            worker = self._idle.pop() if self._idle else None
+        if worker is None:
+            worker = self._create()
+        
+        reusable = False
+        try:
+            worker.configure(format, outtmpl, progress_hook)
+            yield worker.ydl
+            reusable = True
+        except (yt_dlp.utils.DownloadError, yt_dlp.utils.DownloadCancelled):
+            # Expected failure, the instance itself is fine
+            reusable = True
+            raise
+        finally:
+            worker.progress_hook = None
+            worker.jobs += 1
+            self._release(worker, reusable)
+
+    def _release(self, worker: YoutubeDLWorker, reusable: bool) -> None:
+        with self._lock:
+            if reusable and worker.jobs < self.max_jobs and len(self._idle) < self.size:
+                self._idle.append(worker)
+                return
+            if worker.jobs >= self.max_jobs:
+                self.recycled += 1
+        worker.ydl.close()
+
+    def close(self) -> None:
+        with self._lock:
+            workers, self._idle = list(self._idle), deque()
+        for worker in workers:
+            worker.ydl.close()
+
+    def stats(self) -> dict[str, int]:
+        return {"idle": len(self._idle), "created": self.created, "recycled": self.recycled}
+
+def extract_info(pool: YoutubeDLPool, url: str) -> dict[str, Any]:
+    """Extract metadata (blocking)"""
+    with pool.checkout() as ydl:
+        return ydl.sanitize_info(ydl.extract_info(url, download=False))
+
+def download(
+    pool: YoutubeDLPool,
+    url: str,
+    format_string: str,
+    outtmpl: str,
+    info: dict[str, Any] | None = None,
+    progress_hook: Callable[[dict[str, Any]], None] | None = None
+) -> Path:
+    """Download with yt-dlp (blocking), feeding back already extracted info if given"""
+    with pool.checkout(format_string, outtmpl, progress_hook) as ydl:
+        if info is not None:
+            try:
+                # Same path as --load-info-json: skips page fetch and player JS deciphering
+                result = ydl.process_ie_result(ydl.sanitize_info(info, remove_private_keys=True), download=True)
+                return Path(ydl.prepare_filename(result))
+            except yt_dlp.utils.DownloadError as e:
+                # Stream URLs may have expired, fall back to a fresh extraction
+                logging.warning(f"Download from cached info failed, re-extracting: {e}")
+        
+        result = ydl.extract_info(url, download=True)
+        return Path(ydl.prepare_filename(result))
+
+# Pool of a worker process, built by init_process
+process_pool: YoutubeDLPool | None = None
+
+def init_process(size: int, max_jobs: int) -> None:
+    """Worker process initializer: build a YoutubeDL instance"""
+    global process_pool
+    process_pool = YoutubeDLPool(YTDLP_BASE_OPTIONS, size, max_jobs)
+    process_pool.warm(1)
+
+def ping() -> None:
+    """No-op job, used to start worker processes ahead of time"""
+
+def extract_job(url: str) -> dict[str, Any]:
+    """Extract metadata in a worker process"""
+    assert process_pool is not None
+    try:
+        return extract_info(process_pool, url)
+    except yt_dlp.utils.DownloadError as e:
+        # The original carries a traceback that cannot cross a process boundary
+        raise yt_dlp.utils.DownloadError(str(e)) from None
+